@@ -1,20 +1,27 @@
 from time import time
-from typing import Tuple, Any, Dict
+from typing import Tuple, Any, Dict, List, Union, Iterator
+from collections import OrderedDict
 from data_handler import DataPoint
 from csv import reader
+from functools import lru_cache
+from threading import Lock
+import sqlite3
+import os
+import metrics
+from tracks import TrackStore
 
 
 class Aircraft:
 
-    def __init__(self, icao_id: str, attrs: Dict[str, DataPoint]):
+    def __init__(self, icao_id: str, attrs: Dict[str, DataPoint], t: Union[float, None] = None):
         self.icao = icao_id
-        self.last_update = round(time())
-        self.attrs = attrs
+        self.last_update = round(time()) if t is None else t
+        self.attrs = dict(attrs)  # the dict is updated in place, so it can't be the message's own
         self.model, self.operator = AircraftICAODB.get_info(icao_id)
 
-    def update(self, new_attrs):
+    def update(self, new_attrs, t: Union[float, None] = None):
         """ Update aircraft's info with new_attrs from a message """
-        self.last_update = round(time())
+        self.last_update = round(time()) if t is None else t
         self.attrs.update(new_attrs)
 
     def __getitem__(self, item):
@@ -33,26 +40,170 @@ class Aircraft:
         return self.last_update > other.last_update
 
 
+UPDATES = metrics.REGISTRY.counter('a522_aircraft_updates_total', 'Aircraft updates from messages')
+REMOVED = metrics.REGISTRY.counter('a522_aircraft_removed_total', 'Aircraft dropped from tracking', 'reason',
+                                   ('expired', 'evicted'))
+
+
+class AircraftRegistry:
+    """
+    Tracked aircraft, keyed by ICAO. Aircraft are kept in order of their last update so lookups are O(1) and
+    expiring or evicting stale aircraft only touches the ones that are removed.
+    Iterating gives the most recently updated aircraft first
+    """
+
+    def __init__(self, capacity: int = 5000, tracks: Union[TrackStore, None] = None):
+        """
+        :param capacity: max aircraft tracked. Once full, the least recently updated aircraft is evicted
+        :param tracks: where to keep each aircraft's position history, if anywhere. Tracks are dropped along with
+        their aircraft
+        """
+        self.capacity = capacity
+        self.evicted = 0
+        self.tracks = tracks
+        self._aircraft: 'OrderedDict[str, Aircraft]' = OrderedDict()
+
+    def update(self, icao_id: str, attrs: Dict[str, DataPoint], t: Union[float, None] = None) -> Aircraft:
+        """ Updates an aircraft with attrs from a message, adding it if it's new. Returns the aircraft """
+        UPDATES.inc()
+        if self.tracks is not None:
+            self.tracks.update(icao_id, attrs, t)
+        craft = self._aircraft.get(icao_id)
+        if craft is None:
+            craft = self._aircraft[icao_id] = Aircraft(icao_id, attrs, t)
+            while len(self._aircraft) > self.capacity:
+                evicted, _ = self._aircraft.popitem(last=False)
+                self._drop_track(evicted)
+                self.evicted += 1
+                REMOVED.inc_at(1)
+        else:
+            craft.update(attrs, t)
+            self._aircraft.move_to_end(icao_id)
+        return craft
+
+    def _drop_track(self, icao_id: str) -> None:
+        if self.tracks is not None:
+            self.tracks.remove(icao_id)
+
+    def expire(self, max_age: float, now: Union[float, None] = None) -> List[Aircraft]:
+        """ Removes aircraft that haven't been updated within max_age seconds. Returns the removed aircraft """
+        now = round(time()) if now is None else now
+        removed = []
+        while len(self._aircraft) > 0:
+            icao_id, craft = next(iter(self._aircraft.items()))
+            if now - craft.last_update <= max_age:
+                break
+            removed.append(self._aircraft.pop(icao_id))
+            self._drop_track(icao_id)
+        REMOVED.inc_at(0, len(removed))
+        return removed
+
+    def get(self, icao_id: str) -> Union[Aircraft, None]:
+        return self._aircraft.get(icao_id)
+
+    def __contains__(self, icao_id: str) -> bool:
+        return icao_id in self._aircraft
+
+    def __len__(self):
+        return len(self._aircraft)
+
+    def __iter__(self) -> Iterator[Aircraft]:
+        return reversed(self._aircraft.values())
+
+
 class AircraftICAODB:
-    """ Static class for getting data from CSV file """
-    mapping = {}
+    """
+    Static class for getting data from the aircraft database.
+    The CSV is converted once into an indexed SQLite file (see ``build_index()``) and lookups are point queries
+    against it behind a small LRU cache, so nothing is loaded up front. A rebuilt index is picked up without a restart
+    """
     # file from - https://junzis.com/adb/data
     # it's outdated, but the best free source I could find
     # file not in repo as it's not mine
     _file = 'aircraft_db.csv'
+    _index = 'aircraft_db.sqlite'
+    _conn: Union[sqlite3.Connection, None] = None
+    _index_mtime = None
+    _next_check = 0
+    _lock = Lock()  # the GUI looks aircraft up from several threads
+    CHECK_INTERVAL = 60  # seconds between checks for a rebuilt index
 
     @classmethod
     def get_info(cls, icao_id: str) -> Tuple[str, str]:
         """ Returns the model and operator of an aircraft with the given ICAO ID """
-        if len(cls.mapping) == 0:
-            cls._generate_mapping()
-        return cls.mapping.get(icao_id.lower(), ('Unknown', 'Unknown'))
+        with cls._lock:
+            cls._check_index()
+            return cls._lookup(icao_id.lower())
+
+    @classmethod
+    @lru_cache(maxsize=4096)
+    def _lookup(cls, icao_id: str) -> Tuple[str, str]:
+        if cls._conn is None:
+            return 'Unknown', 'Unknown'
+        try:
+            key = int(icao_id, 16)
+        except ValueError:
+            return 'Unknown', 'Unknown'
+        row = cls._conn.execute('SELECT model, operator FROM aircraft WHERE icao = ?', (key,)).fetchone()
+        return row if row is not None else ('Unknown', 'Unknown')
 
     @classmethod
-    def _generate_mapping(cls):
-        with open(cls._file, newline='') as csv:
-            data = list(reader(csv))
-            for line in data[1:]:
-                model = line[3] if len(line[3]) > 0 else 'Unknown'
-                operator = line[4] if len(line[4]) > 0 else 'Unknown'
-                cls.mapping[line[0]] = (model, operator)
+    def _check_index(cls) -> None:
+        """ Opens the index (building it from the CSV if needed) and reopens it if it has been rebuilt """
+        now = time()
+        if now < cls._next_check:
+            return
+        cls._next_check = now + cls.CHECK_INTERVAL
+        if not os.path.exists(cls._index):
+            if not os.path.exists(cls._file):
+                return
+            print(f'Building aircraft index {cls._index} from {cls._file}. This only happens once')
+            cls.build_index(cls._file, cls._index)
+        mtime = os.path.getmtime(cls._index)
+        if mtime != cls._index_mtime:
+            if cls._conn is not None:
+                cls._conn.close()
+            cls._conn = sqlite3.connect(cls._index, check_same_thread=False)
+            cls._index_mtime = mtime
+            cls._lookup.cache_clear()
+
+    @staticmethod
+    def build_index(csv_file: str, index_file: str) -> int:
+        """
+        Converts the CSV database into an SQLite index keyed on the 24 bit ICAO. The new index is written next to the
+        old one and swapped in at the end, so it can be refreshed while running
+        :return: number of aircraft in the index
+        """
+        def rows():
+            with open(csv_file, newline='') as csv:
+                lines = reader(csv)
+                next(lines, None)  # header
+                for line in lines:
+                    try:
+                        icao = int(line[0], 16)
+                    except (ValueError, IndexError):
+                        continue
+                    model = line[3] if len(line[3]) > 0 else 'Unknown'
+                    operator = line[4] if len(line[4]) > 0 else 'Unknown'
+                    yield icao, model, operator
+
+        tmp = index_file + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        conn = sqlite3.connect(tmp)
+        conn.execute('CREATE TABLE aircraft (icao INTEGER PRIMARY KEY, model TEXT, operator TEXT)')
+        conn.executemany('INSERT OR REPLACE INTO aircraft VALUES (?, ?, ?)', rows())
+        conn.commit()
+        count = conn.execute('SELECT COUNT(*) FROM aircraft').fetchone()[0]
+        conn.close()
+        os.replace(tmp, index_file)
+        return count
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Builds the indexed aircraft database from the CSV')
+    parser.add_argument('csv', nargs='?', default=AircraftICAODB._file, help='CSV database to convert')
+    parser.add_argument('index', nargs='?', default=AircraftICAODB._index, help='Index file to write')
+    args = parser.parse_args()
+    print(f'Indexed {AircraftICAODB.build_index(args.csv, args.index)} aircraft into {args.index}')
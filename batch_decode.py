@@ -0,0 +1,205 @@
+import numpy as np
+from typing import Dict, Tuple, Union
+
+import cpr
+import crc
+import utils
+from data_handler import CHAR_TABLE, CLASS_TABLE, DATA_LEN, DataPoint
+from utils import MSG_LEN
+
+# one row per frame. Columns that don't apply to a frame's type are left at their fill value (NaN, 0 or '')
+DECODED = np.dtype([
+    ('valid', '?'), ('df', 'u1'), ('icao', '<u4'), ('tc', 'u1'),
+    # identity (tc 1-4). category is the emitter category, see ``category_names()``
+    ('category', 'u1'), ('callsign', 'U8'),
+    # airborne velocity (tc 19)
+    ('subtype', 'u1'), ('v_we', '<i4'), ('v_sn', '<i4'), ('horz_vel', '<f8'), ('heading', '<f8'),
+    ('vert_baro', '?'), ('vert_vel', '<i4'),
+    # airborne position (tc 9-18, 20-22)
+    ('cpr_odd', '?'), ('lat_cpr', '<u4'), ('lon_cpr', '<u4'), ('lat', '<f8'), ('lon', '<f8'), ('alt', '<i4'),
+])
+
+IDENTITY_TCS = np.arange(1, 5)
+VELOCITY_TCS = np.array([19])
+POSITION_TCS = np.array(list(range(9, 19)) + list(range(20, 23)))
+
+_CHARS = np.frombuffer(CHAR_TABLE.encode(), dtype='S1')
+# CLASS_TABLE padded out to every (tc, emitter category). Combinations the table doesn't have are ''
+_CLASSES = np.array([[row[ec] if ec < len(row) else '' for ec in range(8)] for row in CLASS_TABLE], dtype='U33')
+_NL_TABLE = np.array(cpr.NL_TABLE)
+
+
+def _in_group(tc: np.ndarray, tcs: np.ndarray) -> np.ndarray:
+    """ Whether each type code is one of tcs. A table lookup, since there are only 32 type codes """
+    table = np.zeros(32, dtype=bool)
+    table[tcs] = True
+    return table[tc]
+
+
+def _bits(data: np.ndarray, start: int, end: int) -> np.ndarray:
+    """ Vectorized ``data_handler.get_bits()`` over uint64 payloads """
+    return ((data >> np.uint64(DATA_LEN - end)) & np.uint64((1 << (end - start)) - 1)).astype(np.int64)
+
+
+def _as_frames(frames: np.ndarray) -> np.ndarray:
+    """ (N, 14) uint8 frames from either frames or an (N, 112) matrix of bits """
+    frames = np.asarray(frames)
+    if frames.ndim != 2 or frames.shape[1] not in (MSG_LEN, MSG_LEN // 8):
+        raise ValueError(f'frames must be (N, {MSG_LEN // 8}) bytes or (N, {MSG_LEN}) bits, not {frames.shape}')
+    if frames.shape[1] == MSG_LEN:
+        return np.packbits(frames.astype(bool), axis=1)
+    return frames.astype(np.uint8, copy=False)
+
+
+def _me_field(frames: np.ndarray) -> np.ndarray:
+    """ The 56 bit ME field (type code then payload) of each frame as uint64 """
+    me = np.zeros(len(frames), dtype=np.uint64)
+    for col in frames[:, 4:11].T:
+        me = (me << np.uint64(8)) | col
+    return me
+
+
+def nl(lat: np.ndarray) -> np.ndarray:
+    """ Vectorized ``cpr.nl()`` """
+    return 59 - np.searchsorted(_NL_TABLE, np.abs(lat), side='left')
+
+
+def decode_local(is_odd: np.ndarray, lat_cpr: np.ndarray, lon_cpr: np.ndarray, ref_lat: float, ref_lon: float) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """ Vectorized ``cpr.decode_local()``. Same operations in the same order, so results are identical """
+    d_lat = np.where(is_odd, 360 / 59, 360 / 60)
+    lat_ind = np.floor(ref_lat / d_lat) + np.floor((ref_lat % d_lat) / d_lat - lat_cpr + 0.5)
+    lat = d_lat * (lat_ind + lat_cpr)
+
+    zones = nl(lat) - is_odd
+    d_lon = np.where(zones > 0, 360 / np.maximum(zones, 1), 360)
+    lon_ind = np.floor(ref_lon / d_lon) + np.floor((ref_lon % d_lon) / d_lon - lon_cpr + 0.5)
+    lon = d_lon * (lon_ind + lon_cpr)
+    return lat, lon
+
+
+def _identity(data: np.ndarray) -> Dict[str, np.ndarray]:
+    codes = np.stack([_bits(data, i, i + 6) for i in range(3, DATA_LEN, 6)], axis=1)
+    return {'category': _bits(data, 0, 3),
+            'callsign': np.char.rstrip(_CHARS[codes].view('S8')[:, 0], b'_').astype('U8')}
+
+
+def _velocity(data: np.ndarray) -> Dict[str, np.ndarray]:
+    out = {}
+    subtype = _bits(data, 0, 3)
+    out['subtype'] = subtype
+    v_we = np.where(_bits(data, 8, 9) == 1, -1, 1) * (_bits(data, 9, 19) - 1)
+    v_sn = np.where(_bits(data, 19, 20) == 1, -1, 1) * (_bits(data, 20, 30) - 1)
+    ground = subtype <= 2  # ground speed. Airspeed subtypes aren't decoded
+    out['v_we'] = np.where(ground, v_we, 0)
+    out['v_sn'] = np.where(ground, v_sn, 0)
+    out['horz_vel'] = np.where(ground, np.sqrt(np.square(v_we) + np.square(v_sn)), np.nan)
+    out['heading'] = np.where(ground, (np.rad2deg(np.arctan2(v_we, v_sn)) + 360) % 360, np.nan)
+    out['vert_baro'] = _bits(data, 28, 29) == 1
+    out['vert_vel'] = np.where(_bits(data, 31, 32) == 1, -1, 1) * (_bits(data, 32, 41) - 1) * 64
+    return out
+
+
+def _position(data: np.ndarray, ref: Union[Tuple[float, float], None]) -> Dict[str, np.ndarray]:
+    out = {}
+    is_odd = _bits(data, 16, 17)
+    out['cpr_odd'] = is_odd == 1
+    out['lat_cpr'] = lat_cpr = _bits(data, 17, 34)
+    out['lon_cpr'] = lon_cpr = _bits(data, 34, 51)
+    if ref is not None:
+        out['lat'], out['lon'] = decode_local(is_odd, lat_cpr / cpr.CPR_MAX, lon_cpr / cpr.CPR_MAX, *ref)
+    alt_mult = np.where(_bits(data, 10, 11) == 1, 25, 100)
+    out['alt'] = ((_bits(data, 3, 10) << 4) | _bits(data, 11, 15)) * alt_mult - 1000
+    return out
+
+
+def decode(frames: np.ndarray, ref: Union[Tuple[float, float], None] = None) -> np.ndarray:
+    """
+    Decodes many frames at once: rows are grouped by type code and each group is decoded with array operations.
+    Values match the ``DataHandler`` handlers exactly. Positions are decoded locally against ``ref`` (like
+    ``handle_position()`` without an ICAO), since even/odd pairing depends on each aircraft's history
+    :param frames: (N, 14) uint8 frames or an (N, 112) bit matrix
+    :param ref: (lat, lon) to decode positions against. Default is utils.REF_LAT/REF_LON. Without one, lat and lon
+    are NaN
+    :return: (N,) array of DECODED rows, in the order of frames
+    """
+    frames = _as_frames(frames)
+    if ref is None and utils.REF_LAT is not None and utils.REF_LON is not None:
+        ref = (utils.REF_LAT, utils.REF_LON)
+    out = np.zeros(len(frames), dtype=DECODED)
+    for col in ('horz_vel', 'heading', 'lat', 'lon'):
+        out[col] = np.nan
+    if len(frames) == 0:
+        return out
+
+    out['valid'] = crc.syndromes(frames) == 0
+    out['df'] = frames[:, 0] >> 3
+    out['icao'] = (frames[:, 1].astype(np.uint32) << 16) | (frames[:, 2].astype(np.uint32) << 8) | frames[:, 3]
+    me = _me_field(frames)
+    tc = (me >> np.uint64(DATA_LEN)).astype(np.int64)
+    out['tc'] = tc
+    data = me & np.uint64((1 << DATA_LEN) - 1)
+
+    # each group's columns are written straight into the output, so rows are never copied as records
+    valid = out['valid']
+    for tcs, handler in ((IDENTITY_TCS, _identity), (VELOCITY_TCS, _velocity),
+                         (POSITION_TCS, lambda d: _position(d, ref))):
+        rows = np.flatnonzero(valid & _in_group(tc, tcs))
+        if len(rows):
+            for col, vals in handler(data[rows]).items():
+                out[col][rows] = vals
+    return out
+
+
+def category_names(decoded: np.ndarray) -> np.ndarray:
+    """ Vehicle class of each row (what ``handle_identity()`` calls its type). '' for rows that aren't identities """
+    names = _CLASSES[np.clip(decoded['tc'].astype(np.int64) - 1, 0, 3), decoded['category']]
+    return np.where(np.isin(decoded['tc'], IDENTITY_TCS) & decoded['valid'], names, '')
+
+
+def to_data(row: np.void) -> Dict[str, DataPoint]:
+    """ One decoded row as the dict the ``DataHandler`` handlers give, for code written against them """
+    tc = int(row['tc'])
+    if not row['valid']:
+        return {}
+    vals = {}
+    if tc in IDENTITY_TCS:
+        vals['type'] = DataPoint('Type', str(_CLASSES[tc - 1, row['category']]))
+        vals['id'] = DataPoint('ID', str(row['callsign']))
+    elif tc in VELOCITY_TCS:
+        vals['horz_type'] = DataPoint('Horz. Type', 'GROUND' if row['subtype'] <= 2 else 'AIR')
+        if row['subtype'] <= 2:
+            vals['horz_vel'] = DataPoint('Horz. Velocity', row['horz_vel'], 'kts')
+            vals['heading'] = DataPoint('Heading', row['heading'], 'deg')
+        vals['vert_type'] = DataPoint('Vert. Type', 'BARO' if row['vert_baro'] else 'GEO')
+        vals['vert_vel'] = DataPoint('Vert. Velocity', int(row['vert_vel']), 'ft/min')
+    elif tc in POSITION_TCS:
+        if not np.isnan(row['lat']):
+            vals['lat'] = DataPoint('Latitude', float(row['lat']), 'deg')
+            vals['lon'] = DataPoint('Longitude', float(row['lon']), 'deg')
+        vals['alt'] = DataPoint('Altitude', int(row['alt']), 'ft')
+    return vals
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from synth import load_frames
+    parser = argparse.ArgumentParser(description='Decodes message files (text or binary recordings) in one batch')
+    parser.add_argument('input', nargs='+', help='Message files to decode')
+    parser.add_argument('-o', '--output', default=None, help='.npy file to save the decoded columns to')
+    parser.add_argument('-c', '--custom-coords', default=None,
+                        help='Reference to decode positions against, as `lat,lon`. Default is none (no positions)')
+    args = parser.parse_args()
+
+    coords = None if args.custom_coords is None else tuple(float(v) for v in args.custom_coords.split(','))
+    frames = load_frames(args.input)
+    start = time.perf_counter()
+    decoded = decode(frames, coords)
+    elapsed = time.perf_counter() - start
+    print(f'Decoded {len(decoded)} frames ({decoded["valid"].sum()} valid) in {elapsed:.3f}s '
+          f'({len(decoded) / max(elapsed, 1e-9):.0f} frames/s)')
+    tcs, counts = np.unique(decoded['tc'][decoded['valid']], return_counts=True)
+    print('Type codes: ' + ', '.join(f'{tc}: {n}' for tc, n in zip(tcs, counts)))
+    if args.output is not None:
+        np.save(args.output, decoded)
@@ -0,0 +1,183 @@
+import json
+import platform
+import sys
+import time
+import numpy as np
+from typing import Callable, Dict, List, Tuple
+
+import batch_decode
+import crc
+import demod
+import synth
+import utils
+from aircraft import AircraftRegistry
+from data_handler import DataHandler, DecodeCache
+from message import Message
+from radio import Demodulator
+
+CHUNK = 16384  # samples handed to the demodulator at a time, like reads from the radio
+
+
+def run_stage(name: str, fn: Callable[[], Tuple[int, int]], repeat: int) -> Dict[str, float]:
+    """
+    Times a stage. The fastest run is reported since slower runs are mostly noise from the rest of the system
+    :param fn: runs the stage once and returns the (samples, frames) it processed
+    """
+    times = []
+    samples = frames = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        samples, frames = fn()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {'stage': name, 'runs': repeat, 'seconds': best, 'median_seconds': float(np.median(times)),
+            'samples': samples, 'frames': frames,
+            'samples_per_s': samples / best if samples > 0 else None,
+            'frames_per_s': frames / best if frames > 0 else None,
+            'us_per_frame': best / frames * 1e6 if frames > 0 else None}
+
+
+def min_amp(mag: np.ndarray) -> float:
+    """ Preamble threshold the same way Demodulator picks it """
+    window = 200
+    return 4 * float(mag[: len(mag) // window * window].reshape(-1, window).mean(axis=1).min())
+
+
+def run(seconds: float = 1.0, rate: float = 1000, noise: float = 20, overlap: float = 0.0, repeat: int = 5,
+        seed: int = 0, workers: int = 1, lut: bool = False) -> Dict:
+    """ Benchmarks every stage on one synthesized stream. Returns the results as a JSON friendly dict """
+    sig = synth.synthesize(synth.load_frames(), seconds, rate, noise, overlap=overlap, iq=True, seed=seed)
+    mag = np.absolute(sig.samples)
+    thresh = min_amp(mag)
+    starts = demod.find_preambles(mag, thresh)
+    bits, lengths = demod.slice_bits(mag, starts)
+    full = lengths == utils.MSG_LEN
+    frames = np.packbits(bits[full, :utils.MSG_LEN], axis=1)
+    valid = crc.syndromes(frames) == 0
+    raw_frames = [f.tobytes() for f in frames[valid]]
+    times = (starts[full][valid] / synth.SAMPLE_RATE).tolist()
+
+    def preamble():
+        return len(mag), len(demod.find_preambles(mag, thresh))
+
+    def slicing():
+        b, l = demod.slice_bits(mag, starts)
+        np.packbits(b[l == utils.MSG_LEN, :utils.MSG_LEN], axis=1)
+        return 0, len(starts)
+
+    def crc_check():
+        crc.syndromes(frames)
+        return 0, len(frames)
+
+    def decode(cache_size: int) -> Callable[[], Tuple[int, int]]:
+        def fn():
+            DataHandler.cache = DecodeCache(cache_size)
+            for f, t in zip(raw_frames, times):
+                m = Message(f)
+                m.timestamp = t
+                m.data
+            return 0, len(raw_frames)
+        return fn
+
+    def decode_batch():
+        batch_decode.decode(frames[valid])
+        return 0, int(valid.sum())
+
+    msgs = []
+    for f, t in zip(raw_frames, times):
+        msgs.append(Message(f))
+        msgs[-1].timestamp = t
+        msgs[-1].data
+
+    def aircraft():
+        registry = AircraftRegistry()
+        for m in msgs:
+            registry.update(m.icao, m.data, m.timestamp)
+        return 0, len(msgs)
+
+    latencies: List[float] = []
+    demodulator = Demodulator(workers=workers, lut=lut)  # made once so worker start up isn't timed
+    # with the LUT the demodulator gets int16 I/Q pairs, like the radio gives it
+    stream = np.stack((sig.samples.real, sig.samples.imag), axis=1).round().astype(np.int16) if lut else sig.samples
+
+    def end_to_end():
+        latencies.clear()
+        DataHandler.cache = DecodeCache()
+        demodulator.raw_buf.consume(len(demodulator.raw_buf))
+        registry = AircraftRegistry()
+        n_frames = 0
+        # the last pass flushes whatever is left in the buffer, however the stream divides into chunks
+        for i in list(range(0, len(stream), CHUNK)) + [len(stream)]:
+            start = time.perf_counter()
+            if i < len(stream):
+                demodulator.write(stream[i:i + CHUNK])
+                if not demodulator.ready():
+                    continue
+            elif len(demodulator.raw_buf) == 0:
+                break
+            batch = demodulator.process(i / synth.SAMPLE_RATE)
+            for m in batch.messages():
+                if m.valid:
+                    registry.update(m.icao, m.data, m.timestamp)
+            n_frames += batch.size
+            latencies.append(time.perf_counter() - start)
+        return len(stream), n_frames
+
+    results = [run_stage('preamble', preamble, repeat),
+               run_stage('slice', slicing, repeat),
+               run_stage('crc', crc_check, repeat),
+               run_stage('decode', decode(0), repeat),
+               run_stage('decode_cached', decode(DecodeCache().maxsize), repeat),
+               run_stage('decode_batch', decode_batch, repeat),
+               run_stage('aircraft', aircraft, repeat),
+               run_stage('end_to_end', end_to_end, repeat)]
+    demodulator.close()
+    # a frame waits for the rest of its buffer to be processed, so that is its latency
+    results[-1]['latency_ms_p50'] = float(np.percentile(latencies, 50)) * 1e3
+    results[-1]['latency_ms_p99'] = float(np.percentile(latencies, 99)) * 1e3
+    results[-1]['frames_sent'] = len(sig.starts)
+
+    return {'time': time.time(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'params': {'seconds': seconds, 'rate': rate, 'noise': noise, 'overlap': overlap, 'repeat': repeat,
+                       'seed': seed, 'workers': workers, 'lut': lut},
+            'results': results}
+
+
+def _fmt(val, spec: str) -> str:
+    return '-' if val is None else format(val, spec)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks each stage of the decoder on synthesized samples')
+    parser.add_argument('-s', '--seconds', type=float, default=1.0, help='Length of the stream. Default is 1')
+    parser.add_argument('-r', '--rate', type=float, default=1000, help='Average frames a second. Default is 1000')
+    parser.add_argument('--noise', type=float, default=20, help='Noise standard deviation. Default is 20')
+    parser.add_argument('--overlap', type=float, default=0.0,
+                        help='Fraction of frames that overlap the previous one. Default is 0')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Runs of each stage. Default is 5')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default is 0')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Processes the end to end demodulator uses. Default is 1')
+    parser.add_argument('--lut', action='store_true',
+                        help='Have the end to end demodulator take int16 I/Q and use the magnitude lookup table')
+    parser.add_argument('--json', default=None, help='File to write results to as JSON (`-` for stdout)')
+    args = parser.parse_args()
+
+    utils.REF_LAT, utils.REF_LON = 40.25, -111.65  # only needs to be near the recordings in data/
+    report = run(args.seconds, args.rate, args.noise, args.overlap, args.repeat, args.seed, args.workers, args.lut)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        sys.exit(0)
+    if args.json is not None:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2)
+
+    print(f'{"stage":<14}{"samples/s":>14}{"frames/s":>14}{"us/frame":>12}')
+    for res in report['results']:
+        print(f'{res["stage"]:<14}{_fmt(res["samples_per_s"], ",.0f"):>14}{_fmt(res["frames_per_s"], ",.0f"):>14}'
+              f'{_fmt(res["us_per_frame"], ".2f"):>12}')
+    e2e = report['results'][-1]
+    print(f'end to end: {e2e["frames"]}/{e2e["frames_sent"]} frames found, buffer latency '
+          f'p50={e2e["latency_ms_p50"]:.1f}ms p99={e2e["latency_ms_p99"]:.1f}ms')
@@ -0,0 +1,136 @@
+import math
+from bisect import bisect_left
+from typing import Dict, Tuple, Union
+
+import utils
+
+NZ = 15  # number of latitude zones between the equator and a pole
+CPR_MAX = 131072  # the cpr is 17 bits so this is max
+PAIR_MAX_AGE = 10  # seconds between even and odd frames for a global decode
+LOCAL_MAX_AGE = 180  # seconds a decoded position stays good enough to locally decode against
+STATE_MAX_AGE = 300  # seconds before an aircraft's state is forgotten
+
+
+def _nl_table() -> list:
+    """
+    Latitudes where NL (number of longitude zones) changes. Index k holds the latitude where NL drops from 59 - k
+    to 58 - k, so the table is ascending
+    """
+    return [math.degrees(math.acos(math.sqrt((1 - math.cos(math.pi / (2 * NZ))) /
+                                             (1 - math.cos(2 * math.pi / nl)))))
+            for nl in range(59, 1, -1)]
+
+
+NL_TABLE = _nl_table()
+
+
+def nl(lat: float) -> int:
+    """ Number of longitude zones at a latitude. A binary search of ``NL_TABLE`` instead of trig """
+    return 59 - bisect_left(NL_TABLE, abs(lat))
+
+
+def decode_local(is_odd: bool, lat_cpr: float, lon_cpr: float, ref_lat: float, ref_lon: float) -> Tuple[float, float]:
+    """
+    Decodes a single frame relative to a reference position. The reference must be within ~180NM
+    :param lat_cpr: cpr latitude scaled to [0, 1)
+    :param lon_cpr: cpr longitude scaled to [0, 1)
+    """
+    # number of zones depends on message type
+    d_lat = 360 / 59 if is_odd else 360 / 60  # constants predefined
+    lat_ind = math.floor(ref_lat / d_lat) + math.floor((ref_lat % d_lat) / d_lat - lat_cpr + 0.5)
+    lat = d_lat * (lat_ind + lat_cpr)
+
+    zones = nl(lat) - (1 if is_odd else 0)
+    d_lon = 360 / zones if zones > 0 else 360
+    lon_ind = math.floor(ref_lon / d_lon) + math.floor((ref_lon % d_lon) / d_lon - lon_cpr + 0.5)
+    lon = d_lon * (lon_ind + lon_cpr)
+    return lat, lon
+
+
+def decode_global(even: Tuple[float, float], odd: Tuple[float, float], odd_latest: bool) \
+        -> Union[Tuple[float, float], None]:
+    """
+    Decodes a position from an even and an odd frame with no reference needed
+    :param even: (lat_cpr, lon_cpr) of the even frame, scaled to [0, 1)
+    :param odd: (lat_cpr, lon_cpr) of the odd frame, scaled to [0, 1)
+    :param odd_latest: whether the odd frame is the most recent one (its position is returned)
+    :return: (lat, lon) or None if the frames are from different latitude zones
+    """
+    j = math.floor(59 * even[0] - 60 * odd[0] + 0.5)
+    lat_even = 360 / 60 * (j % 60 + even[0])
+    lat_odd = 360 / 59 * (j % 59 + odd[0])
+    lat_even = lat_even - 360 if lat_even >= 270 else lat_even
+    lat_odd = lat_odd - 360 if lat_odd >= 270 else lat_odd
+    if nl(lat_even) != nl(lat_odd):
+        return None
+
+    lat = lat_odd if odd_latest else lat_even
+    zones = nl(lat)
+    m = math.floor(even[1] * (zones - 1) - odd[1] * zones + 0.5)
+    n_i = max(zones - (1 if odd_latest else 0), 1)
+    lon = 360 / n_i * (m % n_i + (odd[1] if odd_latest else even[1]))
+    lon = lon - 360 if lon >= 180 else lon
+    return lat, lon
+
+
+class AircraftCPR:
+    """ CPR state of one aircraft: its last even and odd frames and last decoded position """
+    __slots__ = ('frames', 'pos', 'pos_time', 'last_seen')
+
+    def __init__(self):
+        self.frames = [None, None]  # [even, odd] as (lat_cpr, lon_cpr, time)
+        self.pos = None
+        self.pos_time = None
+        self.last_seen = None
+
+
+class PositionDecoder:
+    """
+    Stateful position decoder. Keeps the last even and odd frame of each aircraft so a pair can be globally
+    decoded, then decodes later frames locally against the aircraft's own last position.
+    Until an aircraft has a position, frames are decoded against utils.REF_LAT/REF_LON (if set)
+    """
+
+    def __init__(self):
+        self.aircraft: Dict[str, AircraftCPR] = {}
+        self._next_expire = None
+
+    def decode(self, icao: str, is_odd: bool, lat_cpr: int, lon_cpr: int, t: float) \
+            -> Union[Tuple[float, float], None]:
+        """
+        :param icao: aircraft the frame is from
+        :param is_odd: cpr format of the frame
+        :param lat_cpr: raw 17 bit cpr latitude
+        :param lon_cpr: raw 17 bit cpr longitude
+        :param t: time the frame was received
+        :return: (lat, lon) or None if there isn't enough to decode with yet
+        """
+        self._expire(t)
+        state = self.aircraft.get(icao)
+        if state is None:
+            state = self.aircraft[icao] = AircraftCPR()
+        lat_cpr, lon_cpr = lat_cpr / CPR_MAX, lon_cpr / CPR_MAX
+        state.frames[is_odd] = (lat_cpr, lon_cpr, t)
+        state.last_seen = t
+
+        pos = None
+        if state.pos is not None and t - state.pos_time <= LOCAL_MAX_AGE:
+            pos = decode_local(is_odd, lat_cpr, lon_cpr, *state.pos)
+        else:
+            other = state.frames[not is_odd]
+            if other is not None and abs(t - other[2]) <= PAIR_MAX_AGE:
+                even, odd = (other, state.frames[1]) if is_odd else (state.frames[0], other)
+                pos = decode_global(even[:2], odd[:2], is_odd)
+            if pos is None and utils.REF_LAT is not None and utils.REF_LON is not None:
+                return decode_local(is_odd, lat_cpr, lon_cpr, utils.REF_LAT, utils.REF_LON)
+
+        if pos is not None:
+            state.pos, state.pos_time = pos, t
+        return pos
+
+    def _expire(self, t: float) -> None:
+        """ Forgets aircraft that haven't sent a position in a while. Runs at most once a minute """
+        if self._next_expire is not None and t < self._next_expire:
+            return
+        self._next_expire = t + 60
+        self.aircraft = {k: s for k, s in self.aircraft.items() if t - s.last_seen <= STATE_MAX_AGE}
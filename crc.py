@@ -0,0 +1,125 @@
+import numpy as np
+
+GENERATOR = 0xFFF409  # ADS-B CRC-24 polynomial (leading bit dropped)
+CRC_BYTES = 3
+
+
+def _build_table() -> list:
+    """ Builds the CRC of every possible leading byte so the CRC can be run a byte at a time """
+    table = []
+    for i in range(256):
+        c = i << 16
+        for _ in range(8):
+            c = (c << 1) ^ GENERATOR if c & 0x800000 else c << 1
+        table.append(c & 0xFFFFFF)
+    return table
+
+
+CRC_TABLE = _build_table()
+_CRC_TABLE_NP = np.array(CRC_TABLE, dtype=np.uint32)
+
+
+def crc24(data: bytes) -> int:
+    """ Computes CRC-24 of the given bytes """
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFF) ^ CRC_TABLE[(crc >> 16) ^ b]
+    return crc
+
+
+def syndrome(frame: bytes) -> int:
+    """ Returns the CRC remainder of a whole frame (data + parity). 0 means the frame is valid """
+    return crc24(frame[:-CRC_BYTES]) ^ int.from_bytes(frame[-CRC_BYTES:], 'big')
+
+
+def syndromes(frames: np.ndarray) -> np.ndarray:
+    """
+    Vectorized ``syndrome()``
+    :param frames: (N, 14) uint8 array of frames
+    :return: (N,) uint32 array of remainders
+    """
+    frames = np.asarray(frames, dtype=np.uint8)
+    crc = np.zeros(len(frames), dtype=np.uint32)
+    for col in frames[:, :-CRC_BYTES].T:
+        crc = ((crc << 8) & 0xFFFFFF) ^ _CRC_TABLE_NP[(crc >> 16) ^ col]
+    parity = frames[:, -CRC_BYTES:].astype(np.uint32)
+    return crc ^ ((parity[:, 0] << 16) | (parity[:, 1] << 8) | parity[:, 2])
+
+
+def _error_tables(n_bits: int = 112) -> tuple:
+    """
+    Builds syndrome -> flipped bit positions lookups for 1 and 2 bit errors. Bit 0 is the first (DF) bit.
+    Errors in the DF field aren't included since a repair there would change what kind of message it is.
+    Syndromes that more than one error pattern could explain are left out
+    """
+    n_bytes = n_bits // 8
+    single = {}
+    for p in range(5, n_bits):
+        single[syndrome((1 << (n_bits - 1 - p)).to_bytes(n_bytes, 'big'))] = (p,)
+    double = {}
+    ambiguous = set(single)
+    items = sorted(single.items(), key=lambda kv: kv[1])
+    for i, (syn_a, (a,)) in enumerate(items):
+        for syn_b, (b,) in items[i + 1:]:
+            syn = syn_a ^ syn_b
+            if syn in double:
+                ambiguous.add(syn)
+            double[syn] = (a, b)
+    for syn in ambiguous:
+        double.pop(syn, None)
+    return single, double
+
+
+SINGLE_ERRORS, DOUBLE_ERRORS = _error_tables()
+
+
+class ErrorCorrector:
+    """
+    Repairs extended squitters (DF17/18) that fail CRC by looking up the bits that explain their syndrome.
+    A repair is only accepted if the ICAO can be trusted, meaning it was seen recently in a frame that passed CRC
+    on its own. Otherwise a noise burst that happens to match a syndrome would add a made up aircraft
+    """
+    ICAO_TTL = 60  # seconds an ICAO stays trusted after a clean frame
+
+    def __init__(self, max_bits: int = 1):
+        """
+        :param max_bits: largest number of bit errors to repair (1 or 2)
+        """
+        self.max_bits = max_bits
+        self.known_icaos = {}
+        self.stats = {'fixed_1': 0, 'fixed_2': 0, 'rejected': 0}
+
+    def seen(self, icao: int, now: float) -> None:
+        """ Marks an ICAO as trusted (call for each frame that passes CRC) """
+        self.known_icaos[icao] = now
+
+    def expire(self, now: float) -> None:
+        """ Forgets ICAOs that haven't been seen within ``ICAO_TTL`` """
+        self.known_icaos = {k: t for k, t in self.known_icaos.items() if now - t <= self.ICAO_TTL}
+
+    def correct(self, frame: bytes, syn: int):
+        """
+        Attempts to repair a frame
+        :param frame: the 14 bytes of the frame
+        :param syn: the frame's syndrome (from ``syndrome()``)
+        :return: (repaired frame, number of bits fixed) or (None, 0) if the frame can't be trusted
+        """
+        if frame[0] >> 3 not in (17, 18):
+            return None, 0
+        bits = SINGLE_ERRORS.get(syn)
+        if bits is None and self.max_bits >= 2:
+            bits = DOUBLE_ERRORS.get(syn)
+        if bits is None:
+            self.stats['rejected'] += 1
+            return None, 0
+
+        n_bits = len(frame) * 8
+        val = int.from_bytes(frame, 'big')
+        for p in bits:
+            val ^= 1 << (n_bits - 1 - p)
+        fixed = val.to_bytes(len(frame), 'big')
+        if int.from_bytes(fixed[1:4], 'big') not in self.known_icaos:
+            self.stats['rejected'] += 1
+            return None, 0
+        self.stats[f'fixed_{len(bits)}'] += 1
+        return fixed, len(bits)
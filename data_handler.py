@@ -1,17 +1,42 @@
 import utils
-from utils import *
 from typing import Any, Union, Dict
+from collections import OrderedDict
+from time import time
+import cpr
 import numpy as np
 
+DATA_LEN = 51  # bits of payload after the type code
+# identity messages: 6 bit character codes of the callsign, and the vehicle class of each tc and emitter category
+CHAR_TABLE = "#ABCDEFGHIJKLMNOPQRSTUVWXYZ#####_###############0123456789######"
+CLASS_TABLE = [[],  # tc = 1 is reserved
+               ["N/A", "Surface Emergency Vehicle", "Surface Service Vehicle", "Fixed Ground Obstruction"],
+               ["N/A", "Glider/Sailplane", "Lighter-Than-Air", "Parachutist/Skydiver",
+                "Ultralight/Hang-glider/Paraglider", "", "UAV", "Space Vehicle"],
+               ["N/A", "Light", "Medium 1", "Medium 2", "High Vortex Aircraft", "Heavy", "High Performance",
+                "Rotorcraft"]]
+
+
+def get_bits(data: int, start: int, end: int) -> int:
+    """ Gets bits [start, end) of a payload, counting from the most significant bit like slicing a binary string """
+    return (data >> (DATA_LEN - end)) & ((1 << (end - start)) - 1)
+
 
 class DataPoint:
     """ Simple data class for holding information for a given value. Defines standard display method """
+    __slots__ = ('label', 'value', 'unit', '_value_str')
 
     def __init__(self, label: str, value: Any, unit: Union[str, None] = None):
         self.label = label
         self.value = value
         self.unit = unit
-        self.value_str = str(round(value, 4) if isinstance(value, float) else value)
+        self._value_str = None
+
+    @property
+    def value_str(self) -> str:
+        """ Display string for the value. Only formatted when first needed """
+        if self._value_str is None:
+            self._value_str = str(round(self.value, 4) if isinstance(self.value, float) else self.value)
+        return self._value_str
 
     def __str__(self):
         return f'{self.label}: {self.value_str}{f" ({self.unit})" if self.unit is not None else ""}'
@@ -20,92 +45,146 @@ class DataPoint:
         return self.__str__()
 
 
+class DecodeCache:
+    """
+    Bounded LRU cache of decoded payloads keyed on the whole frame. Aircraft repeat identical identity and velocity
+    squitters constantly, so a repeat is a dict lookup instead of a decode. Only frames that passed CRC are stored
+    """
+
+    def __init__(self, maxsize: int = 4096, include_position: bool = False):
+        """
+        :param maxsize: max number of frames kept (0 disables the cache)
+        :param include_position: whether position messages are cached. They're off by default since their result
+        depends on state other than the frame (other frames from the aircraft and the reference location)
+        """
+        self.maxsize = maxsize
+        self.include_position = include_position
+        self.entries: 'OrderedDict[int, Dict[str, DataPoint]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, frame: int) -> bool:
+        return frame in self.entries
+
+    def get(self, frame: int) -> Union[Dict[str, DataPoint], None]:
+        """ Returns a copy of the decoded payload for the frame, or None """
+        vals = self.entries.get(frame)
+        if vals is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(frame)
+        return dict(vals)  # aircraft update the dicts they are given
+
+    def put(self, frame: int, vals: Dict[str, DataPoint]) -> None:
+        if self.maxsize <= 0:
+            return
+        self.entries[frame] = dict(vals)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __str__(self):
+        return f'DecodeCache({len(self.entries)}/{self.maxsize}, hit rate={self.hit_rate:.2%}, ' \
+               f'evictions={self.evictions})'
+
+
 class DataHandler:
     """ Static class for handling interpretation of message payloads """
+    cache = DecodeCache()
+    positions = cpr.PositionDecoder()
 
     @classmethod
     def dispatch(cls, msg) -> Dict[str, DataPoint]:
-        """ calls appropriate method base on MessageType """
+        """ calls appropriate method base on MessageType. Repeated frames are served from ``cache`` """
         from message import MessageType
+        cacheable = msg.type != MessageType.AIRBORNE_POSITION or cls.cache.include_position
+        if cacheable:
+            vals = cls.cache.get(msg.frame)
+            if vals is not None:
+                return vals
         switch = {
-            MessageType.AIRCRAFT_ID: cls.handle_identity,
-            MessageType.AIRBORNE_VELOCITY: cls.handle_velocity,
-            MessageType.AIRBORNE_POSITION: cls.handle_position
+            MessageType.AIRCRAFT_ID: lambda m: cls.handle_identity(m.typecode, m.payload),
+            MessageType.AIRBORNE_VELOCITY: lambda m: cls.handle_velocity(m.typecode, m.payload),
+            MessageType.AIRBORNE_POSITION: lambda m: cls.handle_position(m.typecode, m.payload, m.icao, m.timestamp)
         }
-        return switch.get(msg.type, lambda tc, data: {})(msg.typecode, msg.bin_data)
+        vals = switch.get(msg.type, lambda m: {})(msg)
+        if cacheable:
+            cls.cache.put(msg.frame, vals)
+        return vals
 
     @staticmethod
-    def handle_identity(tc, data) -> Dict[str, DataPoint]:
-        """ Handles aircraft identity messages """
+    def handle_identity(tc: int, data: int) -> Dict[str, DataPoint]:
+        """ Handles aircraft identity messages. data is the payload as an int """
         vals = {}
-        # table to translate int to character
-        char_table = "#ABCDEFGHIJKLMNOPQRSTUVWXYZ#####_###############0123456789######"
-        # table to translate tc,ec into vehicle class
-        class_table = [[],  # tc = 1 is reserved
-                       ["N/A", "Surface Emergency Vehicle", "Surface Service Vehicle", "Fixed Ground Obstruction"],
-                       ["N/A", "Glider/Sailplane", "Lighter-Than-Air", "Parachutist/Skydiver",
-                        "Ultralight/Hang-glider/Paraglider", "", "UAV", "Space Vehicle"],
-                       ["N/A", "Light", "Medium 1", "Medium 2", "High Vortex Aircraft", "Heavy", "High Performance",
-                        "Rotorcraft"]]
-        ec = bin2int(data[:3])
-        vals['type'] = DataPoint('Type', class_table[tc - 1][ec])
+        ec = get_bits(data, 0, 3)
+        vals['type'] = DataPoint('Type', CLASS_TABLE[tc - 1][ec])
         craft_id = ''
-        for i in range(3, len(data), 6):
-            craft_id += char_table[bin2int(data[i: i + 6])]
+        for i in range(3, DATA_LEN, 6):
+            craft_id += CHAR_TABLE[get_bits(data, i, i + 6)]
         vals['id'] = DataPoint('ID', craft_id.rstrip('_'))
 
         return vals
 
     @staticmethod
-    def handle_velocity(tc, data) -> Dict[str, DataPoint]:
-        """ Handles velocity messages """
+    def handle_velocity(tc: int, data: int) -> Dict[str, DataPoint]:
+        """ Handles velocity messages. data is the payload as an int """
         vals = {}
-        subtype = bin2int(data[:3])
+        subtype = get_bits(data, 0, 3)
         # ret['supersonic'] = subtype == 2 or subtype == 4
         vals['horz_type'] = DataPoint('Horz. Type', 'GROUND' if subtype <= 2 else 'AIR')
-        ic = data[3] == 1  # ???
+        ic = get_bits(data, 3, 4) == 1  # ???
 
         if subtype <= 2:  # GROUND SPEED
             # sign and value from data
-            v_we = (-1 if bin2bool(data[8]) else 1) * (bin2int(data[9:19]) - 1)
-            v_sn = (-1 if bin2bool(data[19]) else 1) * (bin2int(data[20:30]) - 1)
+            v_we = (-1 if get_bits(data, 8, 9) else 1) * (get_bits(data, 9, 19) - 1)
+            v_sn = (-1 if get_bits(data, 19, 20) else 1) * (get_bits(data, 20, 30) - 1)
 
             v = np.sqrt(np.square(v_we) + np.square(v_sn))
             h_deg = (np.rad2deg(np.arctan2(v_we, v_sn)) + 360) % 360
             vals['horz_vel'] = DataPoint('Horz. Velocity', v, 'kts')
             vals['heading'] = DataPoint('Heading', h_deg, 'deg')
 
-        vals['vert_type'] = DataPoint('Vert. Type', 'BARO' if bin2bool(data[28]) else 'GEO')
+        vals['vert_type'] = DataPoint('Vert. Type', 'BARO' if get_bits(data, 28, 29) else 'GEO')
         # sign 0=up, 1=down
-        v_ud = (-1 if bin2bool(data[31]) else 1) * (bin2int(data[32:41]) - 1) * 64
+        v_ud = (-1 if get_bits(data, 31, 32) else 1) * (get_bits(data, 32, 41) - 1) * 64
         vals['vert_vel'] = DataPoint('Vert. Velocity', v_ud, 'ft/min')
 
         return vals
 
-    @staticmethod
-    def handle_position(tc, data) -> Dict[str, DataPoint]:
-        """ Handles positional messages. Accesses utils.REF_LAT and utils.REF_LON. These values must be set"""
+    @classmethod
+    def handle_position(cls, tc: int, data: int, icao: Union[str, None] = None, t: Union[float, None] = None) \
+            -> Dict[str, DataPoint]:
+        """
+        Handles positional messages. data is the payload as an int.
+        With an icao and time the position comes from ``positions`` (even/odd pairs and each aircraft's last
+        position). Without, it's decoded against utils.REF_LAT and utils.REF_LON, which must then be set
+        """
         vals = {}
 
-        is_odd = bin2bool(data[16])
-        lat_cpr = bin2int(data[17:34]) / 131072  # the cpr is 17 bits so this is max
-        lon_cpr = bin2int(data[34:51]) / 131072
-
-        # number of zones depends on message type
-        d_lat = 360 / 59 if is_odd else 360 / 60  # constants predefined
-        lat_ind = np.floor(utils.REF_LAT / d_lat) + np.floor((utils.REF_LAT % d_lat) / d_lat - lat_cpr + 0.5)
-        lat = d_lat * (lat_ind + lat_cpr)
-        vals['lat'] = DataPoint('Latitude', lat, 'deg')
-
-        nl = np.floor(2 * np.pi / (np.arccos(1 - ((1 - np.cos(np.pi / 30)) / np.square(np.cos(lat * np.pi / 180))))))
-
-        d_lon = (360 / (nl - (1 if is_odd else 0))) if nl - (1 if is_odd else 0) > 0 else 360
-        lon_ind = np.floor(utils.REF_LON / d_lon) + np.floor((utils.REF_LON % d_lon) / d_lon - lon_cpr + 0.5)
-        lon = d_lon * (lon_ind + lon_cpr)
-        vals['lon'] = DataPoint('Longitude', lon, 'deg')
-
-        alt_mult = 25 if bin2bool(data[10]) else 100
-        alt = bin2int(data[3:10] + data[11:15]) * alt_mult - 1000
+        is_odd = get_bits(data, 16, 17) == 1
+        lat_cpr = get_bits(data, 17, 34)
+        lon_cpr = get_bits(data, 34, 51)
+        if icao is None:
+            pos = cpr.decode_local(is_odd, lat_cpr / cpr.CPR_MAX, lon_cpr / cpr.CPR_MAX, utils.REF_LAT, utils.REF_LON)
+        else:
+            pos = cls.positions.decode(icao, is_odd, lat_cpr, lon_cpr, time() if t is None else t)
+        if pos is not None:
+            vals['lat'] = DataPoint('Latitude', pos[0], 'deg')
+            vals['lon'] = DataPoint('Longitude', pos[1], 'deg')
+
+        alt_mult = 25 if get_bits(data, 10, 11) else 100
+        alt = ((get_bits(data, 3, 10) << 4) | get_bits(data, 11, 15)) * alt_mult - 1000
         vals['alt'] = DataPoint('Altitude', alt, 'ft')
 
         return vals
@@ -0,0 +1,277 @@
+import numpy as np
+from multiprocessing import Process, Queue
+from multiprocessing.sharedctypes import RawArray
+from typing import Callable, Tuple
+from numpy.lib.stride_tricks import sliding_window_view
+
+from utils import MSG_LEN
+
+PREAMB_KEY = [1, 0, 1, 0, 0, 0, 0, 1, 0, 1, 0, 0, 0, 0, 0, 0]  # packets always start with this code
+PREAMB_LEN = len(PREAMB_KEY)
+FRAME_LEN = (MSG_LEN + 1) * 2  # samples sliced after a preamble. multiply by 2 since one bit == two values
+
+_PREAMB_MASK = np.array(PREAMB_KEY, dtype=bool)
+_FRAME_OFFS = np.arange(FRAME_LEN)
+_PREAMB_HIGHS = np.flatnonzero(_PREAMB_MASK)
+
+
+def match_preambles(windows: np.ndarray) -> np.ndarray:
+    """
+    Checks many preamble windows at once. Same rules as the original per-window check:
+    the 0/1 cut-off is halfway between the min and max value of each window
+    :param windows: (N, 16) array of samples
+    :return: (N,) bool array, True where the window matches ``PREAMB_KEY``
+    """
+    if np.issubdtype(windows.dtype, np.integer):  # same cut-off, kept in the integer domain
+        windows = windows.astype(np.int64)
+        normed = 2 * windows >= windows.min(axis=1, keepdims=True) + windows.max(axis=1, keepdims=True)
+        return (normed == _PREAMB_MASK).all(axis=1)
+    mn = windows.min(axis=1, keepdims=True)
+    mx = windows.max(axis=1, keepdims=True)
+    normed = windows >= mn + (mx - mn) / 2
+    return (normed == _PREAMB_MASK).all(axis=1)
+
+
+def find_preambles(mag: np.ndarray, min_amp: float) -> np.ndarray:
+    """
+    Finds the start index of every preamble in a buffer of magnitudes.
+    Candidates must be at least ``min_amp`` on their first sample. Once a preamble is accepted the samples of its
+    frame are skipped, exactly as a sample-by-sample scan would
+    :return: sorted array of preamble start indices
+    """
+    starts = find_candidates(mag, min_amp)
+    return select_frames(starts)
+
+
+def find_candidates(mag: np.ndarray, min_amp: float) -> np.ndarray:
+    """ Returns every index where a preamble matches, without skipping samples covered by earlier frames """
+    if len(mag) < PREAMB_LEN:
+        return np.empty(0, dtype=np.int64)
+    windows = sliding_window_view(mag, PREAMB_LEN)
+    gated = np.flatnonzero(mag[:len(windows)] >= min_amp)
+    return gated[match_preambles(windows[gated])]
+
+
+def find_complete(mag: np.ndarray, min_amp: float,
+                  finder: Callable[[np.ndarray, float], np.ndarray] = find_candidates) -> Tuple[np.ndarray, int]:
+    """
+    Like ``find_preambles()`` but only returns preambles whose whole frame is inside the buffer, so frames that
+    straddle the end of a chunk can be picked up once the next chunk arrives
+    :param finder: how candidates are found. ``ShardPool.find_candidates`` spreads the work over processes
+    :return: preamble start indices and the number of samples at the front of ``mag`` that are done with
+    """
+    last = len(mag) - PREAMB_LEN - FRAME_LEN  # last start whose frame is fully buffered
+    if last < 0:
+        return np.empty(0, dtype=np.int64), 0
+    starts = select_frames(finder(mag[:last + PREAMB_LEN], min_amp))
+    done = last + 1
+    if len(starts) > 0:
+        done = max(done, int(starts[-1]) + PREAMB_LEN + FRAME_LEN)
+    return starts, done
+
+
+def select_frames(starts: np.ndarray) -> np.ndarray:
+    """ Drops candidates that start inside the frame of an earlier accepted preamble """
+    keep = []
+    next_free = -1
+    for s in starts.tolist():
+        if s >= next_free:
+            keep.append(s)
+            next_free = s + PREAMB_LEN + FRAME_LEN
+    return np.array(keep, dtype=np.int64)
+
+
+def slice_bits(mag: np.ndarray, starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Slices the frames following the given preambles into bits, all at once.
+    Each bit is a (high, low) or (low, high) pair of samples. A frame ends early at the first pair where both samples
+    are below 20% of the frame's max, or where the buffer runs out
+    :param mag: buffer of magnitudes
+    :param starts: preamble start indices (from ``find_preambles()``)
+    :return: (N, MSG_LEN + 1) bool array of bits and (N,) array holding the number of valid bits in each row
+    """
+    n_frames = len(starts)
+    if n_frames == 0 or len(mag) == 0:
+        return np.zeros((n_frames, MSG_LEN + 1), dtype=bool), np.zeros(n_frames, dtype=np.int64)
+    first = np.asarray(starts, dtype=np.int64) + PREAMB_LEN
+    avail = np.clip(len(mag) - first, 0, FRAME_LEN)
+    idx = np.minimum(first[:, None] + _FRAME_OFFS, len(mag) - 1)
+    in_buf = _FRAME_OFFS < avail[:, None]
+    if np.issubdtype(mag.dtype, np.integer):
+        # x < max * .2 as 5x < max, so integer magnitudes never become floats
+        raw = np.where(in_buf, mag[idx].astype(np.int32), -1)
+        high, low = raw[:, 0::2], raw[:, 1::2]
+        peak = raw.max(axis=1, keepdims=True)
+        weak = (5 * high < peak) & (5 * low < peak)
+    else:
+        raw = np.where(in_buf, mag[idx], -np.inf)
+        thresh = raw.max(axis=1, keepdims=True) * .2  # want data at least this strong
+        high, low = raw[:, 0::2], raw[:, 1::2]
+        weak = (high < thresh) & (low < thresh)
+    stop = weak | (np.arange(MSG_LEN + 1) >= (avail // 2)[:, None])
+    lengths = np.where(stop.any(axis=1), stop.argmax(axis=1), MSG_LEN + 1)
+    return high >= low, lengths
+
+
+def signal_levels(mag: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """ Signal level of each frame: the mean of the 4 high pulses of its preamble """
+    if len(starts) == 0:
+        return np.empty(0, dtype=mag.dtype)
+    return mag[np.asarray(starts)[:, None] + _PREAMB_HIGHS].mean(axis=1)
+
+
+def bits2str(bits: np.ndarray, lengths: np.ndarray) -> list:
+    """ Converts rows from ``slice_bits()`` into binary strings """
+    chars = bits.astype(np.uint8) + ord('0')
+    return [row[:length].tobytes().decode('ascii') for row, length in zip(chars, lengths.tolist())]
+
+
+class MagnitudeLUT:
+    """
+    Magnitudes of int16 I/Q pairs by table lookup, like dump1090. I and Q are each cut down to ``bits`` signed bits
+    so a pair is one index into a table of uint16 magnitudes, which replaces the float math of ``np.absolute``.
+    The Pluto's ADC is 12 bit, but a table that wide (32MB) is slower than the float math. At 10 bits (a 2MB table)
+    weak frames are found nearly as often as with float magnitudes, where 8 bits (dump1090's width, which suits its
+    8 bit ADC) loses a third of the weakest
+    """
+
+    def __init__(self, full_scale: int = 2048, bits: int = 10):
+        """
+        :param full_scale: largest I or Q value expected. The Pluto's ADC is 12 bit, so 2048
+        :param bits: bits I and Q are each kept to. The table has ``4 ** bits`` entries
+        """
+        self.bits = bits
+        self.shift = max(int(np.ceil(np.log2(full_scale))) - (bits - 1), 0)
+        # I and Q are offset to be unsigned, and the index is (Q << bits) | I
+        levels = (np.arange(1 << bits) - (1 << (bits - 1)) + .5) * (1 << self.shift)
+        mags = np.hypot(levels[:, None], levels[None, :])  # [Q, I]
+        self.table = np.minimum(np.round(mags), 0xFFFF).astype(np.uint16).ravel()
+
+    def __call__(self, iq: np.ndarray, out: np.ndarray) -> None:
+        """
+        :param iq: (N, 2) int16 I/Q pairs
+        :param out: (N,) uint16 array the magnitudes are written to
+        """
+        quant = iq >> self.shift
+        quant += 1 << (self.bits - 1)
+        np.clip(quant, 0, (1 << self.bits) - 1, out=quant)
+        index = quant[:, 1].astype(np.int32)
+        index <<= self.bits
+        index |= quant[:, 0]
+        np.take(self.table, index, out=out)
+
+
+MAG_LUT = MagnitudeLUT()
+
+
+class SampleBuffer:
+    """
+    Fixed-capacity buffer of sample magnitudes. Chunks of IQ samples are converted straight into the buffer and
+    samples that haven't been processed yet are kept at the front, so nothing is reallocated between chunks
+    """
+
+    def __init__(self, capacity: int, dtype=np.float32, shared: bool = False, lut: MagnitudeLUT = MAG_LUT):
+        """
+        :param dtype: type magnitudes are kept as. With uint16, int16 I/Q pairs are converted with ``lut``
+        :param shared: whether the samples are kept in shared memory, so other processes (see ``ShardPool``) can
+        read them without a copy
+        """
+        self.lut = lut
+        dtype = np.dtype(dtype)
+        self.shared = RawArray('b', capacity * dtype.itemsize) if shared else None
+        self.data = np.frombuffer(self.shared, dtype=dtype) if shared else np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, iq: np.ndarray) -> None:
+        """
+        Appends the magnitude of a chunk of samples. If it doesn't fit the oldest samples are lost
+        :param iq: complex samples, magnitudes, or (N, 2) I/Q pairs (e.g. int16 from the radio or a capture)
+        """
+        if len(iq) > len(self.data):
+            iq = iq[-len(self.data):]
+        if self.size + len(iq) > len(self.data):
+            self.consume(self.size + len(iq) - len(self.data))
+        out = self.data[self.size:self.size + len(iq)]
+        if iq.ndim == 2 and out.dtype == np.uint16:
+            self.lut(iq, out)
+        elif iq.ndim == 2:
+            np.hypot(iq[:, 0], iq[:, 1], out=out)
+        elif out.dtype.kind == 'f':
+            np.absolute(iq, out=out)
+        else:
+            out[:] = np.minimum(np.round(np.absolute(iq)), np.iinfo(out.dtype).max)
+        self.size += len(iq)
+
+    def view(self) -> np.ndarray:
+        """ Returns a view (not a copy) of the buffered samples """
+        return self.data[:self.size]
+
+    def consume(self, n: int) -> None:
+        """ Drops the first n samples, moving any carry-over to the front """
+        n = min(n, self.size)
+        keep = self.size - n
+        if keep > 0:
+            self.data[:keep] = self.data[n:self.size]
+        self.size = keep
+
+
+def _shard_worker(shared, dtype, tasks: Queue, results: Queue) -> None:
+    """ Worker loop for ``ShardPool``. Tasks are (shard, first start, end start, min_amp), None to stop """
+    samples = np.frombuffer(shared, dtype=dtype)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        shard, lo, hi, min_amp = task
+        results.put((shard, lo + find_candidates(samples[lo:hi + PREAMB_LEN - 1], min_amp)))
+
+
+class ShardPool:
+    """
+    Finds preamble candidates in a shared ``SampleBuffer`` with several worker processes.
+    The buffer is split into shards of start positions and each worker reads its shard straight from shared memory,
+    plus the PREAMB_LEN - 1 samples after it so preambles crossing into the next shard are still matched. Since each
+    candidate only depends on its own 16 samples, shards don't find duplicates and joining them in order gives the
+    same candidates as one process would. Frames crossing shards are then picked by ``select_frames()`` as usual
+    """
+    MIN_SHARD = 16384  # smaller shards cost more to hand out than to scan
+
+    def __init__(self, buf: SampleBuffer, workers: int):
+        """
+        :param buf: buffer to search. Must have been made with shared=True
+        :param workers: number of worker processes
+        """
+        if buf.shared is None:
+            raise ValueError('ShardPool needs a SampleBuffer made with shared=True')
+        self.buf = buf
+        self.workers = workers
+        self.tasks = Queue()
+        self.results = Queue()
+        self.procs = [Process(target=_shard_worker, args=(buf.shared, buf.data.dtype, self.tasks, self.results),
+                              daemon=True) for _ in range(workers)]
+        for p in self.procs:
+            p.start()
+
+    def find_candidates(self, mag: np.ndarray, min_amp: float) -> np.ndarray:
+        """ Same as ``find_candidates()``. mag must be the front of the pool's buffer (e.g. a slice of its view) """
+        n_starts = len(mag) - PREAMB_LEN + 1
+        n_shards = min(self.workers, n_starts // self.MIN_SHARD)
+        if n_shards <= 1:
+            return find_candidates(mag, min_amp)
+        bounds = np.linspace(0, n_starts, n_shards + 1).astype(np.int64).tolist()
+        for shard in range(n_shards):
+            self.tasks.put((shard, bounds[shard], bounds[shard + 1], min_amp))
+        found = [None] * n_shards
+        for _ in range(n_shards):
+            shard, cands = self.results.get()
+            found[shard] = cands
+        return np.concatenate(found)
+
+    def close(self) -> None:
+        for _ in self.procs:
+            self.tasks.put(None)
+        for p in self.procs:
+            p.join(timeout=1)
@@ -0,0 +1,235 @@
+import asyncio
+from datetime import datetime
+from typing import Callable, Dict, List, Union
+
+import numpy as np
+
+import metrics
+from message import MessageType
+from pipeline import DecodedBatch, Sink
+from radio import FrameBatch
+
+FORMATS = ('raw', 'beast', 'sbs')
+DEFAULT_PORTS = {'raw': 30002, 'beast': 30005, 'sbs': 30003}  # what dump1090 uses, so existing tools just connect
+SLOW_POLICIES = ('disconnect', 'drop')
+
+_HEX = np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)
+BEAST_ESC = 0x1A
+BEAST_LONG = ord('3')  # type of a 112 bit Mode S frame
+BEAST_CLOCK = 12e6  # Beast timestamps count a 12 MHz clock
+SIGNAL_FULL_SCALE = 2048  # signal level that maps to 255 (see demod.MagnitudeLUT)
+
+CLIENTS = metrics.REGISTRY.gauge('a522_feed_clients', 'Clients connected to the TCP feeds')
+SENT = metrics.REGISTRY.counter('a522_feed_bytes_total', 'Bytes sent to feed clients', 'feed', FORMATS)
+SLOW = metrics.REGISTRY.counter('a522_feed_slow_total', 'Times a feed client fell too far behind', 'feed', FORMATS)
+
+
+# formats. Each turns a whole batch into bytes once, however many clients get it
+def raw_frames(batch: FrameBatch) -> bytes:
+    """ AVR format: one ``*<28 hex digits>;`` line per frame """
+    out = np.empty((batch.size, 31), dtype=np.uint8)
+    out[:, 0] = ord('*')
+    out[:, 1:29:2] = _HEX[batch.frames >> 4]
+    out[:, 2:29:2] = _HEX[batch.frames & 0xF]
+    out[:, 29] = ord(';')
+    out[:, 30] = ord('\n')
+    return out.tobytes()
+
+
+def beast_frames(batch: FrameBatch) -> bytes:
+    """
+    Beast binary format: ``0x1a '3'``, a 6 byte 12 MHz timestamp, a signal byte then the 14 byte frame.
+    Any 0x1a after the first two bytes is doubled so readers can find the start of each frame
+    """
+    ticks = (np.round(batch.times * BEAST_CLOCK).astype(np.uint64) & np.uint64((1 << 48) - 1))
+    out = np.empty((batch.size, 23), dtype=np.uint8)
+    out[:, 0] = BEAST_ESC
+    out[:, 1] = BEAST_LONG
+    out[:, 2:8] = (ticks[:, None] >> np.arange(40, -1, -8, dtype=np.uint64)) & np.uint64(0xFF)
+    out[:, 8] = np.minimum(batch.signal.astype(np.uint32) * 255 // SIGNAL_FULL_SCALE, 255)
+    out[:, 9:] = batch.frames
+    repeats = np.ones(out.shape, dtype=np.intp)
+    repeats[:, 2:] += out[:, 2:] == BEAST_ESC
+    return np.repeat(out.ravel(), repeats.ravel()).tobytes()
+
+
+def _sbs_time(ts: float) -> str:
+    t = datetime.fromtimestamp(ts)
+    return f'{t:%Y/%m/%d},{t:%H:%M:%S}.{t.microsecond // 1000:03d}'
+
+
+def _sbs_val(data: Dict, key: str, digits: int = 0) -> str:
+    if key not in data:
+        return ''
+    val = data[key].value
+    return f'{val:.{digits}f}' if digits else str(int(round(val)))
+
+
+def sbs_messages(decoded: DecodedBatch) -> bytes:
+    """
+    SBS BaseStation (port 30003) CSV: a `MSG` line per identity (type 1), airborne position (type 3) or airborne
+    velocity (type 4) message. Other messages have nothing SBS can carry and are skipped
+    """
+    lines = []
+    for m in decoded.messages:
+        if not m.valid:
+            continue
+        if m.type == MessageType.AIRCRAFT_ID:
+            kind, fields = 1, [m.data['id'].value, '', '', '', '', '', '']
+        elif m.type == MessageType.AIRBORNE_POSITION:
+            fields = [
+                '', _sbs_val(m.data, 'alt'), '', '', _sbs_val(m.data, 'lat', 5), _sbs_val(m.data, 'lon', 5), '']
+            kind = 3
+        elif m.type == MessageType.AIRBORNE_VELOCITY:
+            fields = ['', '', _sbs_val(m.data, 'horz_vel'), _sbs_val(m.data, 'heading'), '', '',
+                      _sbs_val(m.data, 'vert_vel')]
+            kind = 4
+        else:
+            continue
+        stamp = _sbs_time(m.timestamp)
+        lines.append(f'MSG,{kind},1,1,{m.icao},1,{stamp},{stamp},' + ','.join(fields) + ',,,,,\r\n')
+    return ''.join(lines).encode()
+
+
+_FORMATTERS: Dict[str, Callable] = {'raw': raw_frames, 'beast': beast_frames, 'sbs': sbs_messages}
+
+
+class _Client:
+    """ One connection. Data waits in ``pending`` until the client's send task gets to it """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.task = asyncio.current_task()
+        self.pending = bytearray()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.finishing = False  # send what's buffered then close
+
+    def close(self, abort: bool = False) -> None:
+        """ Closes the connection. Aborting drops whatever the socket hasn't sent yet, which also ends a stuck send """
+        if not self.closed:
+            self.closed = True
+            self.ready.set()  # wakes the send task so it ends
+            if abort:
+                self.writer.transport.abort()
+            else:
+                self.writer.close()
+
+
+class FeedServer:
+    """
+    TCP server that sends the same stream to every connected client. ``publish()`` never waits: data is added to
+    each client's buffer and a task per client sends everything buffered in one write, waiting for the socket
+    only in that task. A client whose buffer grows past ``max_buffer`` is too slow to keep up, so it's
+    disconnected (or, with the `drop` policy, loses what's buffered and carries on)
+    """
+
+    def __init__(self, fmt: str, port: Union[int, None] = None, host: str = '', max_buffer: int = 1 << 20,
+                 slow_policy: str = 'disconnect'):
+        """
+        :param fmt: one of FORMATS. Only used for metrics and the default port
+        :param port: port to listen on. Default is dump1090's port for the format. 0 picks a free port
+        :param max_buffer: bytes a client can fall behind by
+        :param slow_policy: one of SLOW_POLICIES
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f'fmt must be one of {FORMATS}')
+        if slow_policy not in SLOW_POLICIES:
+            raise ValueError(f'slow_policy must be one of {SLOW_POLICIES}')
+        self.fmt = fmt
+        self.port = DEFAULT_PORTS[fmt] if port is None else port
+        self.host = host
+        self.max_buffer = max_buffer
+        self.slow_policy = slow_policy
+        self.clients: List[_Client] = []
+        self._server: Union[asyncio.AbstractServer, None] = None
+        self._feed = FORMATS.index(fmt)
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._connected, self.host or '0.0.0.0', self.port)
+        if self.port == 0:
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _connected(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client = _Client(writer)
+        self.clients.append(client)
+        CLIENTS.set(CLIENTS.value() + 1)
+        try:
+            while True:
+                await client.ready.wait()
+                client.ready.clear()
+                if client.closed:
+                    break
+                if client.pending:
+                    data, client.pending = bytes(client.pending), bytearray()
+                    writer.write(data)
+                    await writer.drain()
+                    SENT.inc_at(self._feed, len(data))
+                if client.finishing:
+                    break
+        except (ConnectionError, OSError):
+            pass  # client went away
+        finally:
+            self.clients.remove(client)
+            CLIENTS.set(CLIENTS.value() - 1)
+            client.close()
+
+    def publish(self, data: bytes) -> None:
+        """ Queues data for every client """
+        if not data:
+            return
+        for client in self.clients:
+            if client.closed:
+                continue
+            if len(client.pending) + len(data) > self.max_buffer:
+                SLOW.inc_at(self._feed)
+                if self.slow_policy == 'disconnect':
+                    client.close(abort=True)
+                    continue
+                client.pending.clear()
+            client.pending += data
+            client.ready.set()
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for client in list(self.clients):
+            client.close(abort=True)
+
+    async def stop(self, timeout: float = 1.0) -> None:
+        """ Closes the server, giving clients up to ``timeout`` seconds to be sent what's left in their buffers """
+        if self._server is not None:
+            self._server.close()
+        tasks = [c.task for c in self.clients]
+        for client in self.clients:
+            client.finishing = True
+            client.ready.set()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        self.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class FeedSink(Sink):
+    """ Publishes each batch to a ``FeedServer``, which is started when the pipeline starts """
+
+    def __init__(self, server: FeedServer, **kwargs):
+        super().__init__(**kwargs)
+        self.server = server
+        self.needs = 'payloads' if server.fmt == 'sbs' else 'frames'
+        self._format = _FORMATTERS[server.fmt]
+
+    async def run(self) -> None:
+        await self.server.start()
+        try:
+            await super().run()
+        finally:
+            await self.server.stop()
+
+    async def consume(self, item: Union[FrameBatch, DecodedBatch]) -> None:
+        if self.needs == 'frames' and isinstance(item, DecodedBatch):
+            item = item.batch
+        self.server.publish(self._format(item))
+
+    def close(self) -> None:
+        self.server.close()
@@ -2,16 +2,27 @@ import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import plotly.graph_objects as go
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 
 import utils
 import logging
-from typing import Union, List
+from typing import Union, List, Dict, Set, Deque, Tuple
+from collections import deque
+from itertools import islice
 import time
+import numpy as np
 
 from radio import BaseRadio
-from message import Message
-from aircraft import Aircraft
+from message import Message, format_valid
+from data_handler import DataPoint
+from aircraft import Aircraft, AircraftRegistry
+from tracks import TrackStore, downsample
+import metrics
+
+MSG_LOG_SIZE = 1000  # messages kept in the raw message log
+TRAIL_SECONDS = 600  # how far back the trail behind each aircraft goes
+TRAIL_SPACING = 250  # meters between points of a drawn trail
+TRAIL_REBUILD = 60  # seconds between full map rebuilds, which drop trail points older than TRAIL_SECONDS
 
 # suppress logging of POST requests
 log = logging.getLogger('werkzeug')
@@ -19,47 +30,152 @@ log.setLevel(logging.ERROR)
 
 
 class GUIData:
-    """ Class for holding global data for display on GUI. This helps with loading data after refresh """
-    aircraft: List[Aircraft] = []
-    msg_log: List[str] = []
+    """
+    Class for holding global data for display on GUI. This helps with loading data after refresh.
+    Only aircraft that changed since the last tick have their list row and map point rebuilt, and ``version`` lets
+    each client skip the update entirely when nothing changed since it last rendered.
+    Trails are only sent whole when the map is rebuilt (see ``rebuild_map()``). In between, new trail segments are
+    logged with the version that added them, and clients are sent the ones they don't have as an ``extendData``
+    """
+    aircraft = AircraftRegistry(tracks=TrackStore())
+    # (seq, frame, bits corrected, decoded values) of each message, formatted when sent. The values are copied out
+    # of the message since aircraft keep updating the dicts they're given
+    msg_log: Deque[Tuple[int, int, int, Tuple[DataPoint, ...]]] = deque(maxlen=MSG_LOG_SIZE)
+    msg_seq = 0  # sequence number of the newest message in msg_log
     radio: Union[None, BaseRadio] = None
+    version = 0  # bumped whenever the aircraft list or map changes
+    dirty: Set[str] = set()  # ICAOs changed since rows/map were last built
+    rows: Dict[str, html.Li] = {}  # cached list row of each aircraft
+    map_slots: Dict[str, int] = {}  # index of each aircraft in the map's aircraft trace
+    map_icao: List[str] = []
+    map_lat: List[float] = []
+    map_lon: List[float] = []
+    trail_base: Tuple[List[float], List[float]] = ([], [])  # every trail at the last rebuild (separated by gaps)
+    trail_log: List[Tuple[int, List[float], List[float]]] = []  # (version, lat, lon) of segments added since
+    trail_last: Dict[str, float] = {}  # time of the newest drawn trail point of each aircraft
+    trail_size = 0  # points in the trail trace, once a client has every segment
+    figure_version = 0  # version of the last rebuild. Clients that rendered before it are sent the whole figure
+    figure_time = 0.0
+    rebuild = True  # set when aircraft are removed, since trails can't be cut with an extendData
+    base_fig: Dict = {}  # the map without aircraft. Set in run_gui()
 
     @classmethod
     def add_message(cls, msg: Message) -> None:
         """ add message to data. Updates msg_log and relevant aircraft """
-        cls.msg_log.insert(0, str(msg))
+        cls.msg_seq += 1
+        cls.msg_log.append((cls.msg_seq, msg.frame, msg.corrected, tuple(msg.data.values())))
         cls._update_aircraft(msg)
 
-        if len(cls.msg_log) > 1000:
-            cls.msg_log = cls.msg_log[100:]
-
     @classmethod
     def _update_aircraft(cls, msg: Message) -> None:
-        for craft in cls.aircraft:
-            if craft == msg.icao:
-                craft.update(msg.data)
-                break
-        else:
-            cls.aircraft.insert(0, Aircraft(msg.icao, msg.data))
-
-        if len(cls.aircraft) > 100:
-            cls.aircraft = cls.aircraft[25:]
+        cls.aircraft.update(msg.icao, msg.data)
+        cls.dirty.add(msg.icao)
 
     @classmethod
     def remove_old(cls) -> List[str]:
-        """ Removes any aircraft that haven't recently changed. Returns list of removed ICAOs"""
-        to_remove = []
-        for craft in cls.aircraft:
-            if round(time.time()) - craft.last_update > 180:
-                to_remove.append(craft)
-        for craft in to_remove:
-            cls.aircraft.remove(craft)
+        """ Removes any aircraft that haven't recently changed (or were evicted). Returns list of removed ICAOs"""
+        removed = [c.icao for c in cls.aircraft.expire(180)]
+        if len(cls.rows) - len(removed) > len(cls.aircraft):
+            removed.extend(icao for icao in cls.rows if icao not in cls.aircraft and icao not in removed)
+        for icao in removed:
+            cls.rows.pop(icao, None)
+            cls.dirty.discard(icao)
+            cls.trail_last.pop(icao, None)
+            remove_aircraft_map(icao)
+        cls.rebuild |= len(removed) > 0
+        return removed
+
+    @classmethod
+    def apply_changes(cls) -> bool:
+        """ Rebuilds the rows and map points of changed aircraft. Returns whether anything changed """
+        if len(cls.dirty) == 0 and not cls.rebuild:
+            return False
+        now = time.time()
+        cls.version += 1
+        rebuild = cls.rebuild or now - cls.figure_time > TRAIL_REBUILD
+        for icao in cls.dirty:
+            craft = cls.aircraft.get(icao)
+            if craft is None:
+                continue
+            cls.rows[icao] = build_aircraft_li(craft)
+            if craft['lat'].value_str != 'Unknown':
+                update_aircraft_map(craft['lat'].value, craft['lon'].value, icao)
+                if not rebuild:
+                    cls._extend_trail(icao, now)
+        cls.dirty.clear()
+        if rebuild:
+            cls.rebuild_map(now)
+        return True
+
+    @classmethod
+    def _extend_trail(cls, icao: str, now: float) -> None:
+        """ Logs the part of an aircraft's trail drawn since its last point (all of it if it has none yet) """
+        track = cls.aircraft.tracks.get(icao)
+        if track is None:
+            return
+        last = cls.trail_last.get(icao)
+        points = downsample(track.since(now - TRAIL_SECONDS if last is None else last), TRAIL_SPACING,
+                            keep_last=False)
+        if len(points) == 0:
+            return
+        cls.trail_last[icao] = points['t'][-1]
+        if len(points) > 1:
+            cls.trail_log.append((cls.version, np.round(points['lat'], 4).tolist() + [None],
+                                  np.round(points['lon'], 4).tolist() + [None]))
+            cls.trail_size += len(points) + 1
+
+    @classmethod
+    def rebuild_map(cls, now: float) -> None:
+        """ Redraws every trail from the tracks, which drops old points and removed aircraft """
+        trail_lat, trail_lon = [], []
+        cls.trail_last.clear()
+        for icao in cls.map_icao:
+            track = cls.aircraft.tracks.get(icao)
+            if track is None:
+                continue
+            points = downsample(track.since(now - TRAIL_SECONDS), TRAIL_SPACING)
+            if len(points) > 0:
+                cls.trail_last[icao] = points['t'][-1]
+            if len(points) > 1:
+                trail_lat += np.round(points['lat'], 4).tolist() + [None]
+                trail_lon += np.round(points['lon'], 4).tolist() + [None]
+        cls.trail_base = (trail_lat, trail_lon)
+        cls.trail_log.clear()
+        cls.trail_size = len(trail_lat)
+        cls.figure_version = cls.version
+        cls.figure_time = now
+        cls.rebuild = False
 
-        return [c.icao for c in to_remove]
+    @classmethod
+    def map_extension(cls, since: int) -> List:
+        """
+        Gets the ``extendData`` that brings a client's map from version ``since`` to the current one: the trail
+        segments it doesn't have, and the aircraft trace replaced (extended by every aircraft, then cut to that many)
+        """
+        trail_lat, trail_lon = [], []
+        for version, lat, lon in cls.trail_log:
+            if version > since:
+                trail_lat += lat
+                trail_lon += lon
+        update = {'lat': [trail_lat, cls.map_lat], 'lon': [trail_lon, cls.map_lon], 'text': [[], cls.map_icao],
+                  'marker.color': [[], [f'#{icao}' for icao in cls.map_icao]]}
+        # at least 1, since plotly doesn't cut a trace at 0. An empty trace extended by nothing stays empty anyway
+        sizes = [max(cls.trail_size, 1), max(len(cls.map_icao), 1)]
+        trail_trace = len(cls.base_fig['data'])
+        return [update, [trail_trace, trail_trace + 1], {key: sizes for key in update}]
 
     @classmethod
-    def get_msg_log(cls) -> str:
-        return '\n'.join(cls.msg_log)
+    def get_msg_log(cls, since: int) -> Dict:
+        """
+        Gets the log entries a client doesn't have yet
+        :param since: sequence number of the newest entry the client has (-1 if it has none)
+        :return: dict of new entries (newest first), the newest seq and whether the client should reset its log
+        (it's new or fell too far behind)
+        """
+        reset = since < 0 or since > cls.msg_seq or len(cls.msg_log) == 0 or since < cls.msg_log[0][0] - 1
+        count = len(cls.msg_log) if reset else cls.msg_seq - since
+        new = [format_valid(frame, fixed, data) for _, frame, fixed, data in islice(reversed(cls.msg_log), count)]
+        return dict(entries=new, seq=cls.msg_seq, reset=reset, max=MSG_LOG_SIZE)
 
 
 plot_map = go.Figure()
@@ -90,108 +206,146 @@ app.layout = html.Div(style={'display': 'flex', 'flexDirection': 'column', 'widt
                                            placeholder='Raw Messages appear here', readOnly=True)
 
                           ]),
-                          dcc.Interval(id='interval', interval=1000, n_intervals=0)
+                          dcc.Interval(id='interval', interval=1000, n_intervals=0),
+                          dcc.Store(id='rendered-version', data=-1),
+                          dcc.Store(id='log-seq', data=-1),
+                          dcc.Store(id='log-delta')
                       ])
 
 
-@app.callback([Output('message-log', 'value'), Output('map', 'figure'), Output('aircraft-list', 'children')],
+@app.callback([Output('log-delta', 'data'), Output('log-seq', 'data'), Output('map', 'figure'),
+               Output('map', 'extendData'), Output('aircraft-list', 'children'), Output('rendered-version', 'data')],
               [Input('interval', 'n_intervals')],
-              [State('message-log', 'value'), State('map', 'figure'), State('aircraft-list', 'children')])
-def get_messages(n, old_msgs, fig, craft_list):
+              [State('log-seq', 'data'), State('rendered-version', 'data')])
+def get_messages(n, log_seq, rendered):
     """
     Main callback function for dash
     :param n: unused, but needed since we trigger function via interval
-    :param old_msgs: string value inside raw message log. Used for no-op calls to keep log the same
-    :param fig: the map. Can update data dictionary directly
-    :param craft_list: the children of the aircraft list. Used to determine if refresh occured
-    :return: message log, map figure, aircraft list (list of <li> elements)
+    :param log_seq: seq of the newest log entry this client has. Only newer entries are sent
+    :param rendered: the GUIData.version this client last rendered. Used to skip sending unchanged data
+    :return: new log entries, newest log seq, map figure or the data to extend it by, aircraft list (list of <li>
+    elements), rendered version
     """
     msgs = GUIData.radio.get_all_queue()
     valid = [m for m in msgs if m is not None and m.valid]
+    if len(valid) > 0:
+        print(f"[{' '.join([m.icao for m in valid])}]")
 
     # refresh data to remove old aircraft and delete them from map
-    for r in GUIData.remove_old():
-        remove_aircraft_map(fig, r)
-
-    if len(valid) == 0 and not (len(craft_list) < len(GUIData.aircraft)):
-        # print('No msgs')
-        return old_msgs, fig, build_aircraft_ul()
-    print(f"[{' '.join([m.icao for m in valid])}]")
+    GUIData.remove_old()
 
     # add messages/aircraft to global data
     for m in reversed(valid):
         GUIData.add_message(m)
+    GUIData.apply_changes()
+
+    log_delta = GUIData.get_msg_log(log_seq) if log_seq != GUIData.msg_seq else dash.no_update
+    if rendered == GUIData.version:
+        return log_delta, GUIData.msg_seq, dash.no_update, dash.no_update, dash.no_update, rendered
+    if rendered < GUIData.figure_version or rendered > GUIData.version:  # new client, or the server restarted
+        return log_delta, GUIData.msg_seq, build_map_figure(), dash.no_update, build_aircraft_ul(), GUIData.version
+    return (log_delta, GUIData.msg_seq, dash.no_update, GUIData.map_extension(rendered), build_aircraft_ul(),
+            GUIData.version)
 
-    # set locations on map for all known aircraft
-    for craft in GUIData.aircraft:
-        if craft['lat'].value_str != 'Unknown':
-            update_aircraft_map(fig, craft['lat'].value, craft['lon'].value, craft.icao)
 
-    return GUIData.get_msg_log(), fig, build_aircraft_ul()
+# the log is kept in the browser and new entries are added to it there (see gui_assets/log.js)
+app.clientside_callback(ClientsideFunction(namespace='airport522', function_name='appendLog'),
+                        Output('message-log', 'value'), [Input('log-delta', 'data')])
 
 
 def build_aircraft_ul() -> List[html.Li]:
     """
-    Builds the aircraft list for the GUI
+    Builds the aircraft list for the GUI from the cached rows. Most recently updated aircraft first
     :return: a list of <li> elements
     """
-    children = []
-    for craft in GUIData.aircraft:
-        li = html.Li(id=f'li-{craft.icao}', style={'display': 'flex', 'padding': 8, 'border-bottom': '2px solid gray'},
-                     children=[
-                         html.Div(style={'flex': 3}, children=[
-                             html.P(style={'margin': 0}, children=[
-                                 html.H3(f'{craft.model}', title="Model", style={'display': 'inline', 'margin': 0}),
-                                 html.H4(f'  |  {craft.operator}', title='Operator', style={'display': 'inline'}),
-                                 html.I(f'  (Updated: {round(time.time()) - craft.last_update}s ago)',
-                                        style={'display': 'inline'})
-
-                             ]),
-                             html.P(style={'margin': 0, 'marginLeft': 12}, children=[
-                                 html.P(f'ID: {craft["id"].value}', title='Flight ID',
-                                        style={'display': 'inline', 'margin': 0}),
-                                 html.P(f'  ({craft.icao})', title='ICAO ID', style={'display': 'inline'}),
-                                 html.P(f'Horz. Vel.: {craft["horz_vel"].value_str} {craft["horz_vel"].unit}',
-                                        title='Horizontal Velocity', style={'margin': 0}),
-                                 html.P(f'Vert. Vel.: {craft["vert_vel"].value_str} {craft["vert_vel"].unit}',
-                                        title='Vertical Velocity', style={'margin': 0}),
-                                 html.P(f'Heading: {craft["heading"].value_str} {craft["heading"].unit}',
-                                        title='Heading', style={'margin': 0})
-
-                             ])
-                         ]),
-                         html.P(style={'flex': '0 1 auto', 'borderBottom': f'6px solid #{craft.icao}', 'height': 'auto',
-                                       'textAlign': 'right'}, children=[
-                             html.P(f'Lat: {craft["lat"].value_str} {craft["lat"].unit}', style={'margin': 0}),
-                             html.P(f'Lon: {craft["lon"].value_str} {craft["lon"].unit}', style={'margin': 0}),
-                             html.P(f'Alt: {craft["alt"].value} {craft["alt"].unit}', style={'margin': 0})
-                         ])
-                     ])
-        children.append(li)
-    return children
-
-
-def update_aircraft_map(fig: go.Figure, lat: float, lon: float, icao_id: str) -> None:
+    return [GUIData.rows[craft.icao] for craft in GUIData.aircraft if craft.icao in GUIData.rows]
+
+
+def build_aircraft_li(craft: Aircraft) -> html.Li:
+    """
+    Builds the list row of a single aircraft
+    :return: an <li> element
+    """
+    return html.Li(id=f'li-{craft.icao}', style={'display': 'flex', 'padding': 8, 'border-bottom': '2px solid gray'},
+                   children=[
+                       html.Div(style={'flex': 3}, children=[
+                           html.P(style={'margin': 0}, children=[
+                               html.H3(f'{craft.model}', title="Model", style={'display': 'inline', 'margin': 0}),
+                               html.H4(f'  |  {craft.operator}', title='Operator', style={'display': 'inline'}),
+                               html.I(f'  (Updated: {time.strftime("%H:%M:%S", time.localtime(craft.last_update))})',
+                                      style={'display': 'inline'})
+
+                           ]),
+                           html.P(style={'margin': 0, 'marginLeft': 12}, children=[
+                               html.P(f'ID: {craft["id"].value}', title='Flight ID',
+                                      style={'display': 'inline', 'margin': 0}),
+                               html.P(f'  ({craft.icao})', title='ICAO ID', style={'display': 'inline'}),
+                               html.P(f'Horz. Vel.: {craft["horz_vel"].value_str} {craft["horz_vel"].unit}',
+                                      title='Horizontal Velocity', style={'margin': 0}),
+                               html.P(f'Vert. Vel.: {craft["vert_vel"].value_str} {craft["vert_vel"].unit}',
+                                      title='Vertical Velocity', style={'margin': 0}),
+                               html.P(f'Heading: {craft["heading"].value_str} {craft["heading"].unit}',
+                                      title='Heading', style={'margin': 0})
+
+                           ])
+                       ]),
+                       html.P(style={'flex': '0 1 auto', 'borderBottom': f'6px solid #{craft.icao}', 'height': 'auto',
+                                     'textAlign': 'right'}, children=[
+                           html.P(f'Lat: {craft["lat"].value_str} {craft["lat"].unit}', style={'margin': 0}),
+                           html.P(f'Lon: {craft["lon"].value_str} {craft["lon"].unit}', style={'margin': 0}),
+                           html.P(f'Alt: {craft["alt"].value} {craft["alt"].unit}', style={'margin': 0})
+                       ])
+                   ])
+
+
+def update_aircraft_map(lat: float, lon: float, icao_id: str) -> None:
     """ Updates position of an aircraft on the map (or adds it if new) """
     lat, lon = round(lat, 4), round(lon, 4)
-    for trace in fig['data']:
-        if trace['name'] == icao_id:
-            trace['lat'] = [lat]
-            trace['lon'] = [lon]
-            break
+    slot = GUIData.map_slots.get(icao_id)
+    if slot is None:
+        GUIData.map_slots[icao_id] = len(GUIData.map_icao)
+        GUIData.map_icao.append(icao_id)
+        GUIData.map_lat.append(lat)
+        GUIData.map_lon.append(lon)
     else:
-        fig['data'].append(go.Scattermapbox(lat=[lat], lon=[lon], mode='markers', hoverinfo='lat+lon+name',
-                                            marker=dict(size=12, color=f'#{icao_id}'), name=icao_id))
+        GUIData.map_lat[slot] = lat
+        GUIData.map_lon[slot] = lon
+
+
+def remove_aircraft_map(icao_id: str) -> None:
+    """ Removes given aircraft from the map. The last aircraft is moved into its slot """
+    slot = GUIData.map_slots.pop(icao_id, None)
+    if slot is None:
+        return
+    for arr in (GUIData.map_icao, GUIData.map_lat, GUIData.map_lon):
+        arr[slot] = arr[-1]
+        arr.pop()
+    if slot < len(GUIData.map_icao):
+        GUIData.map_slots[GUIData.map_icao[slot]] = slot
 
 
-def remove_aircraft_map(fig: go.Figure, icao_id: str) -> None:
-    """ Removes given aircraft from the map """
-    fig['data'] = [t for t in fig['data'] if t['name'] != icao_id]
+def build_map_figure() -> Dict:
+    """
+    Builds the map. All aircraft are in a single trace so the figure stays small with many aircraft, and so are
+    all their trails (separated by gaps). The trail trace has empty text and colors so it can be extended along
+    with the aircraft trace (see ``GUIData.map_extension()``)
+    """
+    trail_lat, trail_lon = list(GUIData.trail_base[0]), list(GUIData.trail_base[1])
+    for _, lat, lon in GUIData.trail_log:
+        trail_lat += lat
+        trail_lon += lon
+    trail_trace = dict(type='scattermapbox', lat=trail_lat, lon=trail_lon, text=[], mode='lines', hoverinfo='skip',
+                       name='Trails', line=dict(width=2, color='rgba(64,64,64,0.6)'), marker=dict(color=[]))
+    craft_trace = dict(type='scattermapbox', lat=GUIData.map_lat, lon=GUIData.map_lon, text=GUIData.map_icao,
+                       mode='markers', hoverinfo='lat+lon+text', name='Aircraft',
+                       marker=dict(size=12, color=[f'#{icao}' for icao in GUIData.map_icao]))
+    return dict(data=GUIData.base_fig['data'] + [trail_trace, craft_trace], layout=GUIData.base_fig['layout'])
 
 
 def run_gui(radio: BaseRadio, debug: bool):
     """ Runs the GUI """
     GUIData.radio = radio
+    metrics.REGISTRY.gauge('a522_aircraft', 'Aircraft being tracked', fn=lambda: len(GUIData.aircraft))
 
     plot_map.add_trace(go.Scattermapbox(lat=[utils.REF_LAT], lon=[utils.REF_LON], mode='markers',
                                         marker=dict(size=16, color='rgb(255,0,0)'), hoverinfo='lat+lon+name',
@@ -199,5 +353,7 @@ def run_gui(radio: BaseRadio, debug: bool):
     plot_map.update_layout(mapbox=dict(style='stamen-terrain', bearing=0, zoom=8,
                                        center=dict(lat=utils.REF_LAT, lon=utils.REF_LON)),
                            legend=dict(x=0, y=1, bgcolor='rgba(224,224,224,0.85)'),
-                           margin=dict(l=0, r=0, t=0, b=0, pad=0))
+                           margin=dict(l=0, r=0, t=0, b=0, pad=0),
+                           uirevision='map')  # keeps the user's zoom/pan when the figure is replaced
+    GUIData.base_fig = plot_map.to_dict()
     app.run_server(debug=debug)
@@ -0,0 +1,14 @@
+/* keeps the raw message log in the browser so the server only sends new entries */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    airport522: {
+        appendLog: function (delta) {
+            if (!delta) {
+                return '';
+            }
+            var log = delta.reset ? [] : (window.airport522Log || []);
+            log = delta.entries.concat(log).slice(0, delta.max);
+            window.airport522Log = log;
+            return log.join('\n');
+        }
+    }
+});
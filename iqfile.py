@@ -0,0 +1,96 @@
+import os
+import struct
+import time
+import numpy as np
+from typing import Iterator, Tuple
+
+MAGIC = b'A522IQ\x00\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sHHIQd')  # magic, version, format, sample rate, center frequency, start time
+FORMATS = ('int16', 'complex64')  # int16 is interleaved I, Q
+EXTENSION = '.iq'
+
+
+def is_capture(path: str) -> bool:
+    """ Whether a file is a raw IQ capture """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class IQWriter:
+    """
+    Writes raw samples from the radio to disk: a 32 byte header then the samples, either as interleaved int16 I/Q
+    (what the Pluto's ADC gives, half the size) or complex64. Each chunk goes straight to the file so a capture
+    that's cut off still holds everything up to that point
+    """
+
+    def __init__(self, path: str, fmt: str = 'int16', sample_rate: float = 2e6, center_freq: float = 1090e6):
+        if fmt not in FORMATS:
+            raise ValueError(f'fmt must be one of {FORMATS}')
+        self.path = path
+        self.fmt = fmt
+        self.samples = 0
+        self._file = open(path, 'wb', buffering=0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, FORMATS.index(fmt), int(sample_rate), int(center_freq),
+                                     time.time()))
+
+    def write(self, iq: np.ndarray) -> None:
+        """ Adds a chunk of complex samples (as returned by ``sdr.rx()``) or (N, 2) int16 I/Q pairs """
+        if iq.ndim == 2:
+            out = iq.astype(np.int16, copy=False) if self.fmt == 'int16' else \
+                (iq[:, 0] + 1j * iq[:, 1]).astype(np.complex64)
+        elif self.fmt == 'int16':
+            out = np.empty((len(iq), 2), dtype=np.int16)
+            np.clip(np.round(iq.real), -32768, 32767, out=out[:, 0], casting='unsafe')
+            np.clip(np.round(iq.imag), -32768, 32767, out=out[:, 1], casting='unsafe')
+        else:
+            out = iq.astype(np.complex64, copy=False)
+        self._file.write(out.tobytes())
+        self.samples += len(iq)
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class IQReader:
+    """
+    Reads a capture through a memory map. Samples are int16 (N, 2) I/Q pairs or complex64 depending on the format,
+    and chunks are views into the file, so nothing is copied or loaded until it's used
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            magic, version, fmt, rate, freq, start = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an IQ capture')
+        self.path = path
+        self.fmt = FORMATS[fmt]
+        self.sample_rate = rate
+        self.center_freq = freq
+        self.start_time = start
+        dtype = np.dtype(np.int16 if self.fmt == 'int16' else np.complex64)
+        per_sample = dtype.itemsize * (2 if self.fmt == 'int16' else 1)
+        n_samples = (os.path.getsize(path) - HEADER.size) // per_sample  # a cut off capture can end mid sample
+        shape = (n_samples, 2) if self.fmt == 'int16' else (n_samples,)
+        # memmap can't map zero bytes
+        self.samples = np.memmap(path, dtype=dtype, mode='r', offset=HEADER.size, shape=shape) if n_samples > 0 \
+            else np.empty(shape, dtype=dtype)
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+    def chunks(self, size: int = 1 << 18) -> Iterator[Tuple[int, np.ndarray]]:
+        """ Yields (first sample, view of samples) for consecutive chunks of the capture """
+        for i in range(0, len(self.samples), size):
+            yield i, self.samples[i:i + size]
@@ -1,23 +1,89 @@
-from radio import Radio, MockRadio
+from radio import BaseRadio, Radio, MockRadio, IQFileRadio
 from gui import run_gui
 from multiprocessing import Queue
 import argparse
+import replay
+from data_handler import DataHandler, DecodeCache
 import utils
-import time
+import sys
+from recording import RecordWriter
+import metrics
+import iqfile
+import pipeline
+import feeds
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Runs Airport522, a ADS-B decoder")
 
     inp_parser = parser.add_argument_group('input settings')
-    inp_parser.add_argument('-i', '--input', help="File to read messages from. Default is live from radio")
+    inp_parser.add_argument('-i', '--input', nargs='+',
+                            help="File to read messages from. Default is live from radio. "
+                                 "Batch mode also takes several files or directories")
+    inp_parser.add_argument('-b', '--batch', action='store_true',
+                            help='Decode input as fast as possible (no timing) and print a summary at the end')
+    inp_parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='Processes to decode batch input with. Default is one per CPU')
     inp_parser.add_argument('-r', '--repeat', help='Whether file input should repeat', action='store_true')
+    inp_parser.add_argument('--fix-bits', type=int, default=1, choices=[0, 1, 2],
+                            help='Max bit errors to repair in frames failing CRC (radio only). Default is 1')
+    inp_parser.add_argument('--full-speed', action='store_true',
+                            help='Read IQ captures as fast as they can be demodulated instead of in real time')
+    inp_parser.add_argument('--lut', action='store_true',
+                            help='Take int16 I/Q from the radio (or an int16 capture) and find magnitudes with a '
+                                 'lookup table instead of complex math')
+    inp_parser.add_argument('--demod-workers', type=int, default=1,
+                            help='Processes to demodulate radio samples with. Default is 1')
+    inp_parser.add_argument('--start', type=float, default=None,
+                            help='Unix time to start file input from. Binary recordings seek to it through their index')
+    inp_parser.add_argument('--end', type=float, default=None, help='Unix time to stop file input at')
     inp_parser.add_argument('-d', '--delay', help='delay before starting/restarting input. Default is 1', type=int,
                             default=1)
 
     out_parser = parser.add_argument_group('Output settings')
-    out_parser.add_argument('-o', '--output', help="File to write output to. Default is none (only support in cli mode",
-                            type=argparse.FileType('w'))
-    out_parser.add_argument('--output-invalid', action='store_true', help="Include invalid decoding in output")
+    out_parser.add_argument('-o', '--output', help="File to write output to. Default is none (only support in cli mode")
+    out_parser.add_argument('--output-format', choices=['text', 'binary'], default='text',
+                            help='Format of the output file. binary is the compact format from recording.py, which '
+                                 'keeps full timestamps and signal levels. Default is text')
+    out_parser.add_argument('--rotate-mb', type=float, default=None,
+                            help='Start a new binary output file once the current one reaches this many MB')
+    out_parser.add_argument('--rotate-minutes', type=float, default=None,
+                            help='Start a new binary output file once the current one is this many minutes old')
+    out_parser.add_argument('-q', '--quiet', action='store_true',
+                            help="Don't print messages in cli mode. Messages that are only recorded are never decoded")
+    out_parser.add_argument('--capture', default=None,
+                            help='File to write the raw radio samples to, for replaying later with -i')
+    out_parser.add_argument('--capture-format', choices=iqfile.FORMATS, default='int16',
+                            help='Sample format of the capture. Default is int16 (half the size of complex64)')
+    out_parser.add_argument('--output-invalid', action='store_true',
+                            help='Include frames that failed CRC (and could not be repaired) in output. Only full '
+                                 '112 bit frames are sent on by the radio, so shorter or cut off decodes never are')
+
+    parser.add_argument('--decode-cache', type=int, default=4096,
+                        help='Number of decoded frames to keep for repeated messages (0 to disable). Default is 4096')
+
+    feed_parser = parser.add_argument_group('feed settings')
+    for fmt, desc in (('raw', 'raw hex frames (AVR format)'), ('beast', 'Beast binary frames'),
+                      ('sbs', 'decoded messages as SBS BaseStation CSV')):
+        feed_parser.add_argument(f'--{fmt}-port', type=int, nargs='?', const=feeds.DEFAULT_PORTS[fmt], default=None,
+                                 help=f'Serve {desc} over TCP (cli mode). Port defaults to '
+                                      f'{feeds.DEFAULT_PORTS[fmt]}')
+    feed_parser.add_argument('--feed-buffer', type=float, default=1.0, metavar='MB',
+                             help='How far a feed client can fall behind before it counts as slow. Default is 1 MB')
+    feed_parser.add_argument('--slow-clients', choices=feeds.SLOW_POLICIES, default='disconnect',
+                             help='What happens to slow feed clients: disconnect them or drop what they have '
+                                  'buffered. Default is disconnect')
+
+    que_parser = parser.add_argument_group('queue settings')
+    que_parser.add_argument('--queue-size', type=int, default=1000,
+                            help='Max batches of frames waiting between radio and consumer. Default is 1000')
+    que_parser.add_argument('--drop-policy', default='newest', choices=BaseRadio.DROP_POLICIES,
+                            help='What to drop when the queue is full. Default is newest')
+
+    met_parser = parser.add_argument_group('metrics settings')
+    met_parser.add_argument('--metrics-port', type=int, default=None,
+                            help='Serve metrics in the Prometheus text format on this port (at /metrics)')
+    met_parser.add_argument('--stats', type=float, default=None, metavar='SECONDS',
+                            help='Print a line of pipeline stats this often (cli mode)')
 
     gui_parser = parser.add_argument_group('GUI settings')
     gui_parser.add_argument('-g', '--gui', help='launch dash GUI', action='store_true')
@@ -25,9 +91,16 @@ if __name__ == '__main__':
 
     parser.add_argument('-c', '--custom-coords', default=None,
                         help="Custom coordinates to use for reference. Format as `lat,lon`. "
-                             "Default is based on IP address. Need ~300km accuracy")
+                             "Default is based on IP address. Need ~300km accuracy. Only used until an "
+                             "aircraft has sent an even/odd pair of positions")
 
     args = parser.parse_args()
+    if args.batch and args.input is None:
+        parser.error('--batch requires --input')
+    if not args.batch and args.input is not None and len(args.input) > 1:
+        parser.error('multiple inputs are only supported with --batch')
+    if (args.rotate_mb is not None or args.rotate_minutes is not None) and args.output_format != 'binary':
+        parser.error('rotation is only supported with --output-format binary')
 
     if args.custom_coords is not None:
         lat, lon = args.custom_coords.strip().split(',')
@@ -36,22 +109,56 @@ if __name__ == '__main__':
         utils.set_loc_ip()
     print(f'Using reference coordinates of: {utils.REF_LAT}, {utils.REF_LON}')
 
-    msg_que = Queue()
-    if args.input is not None:
-        print(f"Using MockRadio with {args.input}")
-        radio = MockRadio(msg_que, args.input, args.repeat, args.delay, args.delay)
+    DataHandler.cache = DecodeCache(args.decode_cache)
+
+    if args.batch:
+        files = replay.expand_inputs(args.input)
+        print(f'Decoding {len(files)} files')
+        print(replay.decode_files(files, args.jobs))
+        sys.exit(0)
+
+    msg_que = Queue(args.queue_size)
+    if args.input is not None and iqfile.is_capture(args.input[0]):
+        print(f"Using IQFileRadio with {args.input[0]}")
+        radio = IQFileRadio(msg_que, args.input[0], not args.full_speed, args.delay, args.fix_bits,
+                            args.output_invalid, args.drop_policy, args.demod_workers, args.lut)
+    elif args.input is not None:
+        print(f"Using MockRadio with {args.input[0]}")
+        radio = MockRadio(msg_que, args.input[0], args.repeat, args.delay, args.delay, args.drop_policy, args.start,
+                          args.end)
     else:
         print('Setting up radio')
-        radio = Radio(msg_que)
+        radio = Radio(msg_que, args.fix_bits, args.output_invalid, args.drop_policy, args.demod_workers,
+                      args.capture, args.capture_format, args.lut)
         print('Done')
 
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+        print(f'Serving metrics on port {args.metrics_port}')
+
     if args.gui:
         run_gui(radio, args.debug)
     else:
-        while True:
-            msgs = radio.get_all_queue()
-            for m in msgs:
-                if m.valid:
-                    print(m)
-                if args.output is not None and (m.valid or args.output_invalid):
-                    args.output.write(f'{round(time.time())} {m.bin_msg}\n')
+        # every output is a sink of one pipeline fed by the radio, so none of them needs its own polling loop
+        sinks = []
+        if not args.quiet:
+            sinks.append(pipeline.PrintSink())
+        if args.output is not None and args.output_format == 'binary':
+            sinks.append(pipeline.RecordSink(RecordWriter(
+                args.output, max_bytes=None if args.rotate_mb is None else int(args.rotate_mb * 1e6),
+                max_seconds=None if args.rotate_minutes is None else args.rotate_minutes * 60)))
+        elif args.output is not None:
+            sinks.append(pipeline.TextSink(open(args.output, 'w'), args.output_invalid))
+        for fmt in feeds.FORMATS:
+            port = getattr(args, f'{fmt}_port')
+            if port is not None:
+                sinks.append(feeds.FeedSink(feeds.FeedServer(fmt, port, max_buffer=int(args.feed_buffer * 1e6),
+                                                             slow_policy=args.slow_clients)))
+                print(f'Serving {fmt} feed on port {port}')
+        if args.stats is not None:
+            sinks.append(pipeline.StatsSink(args.stats))
+        stages = [pipeline.ValidateStage(args.output_invalid)]
+        decode = pipeline.decode_stage(sinks)
+        if decode is not None:  # recordings and frame feeds don't need frames decoded at all
+            stages.append(decode)
+        pipeline.Pipeline(pipeline.radio_source(radio), stages, sinks, args.queue_size).run_forever()
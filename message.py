@@ -1,6 +1,13 @@
-from data_handler import DataHandler, DataPoint
+from data_handler import DataHandler, DataPoint, DATA_LEN
 from utils import *
 from enum import Enum
+from typing import Union, Dict, Iterable
+import numpy as np
+import demod
+import crc
+import metrics
+from time import perf_counter
+from itertools import count
 
 
 class MessageType(Enum):
@@ -18,32 +25,119 @@ class MessageType(Enum):
     @classmethod
     def from_tc(cls, tc):
         """ Returns appropriate MessageType for a given TC """
-        for e in cls:
+        return _TC_TYPES[tc] if 0 <= tc < len(_TC_TYPES) else cls.UNKNOWN
+
+
+def _tc_types() -> list:
+    """ Builds TC -> MessageType lookup so it's a list index instead of a search through the enum """
+    table = []
+    for tc in range(32):
+        for e in MessageType:
             if tc in e.value:
-                return e
-        return cls.UNKNOWN
+                table.append(e)
+                break
+    return table
+
+
+_TC_TYPES = _tc_types()
+_INVALID = 32  # position of invalid messages in MESSAGES
+MESSAGES = metrics.REGISTRY.counter('a522_messages_total', 'Messages by type code', 'tc',
+                                    [str(tc) for tc in range(32)] + ['invalid'])
+DECODE_TIME = metrics.REGISTRY.histogram('a522_decode_seconds', 'Time to decode a message payload (sampled)',
+                                         (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3))
+DECODE_SAMPLE = 16  # only 1 in this many decodes are timed, since timing costs a few % of a decode
+_decodes = count()
 
 
 class Message:
     """
     Class that holds a single ADS-B message
-    can be built from a binary string or a raw signal
+    can be built from a binary string, bytes or a raw signal.
+    The frame is held as a single int and header fields are taken from it with shifts and masks.
+    The payload isn't decoded until ``data`` is used, so consumers that only need headers don't pay for it
     """
-    CHECK_GEN = '1111111111111010000001001'  # used as key in crc
+    __slots__ = ('frame', 'length', 'valid', 'type', '_data', 'corrected', 'timestamp')
 
-    def __init__(self, bin_msg: str):
-        self.bin_msg = bin_msg
+    def __init__(self, frame: Union[str, bytes, int], length: int = MSG_LEN):
+        """
+        :param frame: the message as a binary string, bytes, or an int
+        :param length: number of bits in the message. Only used when frame is an int
+        """
+        if isinstance(frame, str):
+            self.frame, self.length = int(frame, 2) if frame else 0, len(frame)
+        elif isinstance(frame, (bytes, bytearray)):
+            self.frame, self.length = int.from_bytes(frame, 'big'), len(frame) * 8
+        else:
+            self.frame, self.length = frame, length
+        self.corrected = 0  # number of bits repaired by error correction
+        self.timestamp = None  # unix time the frame was received, if known
+        self._data = None  # payload is only decoded once it's asked for
         self.valid = self._is_valid()
         if self.valid:
-            # these are all straight from headers
-            self.df = bin2int(self.bin_msg[:5])
-            self.icao = bin2hex(self.bin_msg[8:32]).upper()
-            self.capability = bin2int(self.bin_msg[5:8])
-            self.typecode = bin2int(self.bin_msg[32:37])
-            self.bin_data = self.bin_msg[37:88]
-            # these require some extra work
-            self.type = MessageType.from_tc(self.typecode)
-            self.data = DataHandler.dispatch(self)
+            tc = self.typecode
+            self.type = MessageType.from_tc(tc)
+            MESSAGES.inc_at(tc)
+        else:
+            MESSAGES.inc_at(_INVALID)
+
+    @property
+    def data(self) -> Dict[str, DataPoint]:
+        """ Decoded payload. Decoding happens on first access and is then kept """
+        if self._data is None:
+            if not self.valid:
+                self._data = {}
+            elif next(_decodes) % DECODE_SAMPLE == 0:
+                start = perf_counter()
+                self._data = DataHandler.dispatch(self)
+                DECODE_TIME.observe(perf_counter() - start)
+            else:
+                self._data = DataHandler.dispatch(self)
+        return self._data
+
+    @property
+    def bin_msg(self) -> str:
+        """ The message as a binary string """
+        return format(self.frame, f'0{self.length}b') if self.length > 0 else ''
+
+    @property
+    def frame_bytes(self) -> bytes:
+        """ The message as bytes (full length messages only) """
+        return self.frame.to_bytes(self.length // 8, 'big')
+
+    # these are all straight from headers
+    @property
+    def df(self) -> int:
+        return self.frame >> (MSG_LEN - 5)
+
+    @property
+    def capability(self) -> int:
+        return (self.frame >> (MSG_LEN - 8)) & 0x7
+
+    @property
+    def icao_int(self) -> int:
+        return (self.frame >> (MSG_LEN - 32)) & 0xFFFFFF
+
+    @property
+    def icao(self) -> str:
+        return format(self.icao_int, '06X')
+
+    @property
+    def typecode(self) -> int:
+        return (self.frame >> (MSG_LEN - 37)) & 0x1F
+
+    @property
+    def payload(self) -> int:
+        """ The 51 bits of data after the type code """
+        return (self.frame >> (MSG_LEN - 88)) & ((1 << DATA_LEN) - 1)
+
+    @property
+    def bin_data(self) -> str:
+        return format(self.payload, f'0{DATA_LEN}b')
+
+    @classmethod
+    def from_bytes(cls, frame: bytes):
+        """Create a Message from the 14 bytes of a frame"""
+        return cls(bytes(frame))
 
     @classmethod
     def from_raw(cls, raw):
@@ -53,42 +147,41 @@ class Message:
     @staticmethod
     def raw2bin(raw) -> str:
         """ Converts raw messages (from radio) into a binary string"""
-        if len(raw) == 0:
-            return ''
-        thresh = max(raw) * .2  # want data at least this strong
-        msg = ''
-        for i in range(0, len(raw), 2):
-            if i + 1 >= len(raw):
-                break
-            # print(f"THRESH: {thresh} compared to 1={raw[i]}, 2={raw[i+1]}")
-            if raw[i] < thresh and raw[i + 1] < thresh:
-                break
-            if raw[i] >= raw[i + 1]:
-                msg += '1'
-            else:
-                msg += '0'
-        return msg
+        bits, lengths = demod.slice_bits(np.asarray(raw, dtype=float), np.array([-demod.PREAMB_LEN]))
+        return demod.bits2str(bits, lengths)[0]
+
+    @staticmethod
+    def validate_many(frames: np.ndarray) -> np.ndarray:
+        """
+        Checks the CRC of many frames in one call
+        :param frames: (N, 14) uint8 array of frames
+        :return: (N,) bool array
+        """
+        return crc.syndromes(frames) == 0
 
     def _is_valid(self) -> bool:
         """ Calculates validity of message based on length and CRC. Use msg.valid to get result """
-        if len(self.bin_msg) != MSG_LEN:
-            # print(f'bad len: {len(self.bin_msg)}')
-            return False
-
-        # CRC check based on: https://en.wikipedia.org/wiki/Cyclic_redundancy_check#Computation
-        msg_cpy = list(self.bin_msg)
-        while '1' in msg_cpy[:88]:
-            cur_shift = msg_cpy.index('1')
-            for i in range(len(Message.CHECK_GEN)):
-                msg_cpy[cur_shift + i] = str(int(Message.CHECK_GEN[i] != msg_cpy[cur_shift + i]))
-        if '1' in msg_cpy[88:]:
+        if self.length != MSG_LEN:
+            # print(f'bad len: {self.length}')
             return False
-
-        return True
+        if self.frame in DataHandler.cache:
+            return True  # only valid frames are cached
+        return crc.syndrome(self.frame_bytes) == 0
 
     def __str__(self) -> str:
         if self.valid:
-            return ('#' * MSG_LEN) + f'\n{self.bin_msg}\n{self.icao}: DF={self.df}, CA={self.capability}, ' \
-                                     f'TC={self.typecode}, TYPE={self.type.name}\n\tDATA={list(self.data.values())}'
+            return format_valid(self.frame, self.corrected, self.data.values())
         else:
             return f'Invalid ({self.bin_msg})'
+
+
+def format_valid(frame: int, corrected: int, data: Iterable[DataPoint]) -> str:
+    """
+    Display text of a valid full length frame, as ``Message.__str__`` gives it. Only needs the frame and its decoded
+    values, so the text can be built long after the message is gone (see the GUI's message log)
+    """
+    tc = (frame >> (MSG_LEN - 37)) & 0x1F
+    fixed = f' (corrected {corrected} bits)' if corrected else ''
+    return ('#' * MSG_LEN) + f'\n{frame:0{MSG_LEN}b}\n{(frame >> (MSG_LEN - 32)) & 0xFFFFFF:06X}: ' \
+                             f'DF={frame >> (MSG_LEN - 5)}, CA={(frame >> (MSG_LEN - 8)) & 0x7}, ' \
+                             f'TC={tc}, TYPE={MessageType.from_tc(tc).name}{fixed}\n\tDATA={list(data)}'
@@ -0,0 +1,292 @@
+import math
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing.sharedctypes import RawArray
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, Iterable, Sequence, Tuple, Union
+
+import numpy as np
+
+# seconds. Covers everything from one buffer being demodulated to a backed up queue
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _storage(n: int, shared: bool):
+    """
+    Where a metric keeps its numbers. Shared storage lives in shared memory so a metric updated in the radio process
+    can be read from the main one. There's no lock: each shared metric has a single writer
+    """
+    return RawArray('d', n) if shared else [0.0] * n
+
+
+class Metric(ABC):
+    """ Base for metrics. ``samples()`` gives (suffix, labels, value) for each series """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+
+    @abstractmethod
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        pass
+
+    def total(self) -> float:
+        """ Sum over every series. What the CLI stats line shows """
+        return sum(v for _, _, v in self.samples())
+
+
+class Counter(Metric):
+    """
+    Count that only goes up. Can be split by one label whose values are known up front, so each increment is just
+    a list index
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, label: Union[str, None] = None, label_values: Sequence = (),
+                 shared: bool = False):
+        super().__init__(name, help_text)
+        self.label = label
+        self.label_values = [str(v) for v in label_values] if label is not None else ['']
+        self._index = {v: i for i, v in enumerate(self.label_values)}
+        self._vals = _storage(len(self.label_values), shared)
+
+    def inc(self, n: float = 1, label_value: str = '') -> None:
+        self._vals[self._index[label_value] if self.label is not None else 0] += n
+
+    def inc_at(self, i: int, n: float = 1) -> None:
+        """ Increments the series of the i-th label value. Skips the lookup in ``inc()`` for hot paths """
+        self._vals[i] += n
+
+    def inc_many(self, counts: Sequence[float]) -> None:
+        """ Adds counts for every label value at once (e.g. from ``np.bincount``) """
+        for i, n in enumerate(counts):
+            if n:
+                self._vals[i] += n
+
+    def value(self, label_value: str = '') -> float:
+        return self._vals[self._index[label_value] if self.label is not None else 0]
+
+    def samples(self):
+        for v, val in zip(self.label_values, self._vals):
+            yield '', ({self.label: v} if self.label is not None else {}), val
+
+
+class Gauge(Metric):
+    """ Value that goes up and down. Give ``fn`` to read the value when it's collected instead of setting it """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, fn: Union[Callable[[], float], None] = None, shared: bool = False):
+        super().__init__(name, help_text)
+        self.fn = fn
+        self._vals = _storage(1, shared)
+
+    def set(self, val: float) -> None:
+        self._vals[0] = val
+
+    def value(self) -> float:
+        if self.fn is None:
+            return self._vals[0]
+        try:
+            return float(self.fn())
+        except (NotImplementedError, OSError, ValueError):  # e.g. Queue.qsize() isn't available on macOS
+            return math.nan
+
+    def samples(self):
+        yield '', {}, self.value()
+
+
+class Histogram(Metric):
+    """ Counts observations into fixed buckets. Quantiles are estimated from the buckets """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS, shared: bool = False):
+        super().__init__(name, help_text)
+        self.buckets = list(buckets)
+        # per bucket counts, then one for above the last bucket, then the sum and count
+        self._vals = _storage(len(self.buckets) + 3, shared)
+        self._sum = len(self.buckets) + 1
+        self._count = len(self.buckets) + 2
+
+    def observe(self, val: float) -> None:
+        self._vals[bisect_left(self.buckets, val)] += 1
+        self._vals[self._sum] += val
+        self._vals[self._count] += 1
+
+    def observe_many(self, vals: np.ndarray) -> None:
+        """ Observes a whole array with one pass """
+        if len(vals) == 0:
+            return
+        self.inc_buckets(np.bincount(np.searchsorted(self.buckets, vals), minlength=len(self.buckets) + 1))
+        self._vals[self._sum] += float(np.sum(vals))
+        self._vals[self._count] += len(vals)
+
+    def inc_buckets(self, counts: Sequence[int]) -> None:
+        for i, n in enumerate(counts):
+            if n:
+                self._vals[i] += int(n)
+
+    @property
+    def count(self) -> float:
+        return self._vals[self._count]
+
+    @property
+    def sum(self) -> float:
+        return self._vals[self._sum]
+
+    def quantile(self, q: float) -> float:
+        """ Estimates a quantile by interpolating inside the bucket it falls in. NaN if nothing was observed """
+        counts = self._vals[:len(self.buckets) + 1]
+        total = sum(counts)
+        if total == 0:
+            return math.nan
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if seen + n >= rank and n > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lo = self.buckets[i - 1] if i > 0 else 0
+                return lo + (self.buckets[i] - lo) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def samples(self):
+        cumulative = 0
+        for bound, n in zip(self.buckets + ['+Inf'], self._vals[:len(self.buckets) + 1]):
+            cumulative += n
+            yield '_bucket', {'le': str(bound)}, cumulative
+        yield '_sum', {}, self.sum
+        yield '_count', {}, self.count
+
+    def total(self) -> float:
+        return self.count
+
+
+class Registry:
+    """ Holds metrics by name and renders them in the Prometheus text format """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """ Adds a metric, replacing any with the same name (e.g. the metrics of a radio that's been replaced) """
+        with self._lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Union[Metric, None]:
+        return self.metrics.get(name)
+
+    def counter(self, name: str, help_text: str, label: Union[str, None] = None, label_values: Sequence = (),
+                shared: bool = False) -> Counter:
+        return self.register(Counter(name, help_text, label, label_values, shared))
+
+    def gauge(self, name: str, help_text: str, fn: Union[Callable[[], float], None] = None,
+              shared: bool = False) -> Gauge:
+        return self.register(Gauge(name, help_text, fn, shared))
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  shared: bool = False) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets, shared))
+
+    def render(self) -> str:
+        """ All metrics in the Prometheus text exposition format """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for m in metrics:
+            lines.append(f'# HELP {m.name} {m.help}')
+            lines.append(f'# TYPE {m.name} {m.kind}')
+            for suffix, labels, val in m.samples():
+                label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'{m.name}{suffix}{{{label_str}}} {_fmt_value(val)}' if label_str else
+                             f'{m.name}{suffix} {_fmt_value(val)}')
+        return '\n'.join(lines) + '\n'
+
+    def totals(self) -> Dict[str, float]:
+        """ Snapshot of each metric's total, for working out rates """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return {m.name: m.total() for m in metrics}
+
+
+def _fmt_value(val: float) -> str:
+    if math.isnan(val):
+        return 'NaN'
+    if math.isinf(val):
+        return '+Inf' if val > 0 else '-Inf'
+    return repr(int(val)) if float(val).is_integer() else repr(float(val))
+
+
+REGISTRY = Registry()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port: int, host: str = '', registry: Registry = REGISTRY) -> HTTPServer:
+    """ Serves the registry at http://host:port/metrics from a background thread """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # scraped every few seconds, so don't fill the console
+
+    server = _Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StatsLine:
+    """ Builds the periodic one line summary for CLI mode. Rates are over the time since the last line """
+
+    def __init__(self, registry: Registry = REGISTRY):
+        self.registry = registry
+        self._last = registry.totals()
+        self._last_good = self._good()
+
+    def _good(self) -> float:
+        """ Frames that passed CRC or were repaired """
+        frames = self.registry.get('a522_frames_total')
+        if not isinstance(frames, Counter) or frames.label is None:
+            return 0.0
+        return frames.value('valid') + frames.value('corrected')
+
+    def line(self, elapsed: float) -> str:
+        totals, good = self.registry.totals(), self._good()
+
+        def delta(name: str) -> float:
+            return totals.get(name, 0) - self._last.get(name, 0)
+
+        def rate(name: str) -> float:
+            return delta(name) / elapsed if elapsed > 0 else 0.0
+
+        parts = [f'{rate("a522_samples_total") / 1e6:.2f} MS/s',
+                 f'{rate("a522_preambles_total"):.0f} preambles/s',
+                 f'{rate("a522_frames_total"):.0f} frames/s']
+        if delta('a522_frames_total') > 0:
+            parts.append(f'{(good - self._last_good) / delta("a522_frames_total"):.1%} valid')
+        parts.append(f'{rate("a522_messages_total"):.0f} msgs/s')
+        for name, label in (('a522_queue_depth', 'queue'), ('a522_frames_dropped_total', 'dropped'),
+                            ('a522_aircraft', 'aircraft')):
+            if name in totals:
+                parts.append(f'{label} {totals[name]:.0f}')
+        latency = self.registry.get('a522_latency_seconds')
+        if isinstance(latency, Histogram) and latency.count > 0:
+            parts.append(f'latency p50 {latency.quantile(.5) * 1e3:.0f}ms p99 {latency.quantile(.99) * 1e3:.0f}ms')
+        self._last, self._last_good = totals, good
+        return ' | '.join(parts)
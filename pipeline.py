@@ -0,0 +1,313 @@
+import asyncio
+import sys
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from typing import Any, AsyncIterator, Callable, List, NamedTuple, TextIO, Union
+
+import crc
+import metrics
+from aircraft import AircraftRegistry
+from message import Message
+from radio import BaseRadio, FrameBatch
+from recording import RecordWriter
+
+_END = object()  # passed down the pipeline once the source runs out
+NEEDS = ('frames', 'messages', 'payloads')  # what a sink needs, least decoding first
+
+
+class DecodedBatch(NamedTuple):
+    """ A batch of frames with their messages. What sinks get once frames are decoded """
+    batch: FrameBatch
+    messages: List[Message]
+
+
+# sources
+async def radio_source(radio: BaseRadio, executor: Union[Executor, None] = None) -> AsyncIterator[FrameBatch]:
+    """ Batches from a radio. See ``BaseRadio.frames()`` """
+    async for batch in radio.frames(executor):
+        yield batch
+
+
+# stages
+class Stage(ABC):
+    """
+    One step of the pipeline. ``process()`` takes an item and returns what's passed to the next stage (None to pass
+    nothing on). Each stage handles one item at a time, so stages don't need to be thread safe.
+    CPU heavy stages set ``executor`` so they run in the pipeline's executor and don't hold up the event loop
+    """
+    executor = False
+
+    @abstractmethod
+    def process(self, item: Any) -> Any:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class ValidateStage(Stage):
+    """ Drops frames that failed CRC and weren't repaired. Empty batches are dropped too """
+
+    def __init__(self, keep_invalid: bool = False):
+        self.keep_invalid = keep_invalid
+
+    def process(self, batch: FrameBatch) -> Union[FrameBatch, None]:
+        if not self.keep_invalid and batch.size > 0:
+            keep = (crc.syndromes(batch.frames) == 0) | (batch.corrected > 0)
+            if not keep.all():
+                batch = FrameBatch(*(field[keep] for field in batch))
+        return batch if batch.size > 0 else None
+
+
+class DecodeStage(Stage):
+    """ Batches in, ``DecodedBatch`` out. Payloads are decoded here so sinks never pay for it """
+    executor = True
+
+    def __init__(self, decode_payload: bool = True):
+        self.decode_payload = decode_payload
+
+    def process(self, batch: FrameBatch) -> DecodedBatch:
+        msgs = batch.messages()
+        if self.decode_payload:
+            for m in msgs:
+                m.data
+        return DecodedBatch(batch, msgs)
+
+
+class AircraftStage(Stage):
+    """ Keeps a registry of aircraft up to date from decoded messages """
+
+    def __init__(self, registry: Union[AircraftRegistry, None] = None, max_age: float = 180):
+        self.registry = AircraftRegistry() if registry is None else registry
+        self.max_age = max_age
+        self.now = float('-inf')  # newest message time seen. Replays are in capture time, so the clock comes from them
+        metrics.REGISTRY.gauge('a522_aircraft', 'Aircraft being tracked', fn=lambda: len(self.registry))
+
+    def process(self, decoded: DecodedBatch) -> DecodedBatch:
+        for m in decoded.messages:
+            if m.valid:
+                self.registry.update(m.icao, m.data, m.timestamp)
+        if len(decoded.messages) > 0:
+            self.now = max(self.now, max(m.timestamp for m in decoded.messages))
+            self.registry.expire(self.max_age, self.now)
+        return decoded
+
+
+# sinks
+class Sink(ABC):
+    """
+    End of the pipeline. Every sink gets every item through its own bounded queue, so a slow sink only backs up
+    its own queue. What happens when it's full follows ``drop_policy`` (same options as ``BaseRadio``).
+    ``needs`` (one of NEEDS) is how much decoding the sink needs done before it: `frames` takes plain batches,
+    `messages` needs a ``DecodeStage`` and `payloads` one with ``decode_payload`` set
+    """
+    needs = 'payloads'
+
+    def __init__(self, queue_size: int = 100, drop_policy: str = 'block'):
+        if drop_policy not in BaseRadio.DROP_POLICIES:
+            raise ValueError(f'drop_policy must be one of {BaseRadio.DROP_POLICIES}')
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self.queue: Union[asyncio.Queue, None] = None  # made once the loop is running
+
+    async def offer(self, item: Any) -> None:
+        """ Queues an item for the sink. Only waits if the queue is full and the policy is `block` """
+        if item is _END or self.drop_policy == 'block':
+            await self.queue.put(item)
+        elif not self.queue.full():
+            self.queue.put_nowait(item)
+        elif self.drop_policy == 'oldest':
+            self.queue.get_nowait()
+            self.queue.put_nowait(item)
+            self.dropped += 1
+        else:
+            self.dropped += 1
+
+    async def run(self) -> None:
+        while True:
+            item = await self.queue.get()
+            if item is _END:
+                break
+            await self.consume(item)
+
+    @abstractmethod
+    async def consume(self, item: Any) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class CallbackSink(Sink):
+    """ Calls a function with each item """
+
+    def __init__(self, fn: Callable[[Any], None], **kwargs):
+        super().__init__(**kwargs)
+        self.fn = fn
+
+    async def consume(self, item: Any) -> None:
+        self.fn(item)
+
+
+class PrintSink(Sink):
+    """ Prints valid messages, like cli mode always has """
+
+    def __init__(self, out: TextIO = sys.stdout, **kwargs):
+        super().__init__(**kwargs)
+        self.out = out
+
+    async def consume(self, decoded: DecodedBatch) -> None:
+        for m in decoded.messages:
+            if m.valid:
+                print(m, file=self.out)
+
+
+class TextSink(Sink):
+    """ Writes messages to a file in the text format (`timestamp binary_msg`) """
+    needs = 'messages'
+
+    def __init__(self, out: TextIO, include_invalid: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.out = out
+        self.include_invalid = include_invalid
+
+    async def consume(self, decoded: DecodedBatch) -> None:
+        for m in decoded.messages:
+            if m.valid or self.include_invalid:
+                self.out.write(f'{round(m.timestamp)} {m.bin_msg}\n')
+
+    def close(self) -> None:
+        self.out.close()
+
+
+class RecordSink(Sink):
+    """ Writes frames to a binary recording (see recording.py) """
+    needs = 'frames'
+
+    def __init__(self, writer: RecordWriter, **kwargs):
+        super().__init__(**kwargs)
+        self.writer = writer
+
+    async def consume(self, item: Union[FrameBatch, DecodedBatch]) -> None:
+        batch = item.batch if isinstance(item, DecodedBatch) else item
+        self.writer.write(batch.times, batch.frames, batch.signal)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class StatsSink(Sink):
+    """ Prints a ``metrics.StatsLine`` every ``interval`` seconds, whether or not anything is arriving """
+    needs = 'frames'
+
+    def __init__(self, interval: float, out: TextIO = sys.stdout, **kwargs):
+        super().__init__(drop_policy='newest', **kwargs)  # it only needs to know the pipeline is running
+        self.interval = interval
+        self.out = out
+
+    async def run(self) -> None:
+        stats = metrics.StatsLine()
+        last = time.time()
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), max(last + self.interval - time.time(), 0))
+                if item is _END:
+                    break
+            except asyncio.TimeoutError:
+                pass
+            now = time.time()
+            if now - last >= self.interval:
+                print(stats.line(now - last), file=self.out)
+                last = now
+
+    async def consume(self, item: Any) -> None:
+        pass
+
+
+def decode_stage(sinks: List[Sink]) -> Union[DecodeStage, None]:
+    """ The ``DecodeStage`` a set of sinks needs, decoding no more than the neediest one does. None if no decoding """
+    need = max((NEEDS.index(s.needs) for s in sinks), default=0)
+    if need == NEEDS.index('frames'):
+        return None
+    return DecodeStage(decode_payload=need == NEEDS.index('payloads'))
+
+
+class Pipeline:
+    """
+    Runs a source through stages into sinks on one event loop. Each stage and sink is its own task connected by
+    bounded queues, so a stage that falls behind makes the ones before it wait (backpressure) instead of memory
+    growing. Sinks decide for themselves whether to wait or drop when they can't keep up
+    """
+
+    def __init__(self, source: AsyncIterator, stages: List[Stage], sinks: List[Sink], queue_size: int = 100,
+                 executor: Union[Executor, None] = None):
+        """
+        :param source: async iterator of items for the first stage (e.g. ``radio_source()``)
+        :param queue_size: max items waiting between two stages
+        :param executor: where stages with ``executor`` set run. Default is the loop's default executor
+        """
+        self.source = source
+        self.stages = stages
+        self.sinks = sinks
+        self.queue_size = queue_size
+        self.executor = executor
+        self._closed = False
+
+    async def _feed(self, out: asyncio.Queue) -> None:
+        try:
+            async for item in self.source:
+                await out.put(item)
+        finally:
+            await out.put(_END)
+
+    async def _run_stage(self, stage: Stage, inp: asyncio.Queue, out: asyncio.Queue) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await inp.get()
+            if item is _END:
+                await out.put(_END)
+                break
+            if stage.executor:
+                item = await loop.run_in_executor(self.executor, stage.process, item)
+            else:
+                item = stage.process(item)
+            if item is not None:
+                await out.put(item)
+
+    async def _fan_out(self, inp: asyncio.Queue) -> None:
+        while True:
+            item = await inp.get()
+            for sink in self.sinks:
+                await sink.offer(item)
+            if item is _END:
+                break
+
+    async def run(self) -> None:
+        """ Runs until the source runs out and every sink has finished """
+        queues = [asyncio.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        for sink in self.sinks:
+            sink.queue = asyncio.Queue(sink.queue_size)
+        tasks = [self._feed(queues[0]), self._fan_out(queues[-1])]
+        tasks += [self._run_stage(s, queues[i], queues[i + 1]) for i, s in enumerate(self.stages)]
+        tasks += [sink.run() for sink in self.sinks]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.close()
+
+    def run_forever(self) -> None:
+        """ Runs the pipeline on the event loop, blocking until it's done (or interrupted) """
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """ Closes every stage and sink (flushing files etc.). Safe to call more than once """
+        if self._closed:
+            return
+        self._closed = True
+        for part in self.stages + self.sinks:
+            part.close()
@@ -1,25 +1,70 @@
+import asyncio
 import sys
 import numpy as np
 import time
 from multiprocessing import Process, Queue
-from queue import Empty
-from typing import List
+from queue import Empty, Full
+from concurrent.futures import Executor
+from typing import AsyncIterator, List, Union, NamedTuple
 from abc import ABC, abstractmethod
 
 # so stupid it installs here, but too lazy to fix at this point
 sys.path.append('/usr/lib/python3.6/site-packages/')
-import adi
 
+import crc
+import demod
+import iqfile
+import metrics
+import recording
 from message import Message
 from utils import *
 
+FRAME_BYTES = MSG_LEN // 8
+FRAME_SAMPLES = demod.PREAMB_LEN + MSG_LEN * 2  # samples a whole frame takes, preamble included
+FRAME_RESULTS = ('valid', 'corrected', 'invalid')  # CRC outcomes frames are counted by
+
+
+class FrameBatch(NamedTuple):
+    """
+    Frames found by one recv() call. This is what is sent from the radio process to consumers: raw frames are much
+    cheaper to send than Message objects and are only decoded once a consumer asks for them
+    """
+    times: np.ndarray  # (N,) unix time of each frame
+    frames: np.ndarray  # (N, 14) uint8 frames
+    corrected: np.ndarray  # (N,) number of bits repaired in each frame
+    signal: np.ndarray  # (N,) signal level of each frame (0 if unknown)
+
+    @classmethod
+    def empty(cls) -> 'FrameBatch':
+        return cls(np.empty(0), np.empty((0, FRAME_BYTES), dtype=np.uint8), np.empty(0, dtype=np.uint8),
+                   np.empty(0, dtype=np.uint16))
+
+    @property
+    def size(self) -> int:
+        return len(self.times)
+
+    def messages(self) -> List[Message]:
+        """ Decodes the batch into messages """
+        msgs = []
+        for ts, frame, fixed in zip(self.times.tolist(), self.frames, self.corrected.tolist()):
+            m = Message.from_bytes(frame.tobytes())
+            m.timestamp = ts
+            m.corrected = fixed
+            msgs.append(m)
+        return msgs
+
 
 def proc_loop(radio, queue: Queue) -> None:
-    """ loop meant for separate process. Repeatedly calls radio.recv() and puts messages into queue """
+    """
+    loop meant for separate process. Repeatedly calls radio.recv() and puts each batch of frames into queue.
+    recv() blocks until it has something, so this doesn't spin. Ends once recv() returns None
+    """
     while True:
-        msgs = radio.recv()
-        for m in msgs:
-            queue.put(m)
+        batch = radio.recv()
+        if batch is None:
+            break
+        if batch.size > 0:
+            radio.send(batch)
 
 
 class BaseRadio(ABC):
@@ -27,40 +72,233 @@ class BaseRadio(ABC):
     Abstract Radio class
     handles spawning of process and method for retrieving messages
     """
+    DROP_POLICIES = ('newest', 'oldest', 'block')
+    realtime = True  # whether frames are timestamped when they're received, so their age is the pipeline's latency
 
-    def __init__(self, msg_queue: Queue):
+    def __init__(self, msg_queue: Queue, drop_policy: str = 'newest'):
+        """
+        :param msg_queue: queue batches are sent through. Give it a maxsize to bound memory if consumers fall behind
+        :param drop_policy: what to do when the queue is full. `newest` drops the new batch, `oldest` drops the
+        oldest queued batch to make room and `block` waits for the consumer
+        """
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f'drop_policy must be one of {self.DROP_POLICIES}')
         self.queue = msg_queue
+        self.drop_policy = drop_policy
+        # frames dropped because the queue was full. Shared with the radio process
+        self.dropped = metrics.REGISTRY.counter('a522_frames_dropped_total',
+                                                'Frames dropped because the queue was full', shared=True)
+        metrics.REGISTRY.gauge('a522_queue_depth', 'Batches waiting in the queue', fn=msg_queue.qsize)
+        self.latency = metrics.REGISTRY.histogram('a522_latency_seconds',
+                                                  'Time from a frame being received to a consumer getting it')
         self.radio_proc = Process(target=proc_loop, args=(self, msg_queue))
         self.radio_proc.daemon = True
         self.radio_proc.start()
 
-    def get_all_queue(self) -> List[Message]:
+    def send(self, batch: FrameBatch) -> None:
+        """ Puts a batch into the queue, following the drop policy if it's full """
+        if self.drop_policy == 'block':
+            self.queue.put(batch)
+            return
+        try:
+            self.queue.put_nowait(batch)
+            return
+        except Full:
+            pass
+        if self.drop_policy == 'oldest':
+            try:
+                old = self.queue.get_nowait()
+                self._count_dropped(old.size)
+                self.queue.put_nowait(batch)
+                return
+            except (Empty, Full):
+                pass
+        self._count_dropped(batch.size)
+
+    def _count_dropped(self, n: int) -> None:
+        self.dropped.inc(n)
+
+    def get_all_frames(self, timeout: Union[float, None] = 0) -> List[FrameBatch]:
         """
-        Main method for getting messages from radio.
-        Will return whatever is available at the moment in the queue
-        :return: a list of messages (possibly empty)
+        Gets every batch of raw frames available in the queue, without decoding them
+        :param timeout: seconds to wait for the first batch if none are available. 0 returns right away and None
+        waits indefinitely
+        :return: a list of batches (possibly empty)
         """
-        msgs = []
+        batches = []
         try:
+            if timeout != 0:
+                batches.append(self.queue.get(timeout=timeout))
             while True:
-                msgs.append(self.queue.get_nowait())
+                batches.append(self.queue.get_nowait())
         except Empty:
-            return msgs
+            if len(batches) > 0 and self.realtime:  # otherwise times are when it was captured
+                now = time.time()
+                for batch in batches:
+                    self.latency.observe_many(now - batch.times)
+            return batches
+
+    def get_all_queue(self, timeout: Union[float, None] = 0) -> List[Message]:
+        """
+        Main method for getting messages from radio.
+        Will return whatever is available at the moment in the queue
+        :param timeout: seconds to wait for the first message if none are available. 0 returns right away and None
+        waits indefinitely
+        :return: a list of messages (possibly empty)
+        """
+        return [m for batch in self.get_all_frames(timeout) for m in batch.messages()]
+
+    async def frames(self, executor: Union[Executor, None] = None) -> AsyncIterator[FrameBatch]:
+        """
+        Async source of batches, for pipeline.py. The wait for the queue happens in an executor thread, so the event
+        loop is free while nothing arrives. Ends once the radio process is done and the queue is empty
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            batches = await loop.run_in_executor(executor, self.get_all_frames, 1)
+            if len(batches) == 0 and not self.radio_proc.is_alive():
+                batches = self.get_all_frames()  # anything sent right before it finished
+                if len(batches) == 0:
+                    return
+            for batch in batches:
+                yield batch
 
     @abstractmethod
-    def recv(self):
-        """ Method for getting messages directly from radio """
+    def recv(self) -> Union[FrameBatch, None]:
+        """
+        Method for getting frames directly from radio. Should block until frames are available.
+        Returning None means the radio is done and no more frames will come
+        """
         pass
 
 
+class Demodulator:
+    """
+    Turns magnitude samples into batches of frames: finds preambles, slices bits, checks CRC and repairs what it can.
+    Holds no radio, so anything that produces samples (the SDR, files, benchmarks) can feed it
+    """
+    BUFF_SIZE = 1024 * 200
+
+    def __init__(self, sample_rate: float = 2e6, fix_bits: int = 1, keep_invalid: bool = False,
+                 buff_size: int = BUFF_SIZE, workers: int = 1, lut: bool = False):
+        """
+        :param sample_rate: samples per second, used to timestamp frames
+        :param fix_bits: max number of bit errors to repair in frames that fail CRC (0 to disable)
+        :param keep_invalid: whether frames that fail CRC (and can't be repaired) are kept
+        :param buff_size: samples to collect before processing them
+        :param workers: processes to search for preambles with. With more than 1 the buffer is shared with a
+        ``demod.ShardPool``. Workers are started here, so make this before the radio process starts
+        :param lut: whether magnitudes are kept as uint16, with int16 I/Q converted by ``demod.MAG_LUT``. Halves the
+        buffer and keeps every threshold in the integer domain
+        """
+        self.sample_rate = sample_rate
+        self.buff_size = buff_size
+        self.raw_buf = demod.SampleBuffer(buff_size * 2, np.uint16 if lut else np.float32, shared=workers > 1)
+        self.pool = demod.ShardPool(self.raw_buf, workers) if workers > 1 else None
+        self.noise_floor = 1e6
+        self.corrector = crc.ErrorCorrector(fix_bits) if fix_bits > 0 else None
+        self.keep_invalid = keep_invalid
+
+        # updated in the radio process, so kept in shared memory. Counted once per buffer to keep them cheap
+        self.samples_count = metrics.REGISTRY.counter('a522_samples_total', 'Samples demodulated', shared=True)
+        self.preamble_count = metrics.REGISTRY.counter('a522_preambles_total', 'Preambles detected', shared=True)
+        self.frame_count = metrics.REGISTRY.counter('a522_frames_total', 'Full length frames by CRC result',
+                                                    'result', FRAME_RESULTS, shared=True)
+        self.demod_time = metrics.REGISTRY.histogram('a522_demod_seconds', 'Time to demodulate one buffer',
+                                                     shared=True)
+
+    def write(self, iq: np.ndarray) -> None:
+        """ Adds samples (complex IQ or magnitudes) to the buffer """
+        self.raw_buf.write(iq)
+
+    def ready(self) -> bool:
+        """ Whether enough samples are buffered to be worth processing """
+        return len(self.raw_buf) > self.buff_size
+
+    def process(self, now: Union[float, None] = None) -> FrameBatch:
+        """
+        Runs through the buffer to find valid messages. Every preamble in the buffer is found in one pass.
+        Samples that might still hold the start of a frame are kept for the next buffer
+        :param now: time the last buffered sample was received. Default is now
+        """
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        min_amp = self._get_min_amp()
+        raw = self.raw_buf.view()
+        starts, done = demod.find_complete(raw, min_amp,
+                                           demod.find_candidates if self.pool is None else self.pool.find_candidates)
+        bits, lengths = demod.slice_bits(raw, starts)
+        times = now - (len(raw) - starts) / self.sample_rate
+        signal = np.clip(np.round(demod.signal_levels(raw, starts)), 0, 0xFFFF).astype(np.uint16)
+        self.raw_buf.consume(done)
+
+        full = lengths == MSG_LEN  # anything else can't be valid
+        frames = np.packbits(bits[full, :MSG_LEN], axis=1)
+        syndromes = crc.syndromes(frames)
+        corrected = np.zeros(len(frames), dtype=np.uint8)
+        if self.corrector is not None:
+            self._correct_errors(frames, syndromes, corrected, now)
+        keep = slice(None) if self.keep_invalid else (syndromes == 0) | (corrected > 0)
+
+        n_valid, n_fixed = int(np.count_nonzero(syndromes == 0)), int(np.count_nonzero(corrected))
+        self.samples_count.inc(done)
+        self.preamble_count.inc(len(starts))
+        self.frame_count.inc_many((n_valid, n_fixed, len(frames) - n_valid - n_fixed))
+        self.demod_time.observe(time.perf_counter() - start)
+        return FrameBatch(times[full][keep], frames[keep], corrected[keep], signal[full][keep])
+
+    def close(self) -> None:
+        """ Stops the worker processes, if any """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def _correct_errors(self, frames: np.ndarray, syndromes: np.ndarray, corrected: np.ndarray, now: float) -> None:
+        """ Repairs (in place) frames that failed CRC, where it can be trusted. Fills in bits fixed per frame """
+        for f in frames[syndromes == 0]:
+            self.corrector.seen(int.from_bytes(f[1:4].tobytes(), 'big'), now)
+        self.corrector.expire(now)
+        for i in np.flatnonzero(syndromes != 0):
+            fixed, n_bits = self.corrector.correct(frames[i].tobytes(), int(syndromes[i]))
+            if fixed is not None:
+                frames[i] = np.frombuffer(fixed, dtype=np.uint8)
+                corrected[i] = n_bits
+
+    def _get_min_amp(self):
+        """Calculate noise floor. This code almost entirely from pyModeS"""
+        window = 200  # microseconds
+        raw = self.raw_buf.view()
+        blocks = raw[: len(raw) // window * window].reshape(-1, window)
+        if len(blocks) == 0:  # not a full window (e.g. the end of a capture), so keep the floor found so far
+            return 4 * self.noise_floor
+        if np.issubdtype(raw.dtype, np.integer):  # LUT magnitudes keep an integer floor and threshold
+            floor = int(blocks.sum(axis=1, dtype=np.uint64).min()) // window
+        else:
+            floor = float(blocks.mean(axis=1).min())
+        self.noise_floor = min(floor, self.noise_floor)
+        return 4 * self.noise_floor  # not sure how they get this, but should be ~10dB
+
+
 class Radio(BaseRadio):
     """
     Radio using the actual SDR backend
     """
-    PREAMB_KEY = [1, 0, 1, 0, 0, 0, 0, 1, 0, 1, 0, 0, 0, 0, 0, 0]  # packets always start with this code
-    BUFF_SIZE = 1024 * 200
+    PREAMB_KEY = demod.PREAMB_KEY  # packets always start with this code
+    BUFF_SIZE = Demodulator.BUFF_SIZE
+
+    def __init__(self, msg_queue: Queue, fix_bits: int = 1, keep_invalid: bool = False, drop_policy: str = 'newest',
+                 workers: int = 1, capture: Union[str, None] = None, capture_format: str = 'int16', lut: bool = False):
+        """
+        :param fix_bits: max number of bit errors to repair in frames that fail CRC (0 to disable)
+        :param keep_invalid: whether frames that fail CRC (and can't be repaired) are sent on to consumers
+        :param workers: processes to demodulate with (see ``Demodulator``)
+        :param capture: file to also write the raw samples to (see iqfile.py). Default is no capture
+        :param capture_format: `int16` or `complex64` samples in the capture
+        :param lut: whether to take the SDR's raw int16 I/Q and convert it with a magnitude lookup table instead of
+        taking complex samples
+        """
+        import adi  # only needed with the SDR attached, so file based modes work without libiio
 
-    def __init__(self, msg_queue: Queue):
         # set up SDR
         self.sdr = adi.Pluto()
         self.sdr.rx_lo = int(1090e6)  # 1090MHz
@@ -68,106 +306,158 @@ class Radio(BaseRadio):
         self.sdr.rx_rf_bandwidth = self.sdr.sample_rate
         self.sdr.gain_control_mode = 'slow_attack'
 
-        self.raw_buf = []
-        self.noise_floor = 1e6
-        super().__init__(msg_queue)
+        self.lut = lut
+        if lut and not callable(getattr(self.sdr, '_rx_buffered_data', None)):
+            raise RuntimeError(f'--lut reads int16 samples with pyadi-iio\'s _rx_buffered_data(), which pyadi-iio '
+                               f'{getattr(adi, "__version__", "(unknown version)")} does not have. Run without --lut')
+        self.demod = Demodulator(self.sdr.sample_rate, fix_bits, keep_invalid, self.BUFF_SIZE, workers, lut)
+        self.capture = None if capture is None else \
+            iqfile.IQWriter(capture, capture_format, self.sdr.sample_rate, self.sdr.rx_lo)
+        super().__init__(msg_queue, drop_policy)
 
-    def recv(self):
-        raw = self.sdr.rx()
-        self.raw_buf.extend(np.absolute(raw).tolist())
+    def recv(self) -> FrameBatch:
+        samples = self._rx_int16() if self.lut else self.sdr.rx()
+        if self.capture is not None:
+            self.capture.write(samples)
+        self.demod.write(samples)
 
-        if len(self.raw_buf) > self.BUFF_SIZE:
+        if self.demod.ready():
             return self.handle_raw()
-        return []
+        return FrameBatch.empty()
 
-    def handle_raw(self) -> List[Message]:
-        """ Runs through message buffer to find valid messages """
-        min_amp = self._get_min_amp()
-        msgs = []
-        i = 0
-        while i < len(self.raw_buf):
-            if self.raw_buf[i] < min_amp:
-                # print(f'BELOW AMP: {self.raw_buf[i]} < {min_amp}')
-                i += 1
-            elif self.is_preamble(self.raw_buf[i:i + len(Radio.PREAMB_KEY)]):
-                # print('PREAMB' * 25)
-                start = i + len(self.PREAMB_KEY)
-                end = start + (MSG_LEN + 1) * 2  # multiply by 2 since one bit == two values
-                msg = Message.from_raw(self.raw_buf[start:end])
-                msgs.append(msg)
-                i = end
-            else:
-                i += 1
-        self.raw_buf = self.raw_buf[i:]
-        return msgs
+    def _rx_int16(self) -> np.ndarray:
+        """
+        Reads a buffer as (N, 2) int16 I/Q pairs. These are the channels ``rx()`` would combine into complex.
+        pyadi-iio has no public way to get them, so this uses its internal read (checked for in ``__init__()``) and
+        checks what comes back, so a change to it fails clearly instead of giving garbage magnitudes
+        """
+        channels = self.sdr._rx_buffered_data()
+        if len(channels) != 2 or any(np.asarray(c).dtype != np.int16 for c in channels):
+            raise RuntimeError('pyadi-iio\'s _rx_buffered_data() no longer gives int16 I and Q channels, so --lut '
+                               'can\'t be used with this version. Run without --lut')
+        i, q = channels
+        iq = np.empty((len(i), 2), dtype=np.int16)
+        iq[:, 0], iq[:, 1] = i, q
+        return iq
 
-    def _get_min_amp(self):
-        """Calculate noise floor. This code almost entirely from pyModeS"""
-        window = 200  # microseconds
-        total_len = len(self.raw_buf)
-        means = (
-            np.array(self.raw_buf[: total_len // window * window])
-                .reshape(-1, window)
-                .mean(axis=1)
-        )
-        self.noise_floor = min(min(means), self.noise_floor)
-        return 4 * self.noise_floor  # not sure how they get this, but should be ~10dB
+    def handle_raw(self) -> FrameBatch:
+        """ Runs through message buffer to find valid messages (see ``Demodulator.process()``) """
+        return self.demod.process()
 
     @staticmethod
     def is_preamble(data) -> bool:
         """Returns true if the given data is a valid preamble to a message"""
-        if len(data) < 16:
+        if len(data) < demod.PREAMB_LEN:
             return False
-        # set cut-off for 0/1 between minimum and maximum values in data
-        thresh = min(data) + ((max(data) - min(data)) / 2)
-        normed = [1 if b >= thresh else 0 for b in data]
-        # print(f'NORMED PREAMB: {normed}')
-        for i, b in enumerate(Radio.PREAMB_KEY):
-            if normed[i] != b:
-                return False
-        return True
+        return bool(demod.match_preambles(np.asarray(data[:demod.PREAMB_LEN])[None])[0])
+
+
+class IQFileRadio(BaseRadio):
+    """
+    'Radio' that demodulates a raw IQ capture (see iqfile.py) instead of live samples.
+    The capture is memory mapped and handed to the demodulator in chunks straight from the map
+    """
+    CHUNK = 1 << 16  # samples a recv() reads. About 30ms at 2MSPS
+
+    def __init__(self, msg_queue: Queue, in_file: str, realtime: bool = True, init_delay: float = 1,
+                 fix_bits: int = 1, keep_invalid: bool = False, drop_policy: str = 'newest', workers: int = 1,
+                 lut: bool = False):
+        """
+        :param in_file: capture to read
+        :param realtime: whether to read samples at the rate they were captured. Otherwise the capture is read as
+        fast as it can be demodulated. Frames are timestamped with the time they're read in real time, and with the
+        time they were captured otherwise
+        :param init_delay: how long to wait initially before samples are read (real time only)
+        :param lut: whether to demodulate uint16 magnitudes from a lookup table, like ``Radio``
+        """
+        self.reader = iqfile.IQReader(in_file)
+        self.realtime = realtime
+        self.chunks = self.reader.chunks(self.CHUNK)
+        self.done = False
+        self.demod = Demodulator(self.reader.sample_rate, fix_bits, keep_invalid, workers=workers, lut=lut)
+        self.init_time = time.time() + init_delay
+        super().__init__(msg_queue, drop_policy)
+
+    def recv(self) -> Union[FrameBatch, None]:
+        if self.done:
+            return None
+        first, samples = next(self.chunks, (len(self.reader), None))
+        end = first + (0 if samples is None else len(samples))  # samples read so far
+        if self.realtime:
+            wait = self.init_time + end / self.reader.sample_rate - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            now = time.time()
+        else:
+            now = self.reader.start_time + end / self.reader.sample_rate
+
+        if samples is None:  # end of the capture, so whatever is left in the buffer gets processed
+            self.done = True
+            print('File EOF')
+            if len(self.demod.raw_buf) < FRAME_SAMPLES:  # too short to hold a frame
+                return FrameBatch.empty()
+            return self.demod.process(now)
+        self.demod.write(samples)
+        if self.demod.ready():
+            return self.demod.process(now)
+        return FrameBatch.empty()
 
 
 class MockRadio(BaseRadio):
     """
-    'Radio' that reads messages from a file instead
+    'Radio' that reads messages from a file instead. Binary recordings are memory mapped and stepped through with a
+    cursor, so a recording of any size costs the same memory
     """
 
-    def __init__(self, msg_queue, in_file, repeat=True, repeat_delay=1, init_delay=1):
+    def __init__(self, msg_queue, in_file, repeat=True, repeat_delay=1, init_delay=1, drop_policy='newest',
+                 start: Union[float, None] = None, end: Union[float, None] = None):
         """
 
-        :param in_file: file of messages. Lines starting with `#` are ignored. Each line should be `timestamp binary_msg`
+        :param in_file: file of messages. Either a binary recording (see recording.py) or a text file. In text files
+        lines starting with `#` are ignored. Each line should be `timestamp binary_msg`
         :param repeat: whether radio should repeat file messages in a loop
         :param repeat_delay: wait in seconds before repeat starts
         :param init_delay: how long to wait initially before messages are sent
+        :param start: unix time to start sending from. Recordings seek to it through their index
+        :param end: unix time to stop sending at
         """
-        self.msgs = []
-        self.next_msg = 0
+        if recording.is_recording(in_file):
+            self.records = recording.RecordReader(in_file).window(start, end)
+        else:
+            records = recording.read_text(in_file)
+            lo = 0 if start is None else np.searchsorted(records['time_us'], round(start * 1e6))
+            hi = len(records) if end is None else np.searchsorted(records['time_us'], round(end * 1e6))
+            self.records = records[lo:hi]
+        self.cursor = 0  # next record to send
         self.should_repeat = repeat
         self.repeat_delay = repeat_delay
         self.stop_send = False
-        with open(in_file, 'r') as inp:
-            rel_start = None
-            for m in inp.readlines():
-                if not m.startswith('#'):
-                    ts, m = m.strip().split(' ')
-                    if rel_start is None:
-                        rel_start = int(ts)
-                    self.msgs.append((int(ts) - rel_start, Message(m.strip())))
-        self.init_time = round(time.time()) + init_delay
-        super().__init__(msg_queue)
-
-    def recv(self) -> List[Message]:
-        curr_time = round(time.time())
-        if not self.stop_send and curr_time - self.init_time >= self.msgs[self.next_msg][0]:
-            msg = self.msgs[self.next_msg][1]
-            if self.next_msg == len(self.msgs) - 1:
-                if not self.should_repeat:
-                    self.stop_send = True
-                    print('File EOF')
-                else:
-                    self.init_time = curr_time + self.repeat_delay
-            self.next_msg = (self.next_msg + 1) % len(self.msgs)
-
-            return [msg]
-        return []
+        self.init_time = time.time() + init_delay
+        super().__init__(msg_queue, drop_policy)
+
+    def _due(self, i: int) -> float:
+        """ Seconds after init_time that record i is sent at """
+        return (int(self.records['time_us'][i]) - int(self.records['time_us'][0])) / 1e6
+
+    def recv(self) -> Union[FrameBatch, None]:
+        """ Sleeps until the next message is due, then returns every message that is due """
+        if self.stop_send or len(self.records) == 0:
+            return None
+        wait = self.init_time + self._due(self.cursor) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        curr_time = time.time()
+        due_us = int(self.records['time_us'][0]) + int((curr_time - self.init_time) * 1e6)
+        end = self.cursor + int(np.searchsorted(self.records['time_us'][self.cursor:], due_us, side='right'))
+        recs = self.records[self.cursor:max(end, self.cursor + 1)]
+        self.cursor += len(recs)
+        if self.cursor == len(self.records):
+            if not self.should_repeat:
+                self.stop_send = True
+                print('File EOF')
+            else:
+                self.init_time = curr_time + self.repeat_delay  # the next pass is timed from here
+            self.cursor = 0
+        return FrameBatch(np.full(len(recs), curr_time), np.array(recs['frame']),
+                          np.zeros(len(recs), dtype=np.uint8), recs['signal'].astype(np.uint16))
@@ -0,0 +1,241 @@
+import os
+import time
+import numpy as np
+from typing import Iterator, Tuple, Union
+
+from utils import MSG_LEN, iter_msg_file, bin2bytes, bytes2bin
+
+MAGIC = b'A522REC\x00'
+VERSION = 1
+HEADER_BYTES = 16  # magic, version, record size, padding
+RECORD = np.dtype([('time_us', '<u8'), ('frame', 'u1', (MSG_LEN // 8,)), ('signal', '<u2')])
+INDEX = np.dtype([('time_us', '<u8'), ('record', '<u8')])
+INDEX_EVERY = 1024  # records between index entries
+EXTENSION = '.a522'
+
+
+def _header() -> bytes:
+    return MAGIC + VERSION.to_bytes(2, 'little') + RECORD.itemsize.to_bytes(2, 'little') + bytes(4)
+
+
+def is_recording(path: str) -> bool:
+    """ Whether a file is in the binary recording format (as opposed to the text format) """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class RecordWriter:
+    """
+    Writes frames in the binary recording format: a 16 byte header followed by fixed-size records of a microsecond
+    timestamp, the 14 byte frame and the signal level. Writes are buffered and files can rotate by size or age.
+    Each file gets a sparse timestamp index (``<file>.idx``) when it's closed so readers can seek by time
+    """
+
+    def __init__(self, path: str, buffer_bytes: int = 1 << 20, max_bytes: Union[int, None] = None,
+                 max_seconds: Union[float, None] = None):
+        """
+        :param path: file to write. With rotation, each file is named after this with its start time added
+        :param buffer_bytes: bytes buffered before writing to disk
+        :param max_bytes: rotate once a file is this big
+        :param max_seconds: rotate once a file is this old
+        """
+        self.path = path
+        self.buffer_bytes = buffer_bytes
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._buf = bytearray()
+        self._file = None
+        self._file_path = None
+        self._opened = None
+        self._records = 0
+        self._index = []
+
+    def write(self, times: np.ndarray, frames: np.ndarray, signal: Union[np.ndarray, None] = None) -> None:
+        """
+        Adds a batch of frames
+        :param times: (N,) unix time of each frame in seconds
+        :param frames: (N, 14) uint8 frames
+        :param signal: (N,) signal level of each frame
+        """
+        if len(times) == 0:
+            return
+        if self._file is None or self._should_rotate():
+            self._rotate()
+        recs = np.empty(len(times), dtype=RECORD)
+        recs['time_us'] = np.round(np.asarray(times) * 1e6)
+        recs['frame'] = frames
+        recs['signal'] = 0 if signal is None else np.clip(signal, 0, 0xFFFF)
+
+        first = -self._records % INDEX_EVERY  # position of the next indexed record in this batch
+        for i in range(first, len(recs), INDEX_EVERY):
+            self._index.append((int(recs['time_us'][i]), self._records + i))
+        self._records += len(recs)
+        self._buf += recs.tobytes()
+        if len(self._buf) >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._file is not None and len(self._buf) > 0:
+            self._file.write(self._buf)
+            self._buf = bytearray()
+            self._file.flush()
+
+    def close(self) -> None:
+        """ Flushes and closes the current file and writes its index """
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        np.array(self._index, dtype=INDEX).tofile(self._file_path + '.idx')
+        self._file = None
+
+    def _should_rotate(self) -> bool:
+        if self.max_bytes is not None and HEADER_BYTES + self._records * RECORD.itemsize >= self.max_bytes:
+            return True
+        return self.max_seconds is not None and time.time() - self._opened >= self.max_seconds
+
+    def _rotate(self) -> None:
+        self.close()
+        self._opened = time.time()
+        if self.max_bytes is None and self.max_seconds is None:
+            self._file_path = self.path
+        else:
+            root, ext = os.path.splitext(self.path)
+            stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self._opened))
+            self._file_path = f'{root}-{stamp}{ext or EXTENSION}'
+            n = 1
+            while os.path.exists(self._file_path):  # rotated more than once in a second
+                # `_` sorts after the `.` of the first file's extension and the padding keeps 10 after 9, so the
+                # files sort in the order they were written
+                self._file_path = f'{root}-{stamp}_{n:04d}{ext or EXTENSION}'
+                n += 1
+        self._file = open(self._file_path, 'wb')
+        if os.path.exists(self._file_path + '.idx'):  # left from an earlier recording to the same path
+            os.remove(self._file_path + '.idx')
+        self._file.write(_header())
+        self._records = 0
+        self._index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RecordReader:
+    """ Reads a binary recording through a memory map. Nothing is loaded until it's used """
+
+    def __init__(self, path: str):
+        if not is_recording(path):
+            raise ValueError(f'{path} is not a binary recording')
+        self.path = path
+        size = os.path.getsize(path) - HEADER_BYTES
+        n_records = size // RECORD.itemsize
+        self.records = np.memmap(path, dtype=RECORD, mode='r', offset=HEADER_BYTES, shape=(n_records,)) \
+            if n_records > 0 else np.empty(0, dtype=RECORD)
+        self.index = self._load_index()
+
+    def _load_index(self) -> np.ndarray:
+        idx_path = self.path + '.idx'
+        rows = np.arange(0, len(self.records), INDEX_EVERY)
+        if os.path.exists(idx_path):
+            idx = np.fromfile(idx_path, dtype=INDEX)
+            if self._index_matches(idx, rows):
+                return idx
+        # writer didn't close the file (e.g. it crashed) or the index is for other records, so build it from them
+        idx = np.empty(len(rows), dtype=INDEX)
+        idx['time_us'] = self.records['time_us'][rows]
+        idx['record'] = rows
+        return idx
+
+    def _index_matches(self, idx: np.ndarray, rows: np.ndarray) -> bool:
+        """ Whether an index has an entry every INDEX_EVERY records and spans the same times as the records """
+        if len(idx) != len(rows) or not np.array_equal(idx['record'], rows):
+            return False
+        if len(idx) == 0:
+            return True
+        return bool(np.all(np.diff(idx['time_us'].astype(np.int64)) >= 0)
+                    and idx['time_us'][0] == self.records['time_us'][0]
+                    and idx['time_us'][-1] == self.records['time_us'][rows[-1]])
+
+    def __len__(self):
+        return len(self.records)
+
+    def _find(self, time_us: int) -> int:
+        """ First record at or after time_us. The index narrows it down to one block which is then searched """
+        block = np.searchsorted(self.index['time_us'], time_us, side='right') - 1
+        lo = int(self.index['record'][block]) if block >= 0 else 0
+        hi = int(self.index['record'][block + 1]) if block + 1 < len(self.index) else len(self.records)
+        return lo + int(np.searchsorted(self.records['time_us'][lo:hi], time_us))
+
+    def window(self, start: Union[float, None] = None, end: Union[float, None] = None) -> np.ndarray:
+        """
+        Records from start (inclusive) to end (exclusive), as a view into the file
+        :param start: unix time in seconds. Default is the first record
+        :param end: unix time in seconds. Default is after the last record
+        """
+        lo = 0 if start is None else self._find(int(round(start * 1e6)))
+        hi = len(self.records) if end is None else self._find(int(round(end * 1e6)))
+        return self.records[lo:hi]
+
+    def __iter__(self) -> Iterator[Tuple[float, bytes]]:
+        """ Yields (unix time, frame bytes) """
+        for rec in self.records:
+            yield rec['time_us'] / 1e6, rec['frame'].tobytes()
+
+
+def iter_frames(path: str) -> Iterator[Tuple[float, Union[str, bytes]]]:
+    """
+    Yields (timestamp, frame) from either file format. Frames are binary strings for text files and bytes for
+    binary recordings. Either can be passed straight to ``Message``
+    """
+    if is_recording(path):
+        yield from RecordReader(path)
+    else:
+        yield from iter_msg_file(path)
+
+
+def read_text(text_path: str) -> np.ndarray:
+    """
+    Parses a text message file into records, in memory (text files are small). Lines that aren't full frames are
+    skipped and signal levels are 0
+    """
+    times, frames = [], []
+    for ts, m in iter_msg_file(text_path):
+        if len(m) == MSG_LEN:
+            times.append(ts)
+            frames.append(bin2bytes(m))
+    recs = np.zeros(len(times), dtype=RECORD)
+    recs['time_us'] = np.array(times, dtype=np.uint64) * 1000000
+    recs['frame'] = np.frombuffer(b''.join(frames), dtype=np.uint8).reshape(-1, MSG_LEN // 8)
+    return recs
+
+
+def text_to_binary(text_path: str, bin_path: str) -> int:
+    """ Converts a text message file into a binary recording. Lines that aren't full frames are skipped """
+    recs = read_text(text_path)
+    with RecordWriter(bin_path) as writer:
+        writer.write(recs['time_us'] / 1e6, recs['frame'])
+    return len(recs)
+
+
+def binary_to_text(bin_path: str, text_path: str) -> int:
+    """ Converts a binary recording into the text format. Timestamps are rounded to seconds """
+    reader = RecordReader(bin_path)
+    with open(text_path, 'w') as out:
+        for ts, frame in reader:
+            out.write(f'{round(ts)} {bytes2bin(frame)}\n')
+    return len(reader)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Converts between the text and binary recording formats')
+    parser.add_argument('input', help='File to convert. Format is detected automatically')
+    parser.add_argument('output', help='File to write')
+    args = parser.parse_args()
+    if is_recording(args.input):
+        print(f'Wrote {binary_to_text(args.input, args.output)} frames to {args.output}')
+    else:
+        print(f'Wrote {text_to_binary(args.input, args.output)} frames to {args.output}')
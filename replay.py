@@ -0,0 +1,138 @@
+import os
+import time
+from glob import glob
+from multiprocessing import Pool
+from typing import List, Dict, Iterable, Union
+
+import utils
+from recording import iter_frames, EXTENSION
+from message import Message
+from data_handler import DataPoint, DataHandler
+from cpr import PositionDecoder
+
+
+class AircraftSummary:
+    """ What was seen of a single aircraft over a replay """
+
+    def __init__(self, icao: str):
+        self.icao = icao
+        self.count = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.attrs: Dict[str, DataPoint] = {}
+
+    def add(self, ts: float, msg: Message) -> None:
+        """ Adds a valid message sent at ts """
+        self.count += 1
+        if self.first_seen is None:
+            self.first_seen = ts
+        self.last_seen = ts
+        self.attrs.update(msg.data)
+
+    def merge(self, other: 'AircraftSummary') -> None:
+        """ Merges in the summary of the same aircraft from another file. Latest attributes win """
+        if self.last_seen is None or (other.last_seen is not None and other.last_seen >= self.last_seen):
+            self.attrs.update(other.attrs)
+        else:
+            self.attrs = {**other.attrs, **self.attrs}
+        self.count += other.count
+        self.first_seen = min(t for t in (self.first_seen, other.first_seen) if t is not None)
+        self.last_seen = max(t for t in (self.last_seen, other.last_seen) if t is not None)
+
+    def __str__(self):
+        return f'{self.icao}: {self.count} msgs ({self.first_seen} - {self.last_seen})\n' \
+               f'\tDATA={list(self.attrs.values())}'
+
+
+class ReplayResult:
+    """ Per-aircraft summaries and decode statistics of one or more replayed files """
+
+    def __init__(self):
+        self.aircraft: Dict[str, AircraftSummary] = {}
+        self.stats = {'files': 0, 'frames': 0, 'valid': 0, 'invalid': 0, 'seconds': 0.0, 'cache_hits': 0,
+                      'cache_misses': 0}
+        self.types: Dict[str, int] = {}
+
+    def add(self, ts: int, msg: Message) -> None:
+        self.stats['frames'] += 1
+        if not msg.valid:
+            self.stats['invalid'] += 1
+            return
+        self.stats['valid'] += 1
+        self.types[msg.type.name] = self.types.get(msg.type.name, 0) + 1
+        if msg.icao not in self.aircraft:
+            self.aircraft[msg.icao] = AircraftSummary(msg.icao)
+        self.aircraft[msg.icao].add(ts, msg)
+
+    def merge(self, other: 'ReplayResult') -> None:
+        for key, val in other.stats.items():
+            self.stats[key] += val
+        for key, val in other.types.items():
+            self.types[key] = self.types.get(key, 0) + val
+        for icao, craft in other.aircraft.items():
+            if icao in self.aircraft:
+                self.aircraft[icao].merge(craft)
+            else:
+                self.aircraft[icao] = craft
+
+    def __str__(self):
+        rate = self.stats['frames'] / self.stats['seconds'] if self.stats['seconds'] > 0 else 0
+        lines = [str(c) for c in sorted(self.aircraft.values(), key=lambda c: c.count, reverse=True)]
+        lines.append(f"{self.stats['files']} files, {self.stats['frames']} frames ({self.stats['valid']} valid, "
+                     f"{self.stats['invalid']} invalid), {len(self.aircraft)} aircraft. "
+                     f"{self.stats['seconds']:.2f}s of decode time ({rate:.0f} frames/s)")
+        lookups = self.stats['cache_hits'] + self.stats['cache_misses']
+        lines.append(f"Decode cache hit rate: {self.stats['cache_hits'] / lookups if lookups else 0:.2%}")
+        lines.append(f'Types: {self.types}')
+        return '\n'.join(lines)
+
+
+def expand_inputs(inputs: Iterable[str]) -> List[str]:
+    """ Turns a list of files and directories into a list of files. Directories give their text and binary files """
+    files = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            files.extend(sorted(glob(os.path.join(inp, '*.txt')) + glob(os.path.join(inp, f'*{EXTENSION}'))))
+        else:
+            files.append(inp)
+    return files
+
+
+def decode_file(path: str) -> ReplayResult:
+    """ Decodes every message in a file as fast as possible (no timing) """
+    result = ReplayResult()
+    hits, misses = DataHandler.cache.hits, DataHandler.cache.misses
+    DataHandler.positions = PositionDecoder()  # timestamps restart with each file
+    start = time.perf_counter()
+    for ts, m in iter_frames(path):
+        msg = Message(m)
+        msg.timestamp = ts
+        result.add(ts, msg)
+    result.stats['files'] = 1
+    result.stats['seconds'] = time.perf_counter() - start
+    result.stats['cache_hits'] = DataHandler.cache.hits - hits
+    result.stats['cache_misses'] = DataHandler.cache.misses - misses
+    return result
+
+
+def _init_worker(ref_lat: Union[float, None], ref_lon: Union[float, None]) -> None:
+    """ Workers don't share globals with the main process, so the reference location is set again """
+    utils.REF_LAT, utils.REF_LON = ref_lat, ref_lon
+
+
+def decode_files(paths: List[str], workers: int = None) -> ReplayResult:
+    """
+    Decodes many files, spread across a pool of processes, and merges the results
+    :param paths: files to decode
+    :param workers: number of processes. Default is one per CPU. 1 decodes in this process
+    """
+    result = ReplayResult()
+    if workers == 1 or len(paths) <= 1:
+        for p in paths:
+            result.merge(decode_file(p))
+        return result
+
+    with Pool(workers, initializer=_init_worker, initargs=(utils.REF_LAT, utils.REF_LON)) as pool:
+        for res in pool.imap(decode_file, paths):
+            result.merge(res)
+    return result
@@ -0,0 +1,123 @@
+import os
+import numpy as np
+from glob import glob
+from typing import Iterable, NamedTuple, Tuple, Union
+
+import demod
+import iqfile
+from recording import iter_frames
+from utils import MSG_LEN, bin2bytes
+
+SAMPLE_RATE = 2e6  # same as the radio
+FRAME_SAMPLES = demod.PREAMB_LEN + MSG_LEN * 2  # preamble and 2 samples a bit
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class Synthetic(NamedTuple):
+    """ A synthesized stream and where the frames were put in it """
+    samples: np.ndarray  # complex64 IQ or float32 magnitudes
+    starts: np.ndarray  # (N,) sample each frame's preamble starts at
+    frames: np.ndarray  # (N, 14) uint8 frames, in the order they were sent
+
+
+def load_frames(paths: Union[Iterable[str], None] = None) -> np.ndarray:
+    """
+    Reads the full length frames from message files (text or binary recordings)
+    :param paths: files to read. Default is every file in data/
+    :return: (N, 14) uint8 array
+    """
+    if paths is None:
+        paths = sorted(glob(os.path.join(DATA_DIR, '*.txt')))
+    frames = []
+    for path in paths:
+        for _, m in iter_frames(path):
+            if isinstance(m, bytes):
+                frames.append(m)
+            elif len(m) == MSG_LEN:
+                frames.append(bin2bytes(m))
+    return np.frombuffer(b''.join(frames), dtype=np.uint8).reshape(-1, MSG_LEN // 8)
+
+
+def modulate(frames: np.ndarray) -> np.ndarray:
+    """
+    Pulse shapes of frames: the preamble then each bit as (high, low) for a 1 and (low, high) for a 0
+    :param frames: (N, 14) uint8 frames
+    :return: (N, FRAME_SAMPLES) float32 array of 0s and 1s
+    """
+    bits = np.unpackbits(frames, axis=1)
+    pulses = np.empty((len(frames), FRAME_SAMPLES), dtype=np.float32)
+    pulses[:, :demod.PREAMB_LEN] = demod.PREAMB_KEY
+    pulses[:, demod.PREAMB_LEN::2] = bits
+    pulses[:, demod.PREAMB_LEN + 1::2] = 1 - bits
+    return pulses
+
+
+def _starts(n_frames: int, n_samples: int, overlap: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Frame start positions. Gaps are random with the mean needed to fit n_frames. A fraction (``overlap``) of frames
+    start inside the previous one, the rest leave at least 2 quiet samples after it
+    """
+    spacing = n_samples / max(n_frames, 1)
+    gaps = FRAME_SAMPLES + 2 + rng.exponential(max(spacing - FRAME_SAMPLES - 2, 1), n_frames)
+    overlapped = rng.random(n_frames) < overlap
+    gaps[overlapped] = rng.integers(1, FRAME_SAMPLES, overlapped.sum())
+    starts = np.cumsum(gaps).astype(np.int64) - int(gaps[0]) + rng.integers(0, max(int(spacing), 1))
+    return starts[starts + FRAME_SAMPLES <= n_samples]
+
+
+def synthesize(frames: np.ndarray, seconds: float = 1.0, rate: float = 1000, noise: float = 20,
+               amplitude: Tuple[float, float] = (200, 2000), overlap: float = 0.0, iq: bool = False,
+               sample_rate: float = SAMPLE_RATE, seed: Union[int, None] = None) -> Synthetic:
+    """
+    Builds a stream of samples like the radio gives, with frames sent at random times
+    :param frames: (N, 14) uint8 frames to pick from (see ``load_frames()``)
+    :param seconds: length of the stream
+    :param rate: average frames a second
+    :param noise: standard deviation of the complex noise added to every sample
+    :param amplitude: range each frame's amplitude is picked from. The defaults are roughly what the Pluto gives
+    :param overlap: fraction of frames that start inside the previous frame
+    :param iq: whether to give complex IQ samples instead of magnitudes
+    :param sample_rate: samples per second
+    :param seed: random seed, for repeatable streams
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(seconds * sample_rate)
+    starts = _starts(int(seconds * rate), n_samples, overlap, rng)
+    sent = frames[rng.integers(0, len(frames), len(starts))]
+
+    # each frame gets its own amplitude and carrier phase so overlapping frames interfere like they would on air
+    gain = rng.uniform(amplitude[0], amplitude[1], len(starts)) * np.exp(2j * np.pi * rng.random(len(starts)))
+    signal = modulate(sent) * gain[:, None]
+    samples = (rng.normal(0, noise / np.sqrt(2), (n_samples, 2)).astype(np.float32)).view(np.complex64)[:, 0]
+    np.add.at(samples, (starts[:, None] + np.arange(FRAME_SAMPLES)).ravel(), signal.ravel())
+    return Synthetic(samples if iq else np.absolute(samples), starts, sent)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Synthesizes a 2 MSPS stream from recorded frames')
+    parser.add_argument('output', help='File to write the samples to. Written as an IQ capture (see iqfile.py) '
+                                       'unless it ends in .npy')
+    parser.add_argument('-i', '--input', nargs='+', default=None, help='Message files to take frames from. '
+                                                                       'Default is everything in data/')
+    parser.add_argument('-s', '--seconds', type=float, default=1.0, help='Length of the stream. Default is 1')
+    parser.add_argument('-r', '--rate', type=float, default=1000, help='Average frames a second. Default is 1000')
+    parser.add_argument('--noise', type=float, default=20, help='Noise standard deviation. Default is 20')
+    parser.add_argument('--amplitude', type=float, nargs=2, default=(200, 2000), metavar=('MIN', 'MAX'),
+                        help='Range of frame amplitudes. Default is 200 2000')
+    parser.add_argument('--overlap', type=float, default=0.0,
+                        help='Fraction of frames that overlap the previous one. Default is 0')
+    parser.add_argument('--iq', action='store_true', help='Write complex IQ samples instead of magnitudes (.npy)')
+    parser.add_argument('--format', choices=iqfile.FORMATS, default='int16', help='Sample format of IQ captures')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    args = parser.parse_args()
+
+    to_npy = args.output.endswith('.npy')
+    synth = synthesize(load_frames(args.input), args.seconds, args.rate, args.noise, tuple(args.amplitude),
+                       args.overlap, args.iq or not to_npy, seed=args.seed)
+    if to_npy:
+        np.save(args.output, synth.samples)
+    else:
+        with iqfile.IQWriter(args.output, args.format, SAMPLE_RATE) as writer:
+            writer.write(synth.samples)
+    print(f'Wrote {len(synth.samples)} samples holding {len(synth.starts)} frames to {args.output}')
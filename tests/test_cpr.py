@@ -0,0 +1,66 @@
+import glob
+import os
+
+import numpy as np
+
+import batch_decode
+import cpr
+from data_handler import get_bits
+from utils import MSG_LEN, bin2bytes, iter_msg_file
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+# example from https://mode-s.org/decode/adsb/airborne-position.html
+EVEN = bytes.fromhex('8D40621D58C382D690C8AC2863A7')
+ODD = bytes.fromhex('8D40621D58C386435CC412692AD6')
+
+
+def _cpr(frame: bytes):
+    """ (is_odd, lat_cpr, lon_cpr) of an airborne position frame, with the cpr values scaled to [0, 1) """
+    data = int.from_bytes(frame[4:11], 'big') & ((1 << 51) - 1)
+    return get_bits(data, 16, 17) == 1, get_bits(data, 17, 34) / cpr.CPR_MAX, get_bits(data, 34, 51) / cpr.CPR_MAX
+
+
+def test_nl_matches_formula():
+    for lat in np.linspace(-89.9, 89.9, 2000):
+        a = 1 - np.cos(np.pi / (2 * cpr.NZ))
+        expected = 1 if abs(lat) >= 87 else int(np.floor(2 * np.pi / np.arccos(1 - a / np.cos(np.pi / 180 * lat) ** 2)))
+        assert cpr.nl(lat) == expected
+
+
+def test_global():
+    even, odd = _cpr(EVEN)[1:], _cpr(ODD)[1:]
+    lat, lon = cpr.decode_global(even, odd, odd_latest=False)
+    assert (round(lat, 5), round(lon, 5)) == (52.25720, 3.91937)
+    # the latitude comes from whichever frame is newer, so it's slightly different with the odd one
+    lat, lon = cpr.decode_global(even, odd, odd_latest=True)
+    assert round(lat, 5) == 52.26578
+
+
+def test_local():
+    lat, lon = cpr.decode_local(*_cpr(EVEN), 52.258, 3.918)
+    assert (round(lat, 5), round(lon, 5)) == (52.25720, 3.91937)
+
+
+def test_local_agrees_with_global():
+    decoder = cpr.PositionDecoder()
+    assert decoder.decode('40621D', *_raw(ODD), 0) is None
+    lat, lon = decoder.decode('40621D', *_raw(EVEN), 1)
+    assert (round(lat, 5), round(lon, 5)) == (52.25720, 3.91937)
+    # after the pair, frames are decoded locally against the aircraft's last position
+    assert decoder.decode('40621D', *_raw(ODD), 2) == cpr.decode_local(*_cpr(ODD), lat, lon)
+
+
+def _raw(frame: bytes):
+    is_odd, lat_cpr, lon_cpr = _cpr(frame)
+    return is_odd, round(lat_cpr * cpr.CPR_MAX), round(lon_cpr * cpr.CPR_MAX)
+
+
+def test_batch_local_matches_scalar():
+    frames = [bin2bytes(m) for path in glob.glob(os.path.join(DATA, '*.txt')) for _, m in iter_msg_file(path)
+              if len(m) == MSG_LEN]
+    frames = [f for f in frames if 9 <= f[4] >> 3 <= 18]
+    assert len(frames) > 0
+    parts = np.array([_cpr(f) for f in frames])
+    lat, lon = batch_decode.decode_local(parts[:, 0].astype(bool), parts[:, 1], parts[:, 2], 40.25, -111.65)
+    expected = np.array([cpr.decode_local(bool(o), la, lo, 40.25, -111.65) for o, la, lo in parts])
+    assert np.array_equal(lat, expected[:, 0]) and np.array_equal(lon, expected[:, 1])
@@ -0,0 +1,62 @@
+import glob
+import os
+
+import numpy as np
+
+import crc
+from utils import MSG_LEN, bin2bytes, iter_msg_file
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+CHECK_GEN = '1111111111111010000001001'
+
+
+def _bitwise_valid(bin_msg: str) -> bool:
+    """ The bit by bit long division Message._is_valid used before the table """
+    msg = list(bin_msg)
+    while '1' in msg[:88]:
+        shift = msg.index('1')
+        for i in range(len(CHECK_GEN)):
+            msg[shift + i] = str(int(CHECK_GEN[i] != msg[shift + i]))
+    return '1' not in msg[88:]
+
+
+def _frames() -> list:
+    """ Every full frame in data/, plus copies with 1 or 2 bits flipped """
+    frames = [m for path in glob.glob(os.path.join(DATA, '*.txt')) for _, m in iter_msg_file(path) if len(m) == MSG_LEN]
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        bits = list(frames[rng.integers(len(frames))])
+        for p in rng.integers(0, MSG_LEN, rng.integers(1, 3)):
+            bits[p] = '1' if bits[p] == '0' else '0'
+        frames.append(''.join(bits))
+    return frames
+
+
+def test_table_matches_bitwise():
+    frames = _frames()
+    expected = [_bitwise_valid(m) for m in frames]
+    assert any(expected) and not all(expected)
+    assert [crc.syndrome(bin2bytes(m)) == 0 for m in frames] == expected
+    array = np.array([list(bin2bytes(m)) for m in frames], dtype=np.uint8)
+    assert (crc.syndromes(array) == 0).tolist() == expected
+
+
+def test_repairs_need_a_known_icao():
+    frame = bin2bytes(next(iter_msg_file(os.path.join(DATA, 'cap.txt')))[1])
+    corrector = crc.ErrorCorrector(2)
+    broken = (int.from_bytes(frame, 'big') ^ (1 << (MSG_LEN - 1 - 50))).to_bytes(len(frame), 'big')
+    assert corrector.correct(broken, crc.syndrome(broken)) == (None, 0)
+
+    corrector.seen(int.from_bytes(frame[1:4], 'big'), 0)
+    rng = np.random.default_rng(1)
+    for _ in range(100):
+        val = int.from_bytes(frame, 'big')
+        flipped = rng.choice(range(5, MSG_LEN), rng.integers(1, 3), replace=False).tolist()
+        for p in flipped:
+            val ^= 1 << (MSG_LEN - 1 - p)
+        broken = val.to_bytes(len(frame), 'big')
+        fixed, n_bits = corrector.correct(broken, crc.syndrome(broken))
+        if len(flipped) == 1:
+            assert (fixed, n_bits) == (frame, 1)
+        else:  # ambiguous 2 bit syndromes are left out of the table, so some can't be repaired
+            assert fixed in (None, frame)
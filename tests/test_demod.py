@@ -0,0 +1,97 @@
+import numpy as np
+
+import demod
+from utils import MSG_LEN
+
+
+# the per-sample loop the vectorized demodulator replaced (Radio.handle_raw, is_preamble and Message.raw2bin)
+def _is_preamble(data) -> bool:
+    if len(data) < demod.PREAMB_LEN:
+        return False
+    thresh = min(data) + ((max(data) - min(data)) / 2)
+    return all((1 if b >= thresh else 0) == k for b, k in zip(data, demod.PREAMB_KEY))
+
+
+def _raw2bin(raw) -> str:
+    if len(raw) == 0:
+        return ''
+    thresh = max(raw) * .2
+    msg = ''
+    for i in range(0, len(raw), 2):
+        if i + 1 >= len(raw) or (raw[i] < thresh and raw[i + 1] < thresh):
+            break
+        msg += '1' if raw[i] >= raw[i + 1] else '0'
+    return msg
+
+
+def _loop_demod(buf: list, min_amp: float) -> list:
+    msgs = []
+    i = 0
+    while i < len(buf):
+        if buf[i] < min_amp:
+            i += 1
+        elif _is_preamble(buf[i:i + demod.PREAMB_LEN]):
+            start = i + demod.PREAMB_LEN
+            end = start + (MSG_LEN + 1) * 2
+            msgs.append(_raw2bin(buf[start:end]))
+            i = end
+        else:
+            i += 1
+    return msgs
+
+
+def _stream(rng: np.random.Generator, n: int, n_frames: int) -> np.ndarray:
+    """ Noise with frames (including overlapping and cut off ones) at random places """
+    buf = rng.random(n) * 0.3
+    for p in rng.integers(0, n, n_frames):
+        bits = rng.integers(0, 2, MSG_LEN)
+        frame = np.concatenate([np.array(demod.PREAMB_KEY, float), np.ravel([[b, 1 - b] for b in bits])])
+        frame = (frame * rng.uniform(1, 3))[:n - p]
+        buf[p:p + len(frame)] = frame + rng.random(len(frame)) * 0.2
+    return buf
+
+
+def test_matches_loop():
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        buf = _stream(rng, int(rng.integers(100, 6000)), int(rng.integers(0, 20)))
+        starts = demod.find_preambles(buf, 0.25)
+        assert demod.bits2str(*demod.slice_bits(buf, starts)) == _loop_demod(buf.tolist(), 0.25)
+
+
+def test_slice_matches_raw2bin():
+    rng = np.random.default_rng(2)
+    buf = _stream(rng, 3000, 10)
+    for start in rng.integers(0, len(buf), 50):
+        raw = buf[start:start + int(rng.integers(0, 230))]
+        bits, lengths = demod.slice_bits(raw, np.array([-demod.PREAMB_LEN]))
+        assert demod.bits2str(bits, lengths)[0] == _raw2bin(raw.tolist())
+
+
+def test_chunks_match_whole_buffer():
+    rng = np.random.default_rng(3)
+    buf = _stream(rng, 50000, 60)
+    whole = demod.bits2str(*demod.slice_bits(buf, demod.find_preambles(buf, 0.5)))
+
+    samples = demod.SampleBuffer(8000)
+    found = []
+    for i in range(0, len(buf), 1024):
+        samples.write(buf[i:i + 1024].astype(complex))
+        if len(samples) > 3000:
+            view = samples.view()
+            starts, done = demod.find_complete(view, 0.5)
+            found += demod.bits2str(*demod.slice_bits(view, starts))
+            samples.consume(done)
+    view = np.concatenate([samples.view(), np.zeros(300, np.float32)])
+    found += demod.bits2str(*demod.slice_bits(view, demod.find_preambles(view, 0.5)))
+    assert found == whole
+
+
+def test_lut_close_to_hypot():
+    rng = np.random.default_rng(4)
+    iq = rng.integers(-2048, 2048, (10000, 2)).astype(np.int16)
+    out = np.empty(len(iq), dtype=np.uint16)
+    demod.MAG_LUT(iq, out)
+    exact = np.hypot(iq[:, 0].astype(float), iq[:, 1])
+    step = 1 << demod.MAG_LUT.shift
+    assert np.abs(out - exact).max() <= step  # within one quantization step
@@ -0,0 +1,49 @@
+import numpy as np
+
+import feeds
+from radio import FrameBatch
+
+
+def _parse_beast(data: bytes):
+    """ Reference Beast reader, byte by byte: yields (type, unescaped body) for each frame """
+    i = 0
+    while i < len(data):
+        assert data[i] == feeds.BEAST_ESC and data[i + 1] != feeds.BEAST_ESC
+        kind, body, i = data[i + 1], bytearray(), i + 2
+        while i < len(data) and not (data[i] == feeds.BEAST_ESC and data[i + 1:i + 2] != bytes([feeds.BEAST_ESC])):
+            if data[i] == feeds.BEAST_ESC:
+                i += 1  # first of a doubled 0x1a
+            body.append(data[i])
+            i += 1
+        yield kind, bytes(body)
+
+
+def _batch(n: int = 200) -> FrameBatch:
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 256, (n, 14), dtype=np.uint8)
+    frames[::3, 5:9] = feeds.BEAST_ESC  # runs of 0x1a, and one at the end of a frame
+    frames[1::7, -1] = feeds.BEAST_ESC
+    times = 1.7e9 + rng.random(n) * 1000
+    times[::5] = (0x1A1A1A1A1A1A + np.arange(0, n, 5)) / feeds.BEAST_CLOCK  # timestamps with escaped bytes
+    signal = rng.integers(0, 3000, n).astype(np.uint16)
+    signal[::4] = feeds.BEAST_ESC * feeds.SIGNAL_FULL_SCALE // 255 + 1
+    return FrameBatch(times, frames, np.zeros(n, dtype=np.uint8), signal)
+
+
+def test_beast_escaping():
+    batch = _batch()
+    parsed = list(_parse_beast(feeds.beast_frames(batch)))
+    assert len(parsed) == batch.size
+    for i, (kind, body) in enumerate(parsed):
+        assert kind == feeds.BEAST_LONG and len(body) == 21
+        ticks = round(batch.times[i] * feeds.BEAST_CLOCK) & ((1 << 48) - 1)
+        assert int.from_bytes(body[:6], 'big') == ticks
+        assert body[6] == min(int(batch.signal[i]) * 255 // feeds.SIGNAL_FULL_SCALE, 255)
+        assert body[7:] == batch.frames[i].tobytes()
+    assert any(b[6] == feeds.BEAST_ESC for _, b in parsed)
+
+
+def test_raw_frames():
+    batch = _batch(20)
+    lines = feeds.raw_frames(batch).decode().splitlines()
+    assert lines == [f'*{f.tobytes().hex().upper()};' for f in batch.frames]
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+
+import recording
+from utils import MSG_LEN, bin2bytes, iter_msg_file
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+def _records(n: int):
+    rng = np.random.default_rng(0)
+    times = 1.7e9 + np.cumsum(rng.random(n) * 0.01)
+    return times, rng.integers(0, 256, (n, MSG_LEN // 8), dtype=np.uint8), rng.integers(0, 1 << 16, n)
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'rec.a522')
+    times, frames, signal = _records(5000)
+    with recording.RecordWriter(path, buffer_bytes=1000) as writer:
+        for i in range(0, len(times), 777):
+            writer.write(times[i:i + 777], frames[i:i + 777], signal[i:i + 777])
+    reader = recording.RecordReader(path)
+    assert len(reader) == len(times)
+    assert np.array_equal(reader.records['time_us'], np.round(times * 1e6).astype(np.uint64))
+    assert np.array_equal(reader.records['frame'], frames)
+    assert np.array_equal(reader.records['signal'], signal)
+    assert np.array_equal(reader.index['record'], np.arange(0, len(times), recording.INDEX_EVERY))
+
+
+def test_window(tmp_path):
+    path = str(tmp_path / 'rec.a522')
+    times, frames, signal = _records(5000)
+    with recording.RecordWriter(path) as writer:
+        writer.write(times, frames, signal)
+    reader = recording.RecordReader(path)
+    t_us = reader.records['time_us']
+    for start, end in [(None, None), (times[100], times[3000]), (times[0] - 1, times[-1] + 1), (times[2048], None),
+                       (None, times[1024] + 1e-7), (times[-1] + 1, None)]:
+        window = reader.window(start, end)
+        keep = np.ones(len(t_us), dtype=bool)
+        if start is not None:
+            keep &= t_us >= round(start * 1e6)
+        if end is not None:
+            keep &= t_us < round(end * 1e6)
+        assert np.array_equal(window, reader.records[keep])
+
+
+def test_stale_index_is_rebuilt(tmp_path):
+    path = str(tmp_path / 'rec.a522')
+    times, frames, signal = _records(3000)
+    with recording.RecordWriter(path) as writer:
+        writer.write(times, frames, signal)
+    with recording.RecordWriter(path) as writer:  # overwritten with less, so an old index would be wrong
+        writer.write(times[:1500] + 10, frames[:1500])
+    os.remove(path + '.idx')
+    np.zeros(3, dtype=recording.INDEX).tofile(path + '.idx')
+    reader = recording.RecordReader(path)
+    assert np.array_equal(reader.index['record'], [0, 1024])
+    assert reader.index['time_us'][1] == reader.records['time_us'][1024]
+    assert np.array_equal(reader.window(times[1100] + 10)['frame'], frames[1100:1500])
+
+
+def test_text_round_trip(tmp_path):
+    text = os.path.join(DATA, 'position.txt')
+    expected = [(ts, bin2bytes(m)) for ts, m in iter_msg_file(text) if len(m) == MSG_LEN]
+    bin_path, text_path = str(tmp_path / 'rec.a522'), str(tmp_path / 'rec.txt')
+    assert recording.text_to_binary(text, bin_path) == len(expected)
+    assert recording.is_recording(bin_path) and not recording.is_recording(text)
+    assert list(recording.iter_frames(bin_path)) == [(float(ts), f) for ts, f in expected]
+    assert recording.binary_to_text(bin_path, text_path) == len(expected)
+    assert [(ts, bin2bytes(m)) for ts, m in iter_msg_file(text_path)] == expected
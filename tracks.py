@@ -0,0 +1,178 @@
+import numpy as np
+from collections import OrderedDict
+from time import time
+from typing import Dict, Iterator, Tuple, Union
+
+from data_handler import DataPoint
+
+TRACK_DTYPE = np.dtype([('t', 'f8'), ('lat', 'f8'), ('lon', 'f8'), ('alt', 'f4'), ('speed', 'f4'),
+                        ('heading', 'f4')])
+EARTH_RADIUS = 6371000  # m
+
+
+class Track:
+    """
+    History of one aircraft's positions in a fixed size ring array, so memory doesn't grow however long it's tracked.
+    A point is added for each position message. Speed and heading come in velocity messages, so each point has the
+    latest ones received (NaN until there's been one)
+    """
+    __slots__ = ('points', 'head', 'count', 'speed', 'heading')
+
+    def __init__(self, capacity: int):
+        self.points = np.empty(capacity, dtype=TRACK_DTYPE)
+        self.head = 0  # where the next point goes
+        self.count = 0
+        self.speed = np.nan
+        self.heading = np.nan
+
+    @property
+    def capacity(self) -> int:
+        return len(self.points)
+
+    @property
+    def last_time(self) -> float:
+        return self.points['t'][self.head - 1] if self.count > 0 else -np.inf
+
+    def update(self, attrs: Dict[str, DataPoint], t: float) -> bool:
+        """ Adds the data from a message. Returns whether a point was added """
+        if 'horz_vel' in attrs:
+            self.speed = attrs['horz_vel'].value
+            self.heading = attrs['heading'].value
+        if 'lat' not in attrs or t < self.last_time:  # points are kept in time order so queries can bisect
+            return False
+        alt = attrs['alt'].value if 'alt' in attrs else np.nan
+        self.points[self.head] = (t, attrs['lat'].value, attrs['lon'].value, alt, self.speed, self.heading)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        return True
+
+    def history(self) -> np.ndarray:
+        """ Every point held, oldest first (a copy) """
+        if self.count < self.capacity:
+            return self.points[:self.count].copy()
+        return np.concatenate((self.points[self.head:], self.points[:self.head]))
+
+    def since(self, t: float) -> np.ndarray:
+        """ Points at or after time t, oldest first """
+        if self.count == 0 or self.last_time < t:
+            return self.points[:0].copy()
+        points = self.history()
+        return points[np.searchsorted(points['t'], t):]
+
+    def __len__(self):
+        return self.count
+
+
+def resample(points: np.ndarray, interval: float) -> np.ndarray:
+    """
+    Interpolates a track onto evenly spaced times, from its first point to its last
+    :param points: TRACK_DTYPE points, oldest first
+    :param interval: seconds between the new points
+    """
+    if len(points) < 2:
+        return points.copy()
+    t = points['t']
+    out = np.empty(int((t[-1] - t[0]) // interval) + 1, dtype=TRACK_DTYPE)
+    out['t'] = t[0] + np.arange(len(out)) * interval
+    for col in ('lat', 'lon', 'alt', 'speed'):
+        out[col] = np.interp(out['t'], t, points[col])
+    # headings are interpolated the short way around (350 -> 10 goes through 0, not 180). Points from before the
+    # first velocity message have none, and unwrap would spread their NaN, so only known headings are used
+    known = np.isfinite(points['heading'])
+    out['heading'] = np.nan
+    if known.any():
+        heading = np.unwrap(np.deg2rad(points['heading'][known]))
+        out['heading'] = np.rad2deg(np.interp(out['t'], t[known], heading, left=np.nan, right=np.nan))
+        out['heading'] %= 360  # after the cast to float32, which can round 359.99999 up to 360
+    return out
+
+
+def path_distance(points: np.ndarray) -> np.ndarray:
+    """ Distance (m) along a track to each point. Uses a flat earth between points, which is fine at their spacing """
+    lat, lon = np.deg2rad(points['lat']), np.deg2rad(points['lon'])
+    dy = np.diff(lat)
+    dx = (np.diff(lon) + np.pi) % (2 * np.pi) - np.pi  # across the antimeridian too
+    step = EARTH_RADIUS * np.hypot(dy, dx * np.cos((lat[1:] + lat[:-1]) / 2))
+    return np.concatenate(([0.0], np.cumsum(step)))
+
+
+def downsample(points: np.ndarray, min_dist: float, keep_last: bool = True) -> np.ndarray:
+    """
+    Thins a track for drawing: keeps the first point in each ``min_dist`` meters of path and (by default) the
+    last point, so a trail costs the same however often the aircraft reported
+    :param points: TRACK_DTYPE points, oldest first
+    :param min_dist: meters of path between kept points
+    :param keep_last: whether the last point is always kept. Without it, a trail extended later from its last kept
+    point keeps the same spacing
+    """
+    if len(points) < 2 or min_dist <= 0:
+        return points.copy()
+    bins = (path_distance(points) // min_dist).astype(np.int64)
+    keep = np.empty(len(points), dtype=bool)
+    keep[0] = True
+    keep[1:] = bins[1:] != bins[:-1]
+    keep[-1] |= keep_last
+    return points[keep]
+
+
+class TrackStore:
+    """
+    Tracks of many aircraft, keyed by ICAO. Each track has ``capacity`` points preallocated, and once more than
+    ``max_aircraft`` are held the least recently updated is dropped, so memory is bounded at
+    ``capacity * max_aircraft * TRACK_DTYPE.itemsize``
+    """
+
+    def __init__(self, capacity: int = 1024, max_aircraft: int = 5000):
+        """
+        :param capacity: points kept per aircraft. At one position every couple of seconds 1024 is over half an hour
+        :param max_aircraft: tracks kept before the least recently updated is dropped
+        """
+        self.capacity = capacity
+        self.max_aircraft = max_aircraft
+        self._tracks: 'OrderedDict[str, Track]' = OrderedDict()
+
+    def update(self, icao_id: str, attrs: Dict[str, DataPoint], t: Union[float, None] = None) -> bool:
+        """ Adds the data from a message to an aircraft's track. Returns whether a point was added """
+        track = self._tracks.get(icao_id)
+        if track is None:
+            if 'lat' not in attrs and 'horz_vel' not in attrs:
+                return False  # nothing to keep, so no need to allocate a track yet
+            track = self._tracks[icao_id] = Track(self.capacity)
+            while len(self._tracks) > self.max_aircraft:
+                self._tracks.popitem(last=False)
+        else:
+            self._tracks.move_to_end(icao_id)
+        return track.update(attrs, time() if t is None else t)
+
+    def get(self, icao_id: str) -> Union[Track, None]:
+        return self._tracks.get(icao_id)
+
+    def remove(self, icao_id: str) -> None:
+        self._tracks.pop(icao_id, None)
+
+    def trail(self, icao_id: str, seconds: float, min_dist: float = 0, now: Union[float, None] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        An aircraft's recent path for drawing
+        :param seconds: how far back the trail goes
+        :param min_dist: meters between drawn points (see ``downsample()``)
+        :return: lat and lon arrays, oldest first. Empty if the aircraft has no track
+        """
+        track = self._tracks.get(icao_id)
+        if track is None:
+            return np.empty(0), np.empty(0)
+        points = downsample(track.since((time() if now is None else now) - seconds), min_dist)
+        return points['lat'], points['lon']
+
+    @property
+    def nbytes(self) -> int:
+        return sum(track.points.nbytes for track in self._tracks.values())
+
+    def __contains__(self, icao_id: str) -> bool:
+        return icao_id in self._tracks
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._tracks)
@@ -1,4 +1,5 @@
 import requests
+from typing import Iterator, Tuple
 
 # constants
 MSG_LEN = 112
@@ -23,11 +24,34 @@ def int2bin(i: int) -> str:
     return format(i, 'b')
 
 
+def bin2bytes(b: str) -> bytes:
+    """ converts binary string to bytes. Length of string should be a multiple of 8 """
+    return int(b, 2).to_bytes(len(b) // 8, 'big')
+
+
+def bytes2bin(b: bytes) -> str:
+    """ converts bytes to binary string """
+    return format(int.from_bytes(b, 'big'), f'0{len(b) * 8}b')
+
+
 def bin2bool(b: str) -> bool:
     """ converts binary string to bool (each bit is ANDed) """
     return all([b_ == "1" for b_ in b])
 
 
+# message files
+def iter_msg_file(path: str) -> Iterator[Tuple[int, str]]:
+    """
+    Streams (timestamp, binary_msg) pairs from a message file without loading it into memory.
+    Lines starting with `#` (and blank lines) are ignored. Each line should be `timestamp binary_msg`
+    """
+    with open(path, 'r') as inp:
+        for line in inp:
+            if not line.startswith('#') and line.strip():
+                ts, msg = line.strip().split(' ')
+                yield int(ts), msg.strip()
+
+
 # other
 def set_loc_ip():
     """